@@ -1,19 +1,28 @@
-import os
-import pygame
-from tkinter import Tk, filedialog, Button, Listbox, Scrollbar, Label, Canvas, PhotoImage
+from tkinter import Tk, StringVar, Button, Listbox, Label, Canvas, PhotoImage
 from tkinter import ttk
-from PIL import Image, ImageTk, ImageFilter
-import eyed3
-import io
 
-class MusicPlayer:
+from album_art import AlbumArtLoader
+from app_paths import data_path
+from art_cache import ArtCache
+import instrumentation
+from instrumentation import timed
+from library_view import VirtualListView
+from player_core import PlayerCore
+from playback_clock import refresh_interval
+from player_window import PlayerWindow
+from waveform import WaveformLoader, waveform_points
+
+class MusicPlayer(PlayerWindow):
     def __init__(self, master):
-        self.master = master
         master.title("Simple Music Player")
+        self.album_art_item = None
+        # Covers come from the art cache once a scan has put them there
+        self.art_cache = ArtCache(data_path("art"))
+        self.art_loader = AlbumArtLoader(master, (750, 550), blur=False, art_cache=self.art_cache)
+        self.waveform_loader = WaveformLoader(master)
 
-        self.current_track = None
-        self.playing = False
-        self.playlist = []
+        # Playback and the playlist live in the UI-free core, this class only draws them
+        self.attach(master, PlayerCore(art_loader=self.art_loader, art_cache=self.art_cache))
 
         # Create a canvas with no background
         self.canvas = Canvas(master, width=700, height=600, bd=0, highlightthickness=0, background="black") ##ADD8E6
@@ -29,6 +38,17 @@ class MusicPlayer:
         self.select_button = ttk.Button(self.canvas, text="Select Track", command=self.select_track)
         self.select_button_window = self.canvas.create_window(350, 120, anchor="center", window=self.select_button)
 
+        self.playlist_button = ttk.Button(self.canvas, text="Playlist...", command=self.show_playlist_menu)
+        self.playlist_button_window = self.canvas.create_window(175, 120, anchor="center", window=self.playlist_button)
+
+        self.build_playlist_menu()
+
+        self.scan_button = ttk.Button(self.canvas, text="Scan Folder", command=self.scan_folder)
+        self.scan_button_window = self.canvas.create_window(525, 120, anchor="center", window=self.scan_button)
+
+        self.scan_status_label = ttk.Label(self.canvas, text="", font=("Helvetica", 10))
+        self.scan_status_label_window = self.canvas.create_window(350, 160, anchor="center", window=self.scan_status_label)
+
         self.play_button = ttk.Button(self.canvas, text="Play", command=self.toggle_play)
         self.play_button_window = self.canvas.create_window(350, 200, anchor="center", window=self.play_button)
 
@@ -38,6 +58,17 @@ class MusicPlayer:
         self.prev_button = ttk.Button(self.canvas, text="Previous", command=self.play_previous,)
         self.prev_button_window = self.canvas.create_window(175, 200, anchor="center", window=self.prev_button)
 
+        self.shuffle_button = ttk.Button(self.canvas, text="Shuffle: Off", command=self.toggle_shuffle)
+        self.shuffle_button_window = self.canvas.create_window(175, 250, anchor="center", window=self.shuffle_button)
+
+        self.repeat_button = ttk.Button(self.canvas, text="Repeat: All", command=self.cycle_repeat)
+        self.repeat_button_window = self.canvas.create_window(525, 250, anchor="center", window=self.repeat_button)
+
+        self.sound_button = ttk.Button(self.canvas, text="Sound...", command=self.show_sound_menu)
+        self.sound_button_window = self.canvas.create_window(350, 250, anchor="center", window=self.sound_button)
+
+        self.build_sound_menu()
+
         self.song_library_label = ttk.Label(self.canvas, text="Song Library", font=("Helvetica", 12))
         self.song_library_label_window = self.canvas.create_window(375, 380, anchor="center", window=self.song_library_label)
 
@@ -45,10 +76,19 @@ class MusicPlayer:
         self.song_listbox = Listbox(self.canvas, selectmode="SINGLE", font=("Helvetica", 10), bd=0, highlightthickness=0, width=60)
         self.song_listbox_window = self.canvas.create_window(350, 420, anchor="center", window=self.song_listbox)
 
-        # Example songs for the song library
-        self.populate_song_library()
+        # Only the visible rows of the library are ever put into the Listbox
+        self.library_view = VirtualListView(self.song_listbox, self.playlist, label=self.entry_label)
         self.song_listbox.bind("<Double-Button-1>", self.load_selected_song)
 
+        # Search box, filtering the library on every keystroke
+        self.search_label = ttk.Label(self.canvas, text="Search", font=("Helvetica", 10))
+        self.search_label_window = self.canvas.create_window(300, 560, anchor="e", window=self.search_label)
+
+        self.search_var = StringVar()
+        self.search_var.trace_add("write", self.on_search)
+        self.search_entry = ttk.Entry(self.canvas, textvariable=self.search_var, width=40)
+        self.search_entry_window = self.canvas.create_window(390, 560, anchor="center", window=self.search_entry)
+
         # Progress bar
         style.configure("TProgressbar",thickness=20, troughcolor="gray", background="light blue", troughrelief="flat", borderwidth=0)
         self.progress_bar = ttk.Progressbar(self.canvas, orient="horizontal", length=600, mode="determinate",style="TProgressbar")
@@ -61,67 +101,56 @@ class MusicPlayer:
         self.total_time_label = ttk.Label(self.canvas, text="0:00", font=("Helvetica", 10))
         self.total_time_label_window = self.canvas.create_window(625, 322, anchor="center", window=self.total_time_label)
 
-        # Make the progress bar interactive
+        # Waveform overview of the track under the progress bar, drawn once the peaks are ready
+        self.waveform_canvas = Canvas(self.canvas, width=600, height=36, bd=0, highlightthickness=0, background="black")
+        self.waveform_canvas_window = self.canvas.create_window(350, 350, anchor="center", window=self.waveform_canvas)
+        self.waveform_item = self.waveform_canvas.create_polygon(0, 0, 0, 0, fill="gray", outline="")
+        self.waveform_cursor = self.waveform_canvas.create_line(0, 0, 0, 36, fill="light blue", width=2)
+
+        # Make the progress bar and the waveform interactive
         self.progress_bar.bind("<Button-1>", self.change_song_position)
+        self.waveform_canvas.bind("<Button-1>", self.change_song_position)
 
         # Set initial value for the progress bar
         self.progress_bar["value"] = 0
 
-    def select_track(self):
-        file_path = filedialog.askopenfilename(filetypes=[("Audio Files", "*.mp3;*.wav")])
-        if file_path:
-            self.playlist.append(file_path)
-            self.update_song_library()
-            if not self.current_track:
-                self.load_and_play(file_path)
-
-    def toggle_play(self):
-        if self.current_track:
-            if not self.playing:
-                pygame.mixer.music.unpause()
-                self.playing = True
-                self.play_button.configure(text="Pause", style="TButton")
-                self.update_progress_bar()
-            else:
-                pygame.mixer.music.pause()
-                self.playing = False
-                self.play_button.configure(text="Play", style="TButton")
-
-    def play_next(self):
-        if self.playlist:
-            current_index = self.playlist.index(self.current_track)
-            next_index = (current_index + 1) % len(self.playlist)
-            self.load_and_play(self.playlist[next_index])
-
-    def play_previous(self):
-        if self.playlist:
-            current_index = self.playlist.index(self.current_track)
-            prev_index = (current_index - 1) % len(self.playlist)
-            self.load_and_play(self.playlist[prev_index])
-
-    def load_and_play(self, file_path):
-        pygame.mixer.init()
-        pygame.mixer.music.load(file_path)
-        pygame.mixer.music.play()
-        self.playing = True
-        self.play_button.configure(text="Pause", style="TButton")
-        self.current_track = file_path
-
-        # Extract and display album art
-        album_art = self.extract_album_art(file_path)
-        if album_art:
-            self.display_album_art(album_art)
-
-        # Update progress bar
-        self.update_progress_bar()
+        self.start()
+
+    def show_track(self):
+        # Album art is decoded in the background and shown once it is ready
+        track_info = self.core.track_info
+        art_hash = track_info.art_hash if track_info else None
+        self.art_loader.request(self.core.current_track, art_hash, self.display_album_art)
+
+        # Clear the previous track's waveform until this one's is loaded
+        self.waveform_canvas.coords(self.waveform_item, 0, 0, 0, 0)
+        self.waveform_loader.request(self.core.current_track, self.display_waveform)
 
+    def display_waveform(self, peaks):
+        width = self.waveform_canvas.winfo_width()
+        height = self.waveform_canvas.winfo_height()
+        if width > 1 and height > 1:
+            self.waveform_canvas.coords(self.waveform_item, *waveform_points(peaks, width, height))
+
+    @timed("progress_tick")
     def update_progress_bar(self):
+        # Only keep one pending tick, however often this gets called
+        if self.progress_job is not None:
+            self.master.after_cancel(self.progress_job)
+            self.progress_job = None
+
+        # A finished track starts the next one, which restarts the tick by itself
+        if self.core.playing and self.core.poll():
+            return
+
         # Update progress bar based on the current position of the song
-        if self.playing:
-            length = pygame.mixer.music.get_pos() / 1000
-            total_length = eyed3.load(self.current_track).info.time_secs
+        if self.core.current_track and self.core.duration and self.visible:
+            length = self.core.position()
+            total_length = self.core.duration
             progress_percentage = (length / total_length) * 100
             self.progress_bar["value"] = progress_percentage
+            x = self.waveform_canvas.winfo_width() * length / total_length
+            self.waveform_canvas.coords(self.waveform_cursor, x, 0, x, self.waveform_canvas.winfo_height())
 
             # Update current time label
             current_minutes, current_seconds = divmod(int(length), 60)
@@ -131,64 +160,50 @@ class MusicPlayer:
             total_minutes, total_seconds = divmod(int(total_length), 60)
             self.total_time_label["text"] = f"{total_minutes}:{total_seconds:02d}"
 
-            # Call the function after 100 milliseconds to update the progress bar
-            self.master.after(100, self.update_progress_bar)
-
-    def extract_album_art(self, file_path):
-        try:
-            audiofile = eyed3.load(file_path)
-            if audiofile.tag and audiofile.tag.images:
-                # Assume the first image is the album art
-                return audiofile.tag.images[0].image_data
-        except Exception as e:
-            print(f"Error extracting album art: {e}")
-        return None
-
-    def display_album_art(self, image_data):
-        # Convert the image data to a Tkinter PhotoImage
-        image = Image.open(io.BytesIO(image_data))
-        thumbnail = image.copy()
-        thumbnail.thumbnail((750, 550)) 
-        album_art_photo = ImageTk.PhotoImage(thumbnail)
-
-        # Set the thumbnail as the background
-        self.canvas.create_image(350, 275, anchor="center", image=album_art_photo)
+        # Call the function again once the bar (or the track) has moved on far enough to matter
+        if self.core.playing:
+            interval = refresh_interval(self.core.duration, self.progress_bar.winfo_width(), self.visible,
+                                        self.core.remaining(), labels=True)
+            self.progress_job = self.master.after(interval, self.update_progress_bar)
+
+    @timed("album_art_display")
+    def display_album_art(self, album_art_photo):
+        # Set the thumbnail as the background, reusing one canvas item across tracks
+        if self.album_art_item is None:
+            self.album_art_item = self.canvas.create_image(350, 275, anchor="center", image=album_art_photo)
+        else:
+            self.canvas.itemconfigure(self.album_art_item, image=album_art_photo)
 
         # Update the album art label
         self.album_art_label.configure(image=album_art_photo)
         self.album_art_label.image = album_art_photo
 
-    def populate_song_library(self):
-        # Example songs for the song library
-        songs = ["Song 1", "Song 2", "Song 3"]
-        for song in songs:
-            self.song_listbox.insert("end", song)
-
-    def update_song_library(self):
-        self.song_listbox.delete(0, "end")
-        for song in self.playlist:
-            self.song_listbox.insert("end", os.path.basename(song))
-
-    def load_selected_song(self, event):
-        selected_song_index = self.song_listbox.curselection()
-        if selected_song_index:
-            selected_song = self.playlist[selected_song_index[0]]
-            self.load_and_play(selected_song)
-
     def change_song_position(self, event):
+        if not self.core.duration:
+            return
+
         # Calculate the new position based on the click event
-        new_position = (event.x / self.progress_bar.winfo_width()) * 100
+        new_position = (event.x / event.widget.winfo_width()) * 100
 
         # Set the new position of the song
-        total_length = eyed3.load(self.current_track).info.time_secs
-        new_time = (new_position / 100) * total_length
-        pygame.mixer.music.set_pos(new_time)
+        new_time = (new_position / 100) * self.core.duration
+        self.core.seek(new_time)
+        self.update_progress_bar()
+
+
+def main():
+    # Create the Tkinter window
+    root = Tk()
+
+    # Create an instance of the MusicPlayer class
+    music_player = MusicPlayer(root)
+
+    # Latency metrics and UI stall detection, when enabled through the environment
+    instrumentation.start(root)
 
-# Create the Tkinter window
-root = Tk()
+    # Run the Tkinter event loop
+    root.mainloop()
 
-# Create an instance of the MusicPlayer class
-music_player = MusicPlayer(root)
 
-# Run the Tkinter event loop
-root.mainloop()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
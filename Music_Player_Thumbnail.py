@@ -1,19 +1,26 @@
-import os
-import pygame
-from tkinter import Tk, filedialog, Button, Listbox, Scrollbar, Label, Canvas, PhotoImage
+from tkinter import Tk, StringVar, Button, Listbox, Scrollbar, Label, Canvas, PhotoImage
 from tkinter import ttk
-from PIL import Image, ImageTk, ImageFilter
-import eyed3
-import io
 
-class MusicPlayer:
+from album_art import AlbumArtLoader
+from app_paths import data_path
+from art_cache import ArtCache
+import instrumentation
+from instrumentation import timed
+from library_view import VirtualListView
+from player_core import PlayerCore
+from playback_clock import refresh_interval
+from player_window import PlayerWindow
+
+class MusicPlayer(PlayerWindow):
     def __init__(self, master):
-        self.master = master
         master.title("Simple Music Player")
+        self.album_art_item = None
+        # Covers come from the art cache once a scan has put them there
+        self.art_cache = ArtCache(data_path("art"))
+        self.art_loader = AlbumArtLoader(master, (750, 550), blur=True, art_cache=self.art_cache)
 
-        self.current_track = None
-        self.playing = False
-        self.playlist = []
+        # Playback and the playlist live in the UI-free core, this class only draws them
+        self.attach(master, PlayerCore(art_loader=self.art_loader, art_cache=self.art_cache))
 
         # Create a canvas with no background
         self.canvas = Canvas(master, width=750, height=600, bd=0, highlightthickness=0)
@@ -29,6 +36,17 @@ class MusicPlayer:
         self.select_button = ttk.Button(self.canvas, text="Select Track", command=self.select_track)
         self.select_button_window = self.canvas.create_window(375, 120, anchor="center", window=self.select_button)
 
+        self.playlist_button = ttk.Button(self.canvas, text="Playlist...", command=self.show_playlist_menu)
+        self.playlist_button_window = self.canvas.create_window(200, 120, anchor="center", window=self.playlist_button)
+
+        self.build_playlist_menu()
+
+        self.scan_button = ttk.Button(self.canvas, text="Scan Folder", command=self.scan_folder)
+        self.scan_button_window = self.canvas.create_window(550, 120, anchor="center", window=self.scan_button)
+
+        self.scan_status_label = ttk.Label(self.canvas, text="", font=("Helvetica", 10))
+        self.scan_status_label_window = self.canvas.create_window(375, 160, anchor="center", window=self.scan_status_label)
+
         self.play_button = ttk.Button(self.canvas, text="Play", command=self.toggle_play)
         self.play_button_window = self.canvas.create_window(200, 200, anchor="center", window=self.play_button)
 
@@ -38,6 +56,17 @@ class MusicPlayer:
         self.prev_button = ttk.Button(self.canvas, text="Previous", command=self.play_previous)
         self.prev_button_window = self.canvas.create_window(550, 200, anchor="center", window=self.prev_button)
 
+        self.shuffle_button = ttk.Button(self.canvas, text="Shuffle: Off", command=self.toggle_shuffle)
+        self.shuffle_button_window = self.canvas.create_window(200, 250, anchor="center", window=self.shuffle_button)
+
+        self.repeat_button = ttk.Button(self.canvas, text="Repeat: All", command=self.cycle_repeat)
+        self.repeat_button_window = self.canvas.create_window(550, 250, anchor="center", window=self.repeat_button)
+
+        self.sound_button = ttk.Button(self.canvas, text="Sound...", command=self.show_sound_menu)
+        self.sound_button_window = self.canvas.create_window(375, 250, anchor="center", window=self.sound_button)
+
+        self.build_sound_menu()
+
         self.song_library_label = ttk.Label(self.canvas, text="Song Library", font=("Helvetica", 12))
         self.song_library_label_window = self.canvas.create_window(375, 300, anchor="center", window=self.song_library_label)
 
@@ -45,15 +74,20 @@ class MusicPlayer:
         self.song_listbox_window = self.canvas.create_window(375, 400, anchor="center", window=self.song_listbox)
 
         self.scrollbar = Scrollbar(self.canvas, orient="vertical")
-        self.scrollbar.config(command=self.song_listbox.yview)
         self.scrollbar_window = self.canvas.create_window(570, 400, anchor="center", window=self.scrollbar)
 
-        self.song_listbox.config(yscrollcommand=self.scrollbar.set)
+        # Only the visible rows of the library are ever put into the Listbox
+        self.library_view = VirtualListView(self.song_listbox, self.playlist, label=self.entry_label, scrollbar=self.scrollbar)
+        self.song_listbox.bind("<Double-Button-1>", self.load_selected_song)
 
-        # Example songs for the song library
-        self.populate_song_library()
+        # Search box, filtering the library on every keystroke
+        self.search_label = ttk.Label(self.canvas, text="Search", font=("Helvetica", 10))
+        self.search_label_window = self.canvas.create_window(200, 550, anchor="e", window=self.search_label)
 
-        self.song_listbox.bind("<Double-Button-1>", self.load_selected_song)
+        self.search_var = StringVar()
+        self.search_var.trace_add("write", self.on_search)
+        self.search_entry = ttk.Entry(self.canvas, textvariable=self.search_var, width=40)
+        self.search_entry_window = self.canvas.create_window(400, 550, anchor="center", window=self.search_entry)
 
         # Progress bar
         style.configure("TProgressbar",
@@ -65,113 +99,64 @@ class MusicPlayer:
         # Set initial value for the progress bar
         self.progress_bar["value"] = 0
 
-    def select_track(self):
-        file_path = filedialog.askopenfilename(filetypes=[("Audio Files", "*.mp3;*.wav")])
-        if file_path:
-            self.playlist.append(file_path)
-            self.update_song_library()
-            if not self.current_track:
-                self.load_and_play(file_path)
-
-    def toggle_play(self):
-        if self.current_track:
-            if not self.playing:
-                pygame.mixer.music.unpause()
-                self.playing = True
-                self.play_button.configure(text="Pause", style="TButton")
-                self.update_progress_bar()
-            else:
-                pygame.mixer.music.pause()
-                self.playing = False
-                self.play_button.configure(text="Play", style="TButton")
-
-    def play_next(self):
-        if self.playlist:
-            current_index = self.playlist.index(self.current_track)
-            next_index = (current_index + 1) % len(self.playlist)
-            self.load_and_play(self.playlist[next_index])
-
-    def play_previous(self):
-        if self.playlist:
-            current_index = self.playlist.index(self.current_track)
-            prev_index = (current_index - 1) % len(self.playlist)
-            self.load_and_play(self.playlist[prev_index])
-
-    def load_and_play(self, file_path):
-        pygame.mixer.init()
-        pygame.mixer.music.load(file_path)
-        pygame.mixer.music.play()
-        self.playing = True
-        self.play_button.configure(text="Pause", style="TButton")
-        self.current_track = file_path
-
-        # Extract and display album art
-        album_art = self.extract_album_art(file_path)
-        if album_art:
-            self.display_album_art(album_art)
-
-        # Update progress bar
-        self.update_progress_bar()
+        self.start()
+
+    def show_track(self):
+        # Album art is decoded in the background and shown once it is ready
+        track_info = self.core.track_info
+        art_hash = track_info.art_hash if track_info else None
+        self.art_loader.request(self.core.current_track, art_hash, self.display_album_art)
 
+    @timed("progress_tick")
     def update_progress_bar(self):
+        # Only keep one pending tick, however often this gets called
+        if self.progress_job is not None:
+            self.master.after_cancel(self.progress_job)
+            self.progress_job = None
+
+        # A finished track starts the next one, which restarts the tick by itself
+        if self.core.playing and self.core.poll():
+            return
+
         # Update progress bar based on the current position of the song
-        if self.playing:
-            length = pygame.mixer.music.get_pos() / 1000
-            total_length = eyed3.load(self.current_track).info.time_secs
+        if self.core.current_track and self.core.duration and self.visible:
+            length = self.core.position()
+            total_length = self.core.duration
             progress_percentage = (length / total_length) * 100
             self.progress_bar["value"] = progress_percentage
-            self.master.after(100, self.update_progress_bar)
 
-    def extract_album_art(self, file_path):
-        try:
-            audiofile = eyed3.load(file_path)
-            if audiofile.tag and audiofile.tag.images:
-                # Assume the first image is the album art
-                return audiofile.tag.images[0].image_data
-        except Exception as e:
-            print(f"Error extracting album art: {e}")
-        return None
+        # Call the function again once the bar (or the track) has moved on far enough to matter
+        if self.core.playing:
+            interval = refresh_interval(self.core.duration, self.progress_bar.winfo_width(), self.visible,
+                                        self.core.remaining())
+            self.progress_job = self.master.after(interval, self.update_progress_bar)
 
-    def display_album_art(self, image_data):
-        # Convert the image data to a Tkinter PhotoImage
-        image = Image.open(io.BytesIO(image_data))
-        thumbnail = image.copy()
-        thumbnail.thumbnail((750, 550))  # Resize to match the canvas size
-
-        # Apply a blur effect to the thumbnail
-        thumbnail = thumbnail.filter(ImageFilter.BLUR)
-
-        album_art_photo = ImageTk.PhotoImage(thumbnail)
-
-        # Set the thumbnail as the background
-        self.canvas.create_image(375, 275, anchor="center", image=album_art_photo)
+    @timed("album_art_display")
+    def display_album_art(self, album_art_photo):
+        # Set the thumbnail as the background, reusing one canvas item across tracks
+        if self.album_art_item is None:
+            self.album_art_item = self.canvas.create_image(375, 275, anchor="center", image=album_art_photo)
+        else:
+            self.canvas.itemconfigure(self.album_art_item, image=album_art_photo)
 
         # Update the album art label
         self.album_art_label.configure(image=album_art_photo)
         self.album_art_label.image = album_art_photo
 
-    def populate_song_library(self):
-        # Example songs for the song library
-        songs = ["Song 1", "Song 2", "Song 3"]
-        for song in songs:
-            self.song_listbox.insert("end", song)
 
-    def update_song_library(self):
-        self.song_listbox.delete(0, "end")
-        for song in self.playlist:
-            self.song_listbox.insert("end", os.path.basename(song))
+def main():
+    # Create the Tkinter window
+    root = Tk()
+
+    # Create an instance of the MusicPlayer class
+    music_player = MusicPlayer(root)
 
-    def load_selected_song(self, event):
-        selected_song_index = self.song_listbox.curselection()
-        if selected_song_index:
-            selected_song = self.playlist[selected_song_index[0]]
-            self.load_and_play(selected_song)
+    # Latency metrics and UI stall detection, when enabled through the environment
+    instrumentation.start(root)
 
-# Create the Tkinter window
-root = Tk()
+    # Run the Tkinter event loop
+    root.mainloop()
 
-# Create an instance of the MusicPlayer class
-music_player = MusicPlayer(root)
 
-# Run the Tkinter event loop
-root.mainloop()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import io
+import hashlib
+from collections import OrderedDict
+
+from background_loader import BackgroundLoader
+from instrumentation import timed
+from playlist_files import source_path
+
+
+@timed("album_art_extract")
+def extract_album_art(file_path):
+    try:
+        import eyed3
+        audiofile = eyed3.load(file_path)
+        if audiofile and audiofile.tag and audiofile.tag.images:
+            # Assume the first image is the album art
+            return audiofile.tag.images[0].image_data
+    except Exception as e:
+        print(f"Error extracting album art: {e}")
+    return None
+
+
+@timed("album_art_prepare")
+def prepare_album_art(image_data, size, blur=False):
+    from PIL import Image, ImageFilter
+
+    image = Image.open(io.BytesIO(image_data))
+    # Let the JPEG decoder downscale while decoding instead of inflating the full image first
+    image.draft("RGB", size)
+    image = image.convert("RGB")
+    image.thumbnail(size)
+    if blur:
+        image = image.filter(ImageFilter.BLUR)
+    return image
+
+
+@timed("album_art_cached")
+def load_cached_art(path):
+    # Already the right size, only the PNG has to be decoded
+    from PIL import Image
+
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+class AlbumArtLoader(BackgroundLoader):
+    # Decodes, resizes and blurs album art on a worker thread. Ready-to-show images are kept in
+    # an LRU keyed by the hash of the embedded image, so every track of an album shares one entry.
+    # With an art_cache holding this size, covers come from its PNGs instead of the audio files.
+    ERROR = "Error loading album art"
+
+    def __init__(self, master, size, blur=False, capacity=32, art_cache=None):
+        super().__init__(master)
+        self.size = size
+        self.blur = blur
+        self.capacity = capacity
+        self.art_cache = art_cache
+        self.variant = None
+        if art_cache is not None:
+            from art_cache import variant_for
+            self.variant = variant_for(size, blur)
+
+        self._images = OrderedDict()
+        self._latest = 0
+
+    def request(self, file_path, art_hash, callback):
+        # callback(photo) is run on the Tk thread, and only for the most recent request
+        self._latest += 1
+        if art_hash:
+            entry = self._lookup(art_hash)
+            if entry is not None:
+                callback(self._photo(entry))
+                return
+        self._submit((self._latest, file_path, art_hash, callback))
+
+    def prefetch(self, file_path):
+        # Decode art into the LRU ahead of time, without displaying it
+        self._submit((None, file_path, None, None), poll=False)
+
+    def _lookup(self, art_hash):
+        with self._lock:
+            entry = self._images.get(art_hash)
+            if entry is not None:
+                self._images.move_to_end(art_hash)
+            return entry
+
+    def _store(self, art_hash, image):
+        with self._lock:
+            entry = self._images.get(art_hash)
+            if entry is None:
+                entry = [image, None]
+                self._images[art_hash] = entry
+                while len(self._images) > self.capacity:
+                    self._images.popitem(last=False)
+            return entry
+
+    @timed("album_art_photo")
+    def _photo(self, entry):
+        # PhotoImages may only be created on the Tk thread, so they are made on first display
+        if entry[1] is None:
+            from PIL import ImageTk
+            entry[1] = ImageTk.PhotoImage(entry[0])
+        return entry[1]
+
+    def _run(self, job):
+        token, file_path, art_hash, callback = job
+        if callback is not None and token != self._latest:
+            # Already skipped past this track
+            return
+        if art_hash and self.variant is not None and self.art_cache.has(art_hash, self.variant):
+            entry = self._lookup(art_hash)
+            if entry is None:
+                try:
+                    entry = self._store(art_hash, load_cached_art(self.art_cache.path(art_hash, self.variant)))
+                except Exception as e:
+                    print(f"Error reading cached album art: {e}")
+                    return
+            if callback is not None:
+                self._results.put((token, entry, callback))
+            return
+
+        # A CUE track shows the art of the file it is part of
+        image_data = extract_album_art(source_path(file_path))
+        if not image_data:
+            return
+        art_hash = hashlib.sha1(image_data).hexdigest()
+        if self.art_cache is not None:
+            # Next time it comes from the cache
+            self.art_cache.add(art_hash, image_data)
+        entry = self._lookup(art_hash)
+        if entry is None:
+            try:
+                entry = self._store(art_hash, prepare_album_art(image_data, self.size, self.blur))
+            except Exception as e:
+                print(f"Error decoding album art: {e}")
+                return
+        if callback is not None:
+            self._results.put((token, entry, callback))
+
+    def _handle(self, result):
+        token, entry, callback = result
+        if token == self._latest:
+            callback(self._photo(entry))
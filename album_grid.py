@@ -0,0 +1,185 @@
+import os
+from collections import namedtuple, OrderedDict
+
+from art_cache import ART_VARIANTS, THUMB
+from instrumentation import timed
+from playlist_files import source_path
+
+THUMB_WIDTH, THUMB_HEIGHT = ART_VARIANTS[THUMB][0]
+CELL_WIDTH = THUMB_WIDTH + 30
+CELL_HEIGHT = THUMB_HEIGHT + 50
+
+# How often a grid with covers still missing looks for new ones in the cache, in ms
+REFRESH_MS = 1000
+
+Album = namedtuple("Album", "title artist art_hash paths")
+
+
+def group_albums(paths, info_for):
+    # Tracks by album tag and folder, so two albums that share a name stay apart, sorted by
+    # artist and title. Tracks without an album tag aren't in any.
+    albums = {}
+    for path in paths:
+        info = info_for(path)
+        if info is None or not info.album:
+            continue
+        key = (info.album.casefold(), os.path.dirname(source_path(path)))
+        album = albums.get(key)
+        if album is None:
+            album = albums[key] = Album(info.album, info.artist, info.art_hash, [])
+        elif album.art_hash is None and info.art_hash:
+            album = albums[key] = album._replace(art_hash=info.art_hash)
+        album.paths.append(path)
+    return sorted(albums.values(), key=lambda album: ((album.artist or "").casefold(), album.title.casefold()))
+
+
+class AlbumGrid:
+    # Albums as rows of covers on a Canvas that only ever holds the cells on screen. Covers are
+    # the art cache's thumbnails, read when their cell comes into view and kept in a small LRU,
+    # so browsing thousands of albums never touches the audio files. on_open(album) is called
+    # on a double click.
+    def __init__(self, canvas, art_cache, on_open, scrollbar=None, capacity=256):
+        self.canvas = canvas
+        self.art_cache = art_cache
+        self.on_open = on_open
+        self.scrollbar = scrollbar
+        self.capacity = capacity
+
+        self.albums = []
+        self.first_row = 0
+        self._photos = OrderedDict()
+        self._missing = False
+        self._stored = None
+        self._render_pending = False
+        self._refresh_job = None
+
+        if scrollbar is not None:
+            scrollbar.config(command=self.yview)
+        canvas.bind("<Configure>", lambda event: self.schedule_render())
+        canvas.bind("<Double-Button-1>", self.on_double_click)
+        canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        canvas.bind("<Button-4>", lambda event: self.scroll(-1))
+        canvas.bind("<Button-5>", lambda event: self.scroll(1))
+
+    @property
+    def columns(self):
+        return max(1, self.canvas.winfo_width() // CELL_WIDTH)
+
+    @property
+    def rows(self):
+        # Rows fully on screen
+        return max(1, self.canvas.winfo_height() // CELL_HEIGHT)
+
+    @property
+    def total_rows(self):
+        return -(-len(self.albums) // self.columns)
+
+    def set_albums(self, albums):
+        self.albums = list(albums)
+        self.first_row = 0
+        self.schedule_render()
+
+    def on_mouse_wheel(self, event):
+        self.scroll(-1 if event.delta > 0 else 1)
+        return "break"
+
+    def scroll(self, rows):
+        self.scroll_to(self.first_row + rows)
+        return "break"
+
+    def scroll_to(self, first_row):
+        first_row = max(0, min(first_row, self.total_rows - self.rows))
+        if first_row != self.first_row:
+            self.first_row = first_row
+            self.schedule_render()
+
+    def yview(self, *args):
+        # Scrollbar protocol: ("moveto", fraction) or ("scroll", amount, "units"/"pages")
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * self.total_rows))
+        elif args[0] == "scroll":
+            amount = int(args[1])
+            self.scroll(amount * self.rows if args[2] == "pages" else amount)
+
+    def on_double_click(self, event):
+        for tag in self.canvas.gettags("current"):
+            if tag.startswith("album"):
+                self.on_open(self.albums[int(tag[5:])])
+                return
+
+    def schedule_render(self):
+        if not self._render_pending:
+            self._render_pending = True
+            self.canvas.after_idle(self.render)
+
+    @timed("album_grid_render")
+    def render(self):
+        self._render_pending = False
+        canvas = self.canvas
+        canvas.delete("all")
+        columns = self.columns
+        self.first_row = max(0, min(self.first_row, self.total_rows - self.rows))
+        self._missing = False
+        self._stored = self.art_cache.stored
+
+        # The row cut off at the bottom is drawn too
+        first = self.first_row * columns
+        for number, album in enumerate(self.albums[first:first + (self.rows + 1) * columns]):
+            row, column = divmod(number, columns)
+            x = column * CELL_WIDTH + CELL_WIDTH // 2
+            y = row * CELL_HEIGHT + 10
+            tags = ("cell", f"album{first + number}")
+            photo = self._thumbnail(album)
+            if photo is not None:
+                canvas.create_image(x, y + THUMB_HEIGHT // 2, image=photo, tags=tags)
+            else:
+                canvas.create_rectangle(x - THUMB_WIDTH // 2, y, x + THUMB_WIDTH // 2, y + THUMB_HEIGHT, outline="grey",
+                                        fill="#202020", tags=tags)
+            label = f"{album.artist} - {album.title}" if album.artist else album.title
+            canvas.create_text(x, y + THUMB_HEIGHT + 4, text=label, width=CELL_WIDTH - 10, anchor="n", fill="white",
+                               font=("Helvetica", 9), tags=tags)
+        self.update_scrollbar()
+
+        if self._missing and self._refresh_job is None:
+            self._refresh_job = canvas.after(REFRESH_MS, self._refresh)
+
+    def _thumbnail(self, album):
+        if not album.art_hash:
+            return None
+        photo = self._photos.get(album.art_hash)
+        if photo is not None:
+            self._photos.move_to_end(album.art_hash)
+            return photo
+
+        from tkinter import PhotoImage, TclError
+        try:
+            # Tk reads PNG by itself, so the grid doesn't need PIL
+            photo = PhotoImage(file=self.art_cache.path(album.art_hash, THUMB))
+        except TclError:
+            # Not cached yet; scanned before covers were cached, or the cache is still catching up
+            self._missing = True
+            self.art_cache.add_file(album.paths[0], album.art_hash, block=False)
+            return None
+        self._photos[album.art_hash] = photo
+        while len(self._photos) > self.capacity:
+            self._photos.popitem(last=False)
+        return photo
+
+    def _refresh(self):
+        # Draws the covers that have been cached since; stops once none are missing
+        self._refresh_job = None
+        if not self.canvas.winfo_ismapped():
+            return
+        if self.art_cache.stored != self._stored:
+            self.render()
+        elif self._missing and self.art_cache.pending:
+            self._refresh_job = self.canvas.after(REFRESH_MS, self._refresh)
+
+    def update_scrollbar(self):
+        if self.scrollbar is None:
+            return
+        total = self.total_rows
+        if total <= self.rows:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(self.first_row / total, (self.first_row + self.rows) / total)
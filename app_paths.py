@@ -0,0 +1,10 @@
+import os
+
+# Everything the player persists between runs lives under one folder in the user's home
+DATA_DIR = os.environ.get("MUSIC_PLAYER_HOME", os.path.join(os.path.expanduser("~"), ".music_player"))
+
+
+def data_path(*parts):
+    path = os.path.join(DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
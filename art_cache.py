@@ -0,0 +1,125 @@
+import os
+import queue
+import threading
+
+from album_art import extract_album_art, prepare_album_art
+from playlist_files import source_path
+
+# Album art kept on disk already scaled, named after the hash of the embedded image, so every
+# track of an album shares one set of files and showing a cover never has to read an audio file:
+#   <directory>/ab/abcdef...-thumb.png
+THUMB = "thumb"
+NOW_PLAYING = "now_playing"
+BACKGROUND = "background"
+# Variant -> (bounding size, blurred)
+ART_VARIANTS = {
+    THUMB: ((120, 120), False),
+    NOW_PLAYING: ((750, 550), False),
+    BACKGROUND: ((750, 550), True),
+}
+
+# Covers waiting to be scaled; whatever doesn't fit is left for later rather than piled up in memory
+QUEUE_SIZE = 64
+# Threads scaling covers; PIL lets go of the GIL while it decodes, resizes and encodes
+WORKERS = min(4, os.cpu_count() or 1)
+
+
+def variant_for(size, blur):
+    # The cached variant an AlbumArtLoader of this size can show, if any
+    return next((name for name, variant in ART_VARIANTS.items() if variant == (tuple(size), blur)), None)
+
+
+class ArtCache:
+    # Scales covers into every variant on a few worker threads. add() and add_file() can be
+    # called from any thread; a cover already on disk or already queued is skipped.
+    def __init__(self, directory):
+        self.directory = directory
+        # Covers written so far, for views waiting on missing ones
+        self.stored = 0
+
+        self._jobs = queue.Queue(QUEUE_SIZE)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._disabled = False
+
+    def path(self, art_hash, variant=THUMB):
+        return os.path.join(self.directory, art_hash[:2], f"{art_hash}-{variant}.png")
+
+    def has(self, art_hash, variant=THUMB):
+        # The thumbnail is written last, so it stands for the whole set
+        return os.path.exists(self.path(art_hash, variant))
+
+    @property
+    def pending(self):
+        return len(self._queued)
+
+    def add(self, art_hash, image_data, block=True):
+        # Embedded art that was read anyway, e.g. by a scan parsing the tags
+        return self._queue(art_hash, image_data, None, block)
+
+    def add_file(self, file_path, art_hash, block=True):
+        # The art of a track whose cover isn't stored yet; the worker reads it from the file.
+        # block=False gives up instead of waiting when the queue is full (for the Tk thread and
+        # scans); either returns False only if the cover was left out for want of room.
+        return self._queue(art_hash, None, file_path, block)
+
+    def _queue(self, art_hash, image_data, file_path, block):
+        if self._disabled or not art_hash or self.has(art_hash):
+            return True
+        with self._lock:
+            if art_hash in self._queued:
+                return True
+            self._queued.add(art_hash)
+            if not self._workers:
+                self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(WORKERS)]
+                for worker in self._workers:
+                    worker.start()
+        try:
+            self._jobs.put((art_hash, image_data, file_path), block)
+        except queue.Full:
+            with self._lock:
+                self._queued.discard(art_hash)
+            return False
+        return True
+
+    def store(self, art_hash, image_data):
+        # Every variant, each through a temporary file so a reader never sees half a PNG. The
+        # image is decoded once, at the biggest size, and the smaller variants scaled from that.
+        from PIL import ImageFilter
+
+        os.makedirs(os.path.dirname(self.path(art_hash)), exist_ok=True)
+        largest = max((size for size, _ in ART_VARIANTS.values()), key=lambda size: size[0] * size[1])
+        decoded = prepare_album_art(image_data, largest)
+        for variant in sorted(ART_VARIANTS, key=lambda name: name == THUMB):
+            size, blur = ART_VARIANTS[variant]
+            image = decoded.copy()
+            image.thumbnail(size)
+            if blur:
+                image = image.filter(ImageFilter.BLUR)
+            path = self.path(art_hash, variant)
+            temporary = f"{path}.{threading.get_ident()}.tmp"
+            # Light compression halves the time to write a cover, for somewhat bigger files
+            image.save(temporary, "PNG", compress_level=1)
+            os.replace(temporary, path)
+        with self._lock:
+            self.stored += 1
+
+    def _work(self):
+        while True:
+            art_hash, image_data, file_path = self._jobs.get()
+            try:
+                if not self._disabled and not self.has(art_hash):
+                    if image_data is None:
+                        # A CUE track's art is that of the file it is part of
+                        image_data = extract_album_art(source_path(file_path))
+                    if image_data:
+                        self.store(art_hash, image_data)
+            except ImportError as e:
+                print(f"Error caching album art: {e}")
+                self._disabled = True
+            except Exception as e:
+                print(f"Error caching album art: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(art_hash)
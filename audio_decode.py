@@ -0,0 +1,285 @@
+import os
+import mmap
+import shutil
+import struct
+import subprocess
+import importlib.util
+
+from duration_probe import probe_duration
+from seek_index import seek_position
+
+# Frames per block handed out by PcmStream.blocks(), about 1.5 s at 44.1 kHz
+BLOCK_FRAMES = 65536
+
+# WAV format tags
+WAVE_PCM = 1
+WAVE_FLOAT = 3
+WAVE_EXTENSIBLE = 0xFFFE
+
+
+class PcmStream:
+    # Decoded audio as a sequence of float32 blocks shaped (frames, channels) in [-1, 1].
+    # Only one block is alive at a time, so memory use doesn't depend on the track length.
+    def __init__(self, sample_rate, channels, frames, read_block):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        # Total frame count, or None when it can't be known without decoding everything
+        self.frames = frames
+        self._read_block = read_block
+        self._close = None
+
+    def blocks(self, block_frames=BLOCK_FRAMES):
+        while True:
+            block = self._read_block(block_frames)
+            if block is None or not len(block):
+                return
+            yield block
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Decoders by file extension: opener(path, start, sample_rate, channels, seek_index) -> PcmStream,
+# and a check for whether what the opener needs is installed. seek_index is the file's
+# seek_index.SeekIndex when it has one, for openers that can start at a byte offset. Registering a new one is all it takes
+# for the player, the file dialogs and the scanner to pick up another format.
+DECODERS = {}
+
+
+def register_decoder(extensions, opener, available=None):
+    for extension in extensions:
+        DECODERS[extension.lower()] = (opener, available)
+
+
+def decoder_for(path):
+    return usable_decoder(os.path.splitext(path)[1].lower())
+
+
+def usable_decoder(extension):
+    decoder = DECODERS.get(extension)
+    if decoder is None:
+        return None
+    opener, available = decoder
+    if available is not None and not available():
+        return None
+    return opener
+
+
+def supported_extensions():
+    return tuple(extension for extension in DECODERS if usable_decoder(extension))
+
+
+def numpy_available():
+    return importlib.util.find_spec("numpy") is not None
+
+
+_ffmpeg = []
+
+
+def ffmpeg_path():
+    if not _ffmpeg:
+        _ffmpeg.append(shutil.which("ffmpeg"))
+    return _ffmpeg[0]
+
+
+def open_pcm(path, start=0.0, sample_rate=None, channels=None, seek_index=None):
+    # A PcmStream for the file starting `start` seconds in, converted to the given rate and channel
+    # count if those are set, or None when it can't be decoded here
+    opener = decoder_for(path)
+    if opener is None:
+        print(f"Error decoding audio: no decoder for {os.path.basename(path)}")
+        return None
+    try:
+        stream = opener(path, start, sample_rate, channels, seek_index)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Error decoding audio: {e}")
+        return None
+    if stream is not None and ((sample_rate and stream.sample_rate != sample_rate) or
+                               (channels and stream.channels != channels)):
+        stream = convert(stream, sample_rate or stream.sample_rate, channels or stream.channels)
+    return stream
+
+
+def read_wav_header(f, file_size):
+    # (format, channels, sample rate, bytes per frame, bits per sample, data offset, data size)
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] not in (b"RIFF", b"RF64") or riff[8:12] != b"WAVE":
+        raise ValueError("not a WAV file")
+
+    fmt = None
+    position = 12
+    while position + 8 <= file_size:
+        f.seek(position)
+        chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+        if chunk_id == b"fmt ":
+            data = f.read(min(chunk_size, 40))
+            tag, channels, rate, _, align, bits = struct.unpack_from("<HHIIHH", data)
+            if tag == WAVE_EXTENSIBLE and len(data) >= 26:
+                tag = struct.unpack_from("<H", data, 24)[0]
+            fmt = (tag, channels, rate, align, bits)
+        elif chunk_id == b"data":
+            if fmt is None:
+                break
+            available = file_size - position - 8
+            if chunk_size == 0xFFFFFFFF or chunk_size > available:
+                chunk_size = available
+            return fmt + (position + 8, chunk_size)
+        position += 8 + chunk_size + (chunk_size & 1)
+    raise ValueError("WAV file without audio data")
+
+
+def open_wav(path, start=0.0, sample_rate=None, channels=None, seek_index=None):
+    # Samples are read straight out of a memory map of the file, one block at a time
+    import numpy as np
+
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        tag, channel_count, rate, align, bits, offset, size = read_wav_header(f, file_size)
+        width = align // channel_count if channel_count else 0
+        if tag not in (WAVE_PCM, WAVE_FLOAT) or not 1 <= width <= 8 or (tag == WAVE_FLOAT and width not in (4, 8)):
+            raise ValueError(f"unsupported WAV format {tag} with {bits} bit samples")
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    frames = size // align
+    state = {"frame": min(frames, int(start * rate))}
+
+    def read_block(block_frames):
+        first = state["frame"]
+        count = min(block_frames, frames - first)
+        if count <= 0:
+            return None
+        state["frame"] = first + count
+        data = mapped[offset + first * align:offset + (first + count) * align]
+        if tag == WAVE_FLOAT:
+            samples = np.frombuffer(data, "<f4" if width == 4 else "<f8").astype(np.float32)
+        else:
+            samples = pcm_to_float(np, data, width)
+        return samples.reshape(-1, channel_count)
+
+    stream = PcmStream(rate, channel_count, frames - state["frame"], read_block)
+    stream._close = mapped.close
+    return stream
+
+
+def pcm_to_float(np, data, width):
+    if width == 1:
+        # 8 bit WAV samples are unsigned
+        return (np.frombuffer(data, np.uint8).astype(np.float32) - 128) / 128
+    if width == 2:
+        return np.frombuffer(data, "<i2").astype(np.float32) / 32768
+    if width == 3:
+        raw = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples -= (samples & 0x800000) << 1
+        return samples.astype(np.float32) / 8388608
+    if width == 4:
+        return np.frombuffer(data, "<i4").astype(np.float32) / 2147483648
+    # Wider integer samples: keep the top 32 bits
+    raw = np.frombuffer(data, np.uint8).reshape(-1, width)[:, width - 4:]
+    return np.ascontiguousarray(raw).view("<i4").ravel().astype(np.float32) / 2147483648
+
+
+def open_ffmpeg(path, start=0.0, sample_rate=None, channels=None, seek_index=None):
+    # Everything ffmpeg can read, decoded in a child process and read from a pipe
+    import numpy as np
+
+    sample_rate = sample_rate or 44100
+    channels = channels or 2
+    command = [ffmpeg_path(), "-nostdin", "-v", "error"]
+    # Sound before `start` that ffmpeg decodes anyway, dropped here
+    state = {"skip": 0}
+    if start > 0 and seek_index is not None:
+        # Straight to the frame that holds `start`; with -ss, ffmpeg guesses the byte position
+        # of a VBR file from its bitrate or TOC
+        offset, frame_start = seek_position(seek_index, path, start)
+        command += ["-skip_initial_bytes", str(offset)]
+        state["skip"] = round((start - frame_start) * sample_rate)
+    elif start > 0:
+        command += ["-ss", f"{start:.3f}"]
+    command += ["-i", path, "-f", "f32le", "-ac", str(channels), "-ar", str(sample_rate), "-"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    frame_bytes = 4 * channels
+
+    def read_block(block_frames):
+        while True:
+            data = process.stdout.read(block_frames * frame_bytes)
+            usable = len(data) - len(data) % frame_bytes
+            if not usable:
+                return None
+            block = np.frombuffer(data[:usable], "<f4").reshape(-1, channels)
+            if state["skip"]:
+                dropped = min(state["skip"], len(block))
+                state["skip"] -= dropped
+                block = block[dropped:]
+            if len(block):
+                return block
+
+    def close():
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+    duration = probe_duration(path)
+    frames = max(0, int((duration - start) * sample_rate)) if duration else None
+    stream = PcmStream(sample_rate, channels, frames, read_block)
+    stream._close = close
+    return stream
+
+
+def convert(stream, sample_rate, channels):
+    # Remaps channels and resamples (linear interpolation, carried across block boundaries)
+    import numpy as np
+
+    step = stream.sample_rate / sample_rate
+    state = {"source": None, "carry": None, "position": 0.0}
+
+    def remap(block):
+        if block.shape[1] == channels:
+            return block
+        if channels == 1:
+            return block.mean(axis=1, keepdims=True)
+        if block.shape[1] == 1:
+            return np.repeat(block, channels, axis=1)
+        return block[:, :channels]
+
+    def read_block(block_frames):
+        if state["source"] is None:
+            state["source"] = stream.blocks(max(1, int(block_frames * step)))
+        while True:
+            block = next(state["source"], None)
+            if block is None:
+                return None
+            block = remap(block)
+            if step == 1:
+                return block
+            carry = state["carry"]
+            data = block if carry is None else np.concatenate((carry, block))
+            last = len(data) - 1
+            position = state["position"]
+            count = int(np.ceil((last - position) / step)) if last > position else 0
+            state["carry"] = data[-1:]
+            state["position"] = position + step * count - last
+            if not count:
+                continue
+            positions = position + step * np.arange(count)
+            index = positions.astype(np.int64)
+            fraction = (positions - index).astype(np.float32)[:, None]
+            return data[index] * (1 - fraction) + data[index + 1] * fraction
+
+    frames = int(stream.frames / step) if stream.frames else None
+    converted = PcmStream(sample_rate, channels, frames, read_block)
+    converted._close = stream.close
+    return converted
+
+
+register_decoder([".wav"], open_wav, numpy_available)
+register_decoder([".mp3", ".flac", ".ogg", ".oga", ".opus", ".m4a", ".aac"], open_ffmpeg,
+                 lambda: numpy_available() and ffmpeg_path() is not None)
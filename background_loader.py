@@ -0,0 +1,55 @@
+import queue
+import threading
+
+
+class BackgroundLoader:
+    # A worker thread that takes jobs off a queue, and a poll on the Tk thread (through
+    # master.after) that hands what they produced back, running only while jobs are pending.
+    # Subclasses do a job in _run(job), putting anything for the Tk thread on self._results,
+    # and take each result in _handle(result) on the Tk thread.
+    POLL_MS = 20
+    ERROR = "Error loading in the background"
+
+    def __init__(self, master):
+        self.master = master
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._polling = False
+
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def _submit(self, job, poll=True):
+        # poll=False for jobs that never produce a result, so there is nothing to wait for
+        with self._lock:
+            self._pending += 1
+        self._jobs.put(job)
+        if poll and not self._polling:
+            self._polling = True
+            self.master.after(self.POLL_MS, self._deliver)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                print(f"{self.ERROR}: {e}")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+    def _deliver(self):
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._handle(result)
+
+        if self._pending or not self._results.empty():
+            self.master.after(self.POLL_MS, self._deliver)
+        else:
+            self._polling = False
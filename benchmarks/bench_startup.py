@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import plus construction of the headless core must stay under this, on top of bare interpreter start
+STARTUP_TARGET_MS = 100
+
+HEAVY_MODULES = ("pygame", "PIL", "eyed3", "numpy")
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{setup}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+CASES = {
+    "player_core": "import player_core\nplayer_core.PlayerCore()",
+    "Music_Player": "import Music_Player",
+    "Music_Player_Thumbnail": "import Music_Player_Thumbnail",
+    "new_main": "import new_main",
+}
+
+
+def measure(setup, env):
+    code = PROBE.format(setup=setup, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold start time of the player modules")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, MUSIC_PLAYER_HOME=home, PYTHONDONTWRITEBYTECODE="1")
+        for name, setup in CASES.items():
+            runs = [measure(setup, env) for _ in range(args.runs)]
+            errors = [run["error"] for run in runs if "error" in run]
+            if errors:
+                results[name] = {"error": errors[0]}
+                continue
+            times = sorted(run["ms"] for run in runs)
+            results[name] = {"median_ms": times[len(times) // 2], "min_ms": times[0], "heavy_imports": runs[0]["heavy"]}
+
+    core = results["player_core"]
+    passed = "median_ms" in core and core["median_ms"] <= STARTUP_TARGET_MS and not core["heavy_imports"]
+    report = {"benchmark": "startup", "target_ms": STARTUP_TARGET_MS, "passed": passed, "results": results}
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import time
+import platform
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+
+
+class Skip(Exception):
+    # Raised by a benchmark whose dependencies (pygame, a display, ...) aren't available
+    pass
+
+
+def require(module_name):
+    try:
+        __import__(module_name)
+    except ImportError:
+        raise Skip(f"{module_name} is not installed")
+
+
+def measure(function, runs=20, warmup=1):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return summarize(times)
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        "runs": len(times),
+        "median_ms": times[len(times) // 2],
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))],
+        "min_ms": times[0],
+        "mean_ms": sum(times) / len(times),
+    }
+
+
+def report(name, results):
+    return {
+        "benchmark": name,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+def write_report(data, output=None):
+    text = json.dumps(data, indent=2, sort_keys=True)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+
+def compare(current, baseline, threshold=0.10):
+    # Results whose median got more than threshold slower than in the baseline report
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before or "median_ms" not in result or "median_ms" not in before or not before["median_ms"]:
+            continue
+        ratio = result["median_ms"] / before["median_ms"]
+        if ratio > 1 + threshold:
+            regressions.append({"name": name, "before_ms": before["median_ms"], "after_ms": result["median_ms"],
+                                "ratio": ratio})
+    return regressions
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import zlib
+import wave
+import random
+import struct
+import argparse
+
+# Builds a synthetic library of MP3 and WAV files locally, so benchmarks don't depend on anyone's
+# music collection. The MP3s are valid MPEG-1 Layer III streams of silent frames; only the
+# headers, tags and artwork vary, which is all the player's hot paths look at.
+
+SAMPLE_RATE = 44100
+SAMPLES_PER_FRAME = 1152
+BITRATES = (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+
+DEFAULT_SPEC = {
+    "durations": [15, 90, 300],
+    "bitrates": [128, 320],
+    "art_sizes": [0, 300, 1200],
+    "wav_durations": [15, 90],
+}
+LONG_SPEC = dict(DEFAULT_SPEC, durations=[15, 90, 300, 3600], wav_durations=[15, 90, 600])
+
+
+def frame_header(bitrate, padding):
+    index = BITRATES.index(bitrate) + 1
+    # MPEG-1 Layer III, no CRC, 44.1 kHz, joint stereo, original
+    return bytes((0xFF, 0xFB, (index << 4) | (padding << 1), 0x44))
+
+
+def frame_length(bitrate, padding):
+    return 144 * bitrate * 1000 // SAMPLE_RATE + padding
+
+
+def mp3_frames(duration, bitrate=None, rng=None):
+    # bitrate None gives a VBR stream. Yields (header bytes, frame length) for every frame.
+    count = int(duration * SAMPLE_RATE / SAMPLES_PER_FRAME)
+    remainder = 0
+    for _ in range(count):
+        rate = bitrate if bitrate is not None else rng.choice(BITRATES[4:])
+        # Pad frames the way encoders do so the average frame size matches the bitrate exactly
+        remainder += 144 * rate * 1000 % SAMPLE_RATE
+        padding = 0
+        if remainder >= SAMPLE_RATE:
+            remainder -= SAMPLE_RATE
+            padding = 1
+        yield frame_header(rate, padding), frame_length(rate, padding)
+
+
+def xing_frame(tag, frames, stream_bytes, toc):
+    header = frame_header(128, 0)
+    body = bytearray(frame_length(128, 0) - 4)
+    # Xing header sits after the 32 byte side info of an MPEG-1 stereo frame
+    body[32:36] = tag
+    body[36:40] = struct.pack(">I", 0x0F)
+    body[40:48] = struct.pack(">II", frames, stream_bytes)
+    body[48:148] = toc
+    body[148:152] = struct.pack(">I", 100)
+    return header + bytes(body)
+
+
+def write_mp3(path, duration, bitrate=None, art=None, title=None, artist=None, album=None, xing=True, seed=0):
+    rng = random.Random(seed)
+    frames = list(mp3_frames(duration, bitrate, rng))
+
+    offsets = []
+    position = 0
+    for header, length in frames:
+        offsets.append(position)
+        position += length
+
+    tag = id3v2(title, artist, album, art)
+    with open(path, "wb") as f:
+        f.write(tag)
+        if xing:
+            first = frame_length(128, 0)
+            stream_bytes = position + first
+            toc = bytes(min(255, int(256 * (first + offsets[min(len(offsets) - 1, int(i / 100 * len(offsets)))]) / stream_bytes))
+                        for i in range(100))
+            f.write(xing_frame(b"Info" if bitrate else b"Xing", len(frames), stream_bytes, toc))
+        for header, length in frames:
+            f.write(header)
+            f.write(bytes(length - 4))
+
+
+def write_wav(path, duration, channels=2, sample_width=2):
+    with wave.open(path, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(sample_width)
+        w.setframerate(SAMPLE_RATE)
+        second = bytes(SAMPLE_RATE * channels * sample_width)
+        for _ in range(int(duration)):
+            w.writeframes(second)
+
+
+def id3v2(title, artist, album, art):
+    frames = b""
+    for frame_id, text in (("TIT2", title), ("TPE1", artist), ("TALB", album)):
+        if text:
+            frames += id3_frame(frame_id, b"\x00" + text.encode("latin-1"))
+    if art:
+        frames += id3_frame("APIC", b"\x00image/png\x00\x03\x00" + art)
+    size = len(frames)
+    syncsafe = bytes(((size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F))
+    return b"ID3\x03\x00\x00" + syncsafe + frames
+
+
+def id3_frame(frame_id, data):
+    return frame_id.encode("ascii") + struct.pack(">I", len(data)) + b"\x00\x00" + data
+
+
+def png(size, seed=0):
+    # A noisy RGB image, so it compresses about as badly as a real photo
+    rng = random.Random(seed)
+    rows = b"".join(b"\x00" + rng.randbytes(size * 3) for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b"")
+
+
+def build(directory, spec=None):
+    # Writes the corpus (if it isn't there already) and returns its manifest
+    spec = spec or DEFAULT_SPEC
+    manifest_path = os.path.join(directory, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["spec"] == spec:
+            return manifest
+
+    os.makedirs(directory, exist_ok=True)
+    arts = {size: png(size, seed=size) for size in spec["art_sizes"] if size}
+    tracks = []
+    number = 0
+    for duration in spec["durations"]:
+        for bitrate in spec["bitrates"] + [None]:
+            for art_size in spec["art_sizes"]:
+                number += 1
+                kind = f"cbr{bitrate}" if bitrate else "vbr"
+                name = f"{number:03d}_{kind}_{duration}s_art{art_size}.mp3"
+                path = os.path.join(directory, name)
+                write_mp3(path, duration, bitrate, arts.get(art_size), title=f"Track {number}",
+                          artist=f"Artist {number % 7}", album=f"Album {art_size}", seed=number)
+                tracks.append({"path": path, "format": "mp3", "duration": duration, "bitrate": bitrate,
+                               "vbr": bitrate is None, "art_size": art_size})
+    for duration in spec["wav_durations"]:
+        number += 1
+        path = os.path.join(directory, f"{number:03d}_pcm_{duration}s.wav")
+        write_wav(path, duration)
+        tracks.append({"path": path, "format": "wav", "duration": duration, "bitrate": 1411, "vbr": False, "art_size": 0})
+
+    manifest = {"spec": spec, "tracks": tracks}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the synthetic benchmark corpus")
+    parser.add_argument("directory")
+    parser.add_argument("--long", action="store_true", help="include hour-long files")
+    args = parser.parse_args(argv)
+    manifest = build(args.directory, LONG_SPEC if args.long else DEFAULT_SPEC)
+    print(f"{len(manifest['tracks'])} files in {args.directory}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import tempfile
+import threading
+
+# SDL has to be told before pygame loads that there may be no sound card
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+from common import Skip, require, summarize, report, write_report
+import corpus
+
+from remote_api import read_websocket_frame, accept_key, OP_TEXT, OP_CLOSE
+
+# Load test of the remote control: a crowd of WebSocket subscribers listens for events while HTTP
+# clients hammer the read endpoints and one controller skips tracks. Reports request latencies,
+# how long a track change takes to reach every subscriber, and how long the thread that owns the
+# player (the Tk thread in a window) spends running remote commands per pass.
+#
+# Runs against its own headless player unless --port points it at one that is already running.
+
+HOST = "127.0.0.1"
+# The player's token, if it has one (the same variable a player listening beyond localhost reads)
+AUTHORIZATION = (f"Authorization: Bearer {os.environ['MUSIC_PLAYER_REMOTE_TOKEN']}\r\n"
+                 if os.environ.get("MUSIC_PLAYER_REMOTE_TOKEN") else "")
+
+
+async def http_request(reader, writer, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {HOST}\r\n{AUTHORIZATION}Content-Length: {len(data)}\r\n\r\n".encode() + data)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def open_websocket(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((f"GET /events HTTP/1.1\r\nHost: {host}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                  f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n{AUTHORIZATION}\r\n").encode())
+    await writer.drain()
+    status = await reader.readline()
+    accepted = None
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "sec-websocket-accept":
+            accepted = value.strip()
+    if b" 101 " not in status or accepted != accept_key(key):
+        raise ConnectionError(f"WebSocket handshake failed: {status!r}")
+    return reader, writer
+
+
+async def subscribe(host, port, arrivals, connected):
+    # Collects when each track change arrives
+    reader, writer = await open_websocket(host, port)
+    connected.release()
+    try:
+        while True:
+            _, opcode, payload = await read_websocket_frame(reader)
+            if opcode == OP_CLOSE:
+                break
+            if opcode == OP_TEXT and json.loads(payload).get("event") == "track":
+                arrivals.append(time.perf_counter())
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def client(host, port, requests, latencies):
+    # One keep-alive connection going through the read endpoints, with the odd seek
+    reader, writer = await asyncio.open_connection(host, port)
+    calls = [
+        ("state", "GET", "/state", None),
+        ("search", "GET", "/search?q=track&limit=20", None),
+        ("queue", "GET", "/queue?offset=0&limit=50", None),
+        ("seek", "POST", "/seek", {"position": 1.0}),
+    ]
+    try:
+        for number in range(requests):
+            name, method, path, body = calls[number % len(calls)]
+            start = time.perf_counter()
+            status, _ = await http_request(reader, writer, method, path, body)
+            latencies.setdefault(name if status == 200 else f"{name}_failed", []).append(
+                (time.perf_counter() - start) * 1000)
+    finally:
+        writer.close()
+
+
+async def control(host, port, commands, interval, sent, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(commands):
+            await asyncio.sleep(interval)
+            start = time.perf_counter()
+            sent.append(start)
+            await http_request(reader, writer, "POST", "/next")
+            latencies.setdefault("next", []).append((time.perf_counter() - start) * 1000)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, args):
+    subscribers = [[] for _ in range(args.subscribers)]
+    connected = asyncio.Semaphore(0)
+    listeners = [asyncio.ensure_future(subscribe(host, port, arrivals, connected)) for arrivals in subscribers]
+    for _ in subscribers:
+        await connected.acquire()
+
+    latencies = {}
+    sent = []
+    started = time.perf_counter()
+    await asyncio.gather(control(host, port, args.commands, args.interval, sent, latencies),
+                         *[client(host, port, args.requests, latencies) for _ in range(args.clients)])
+    elapsed = time.perf_counter() - started
+    # Give the last track change time to reach everyone
+    await asyncio.sleep(1.0)
+    for listener in listeners:
+        listener.cancel()
+    await asyncio.gather(*listeners, return_exceptions=True)
+
+    results = {f"http/{name}": summarize(times) for name, times in latencies.items()}
+    requests = sum(len(times) for times in latencies.values())
+    results["http_requests_per_second"] = requests / elapsed
+
+    # The nth track event a subscriber sees is the nth skip; the start of each skip is when it was sent
+    deliveries = [(arrival - sent[number]) * 1000 for arrivals in subscribers for number, arrival in enumerate(arrivals[:len(sent)])]
+    slowest = [max((arrivals[number] - sent[number]) * 1000 for arrivals in subscribers if len(arrivals) > number)
+               for number in range(len(sent)) if any(len(arrivals) > number for arrivals in subscribers)]
+    if deliveries:
+        results["fanout/each"] = summarize(deliveries)
+        results["fanout/all_subscribers"] = summarize(slowest)
+    results["subscribers"] = len(subscribers)
+    results["subscribers_missing_events"] = sum(1 for arrivals in subscribers if len(arrivals) < len(sent))
+    return results
+
+
+def serve(args, directory):
+    # A headless player on a free port, driven from this thread the way a window drives it
+    require("pygame")
+    from metadata_cache import MetadataCache
+    from player_core import PlayerCore
+
+    paths = []
+    for number in range(args.commands + 2):
+        path = os.path.join(directory, f"track{number:03d}.wav")
+        corpus.write_wav(path, 60)
+        paths.append(path)
+    core = PlayerCore(metadata=MetadataCache())
+    core.add_tracks(paths)
+    remote = core.start_remote(0)
+    if remote is None:
+        raise Skip("the remote control didn't start")
+    core.play_next()
+    return core, remote
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the HTTP and WebSocket remote control")
+    parser.add_argument("--port", type=int, help="test the player already listening on this port")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--subscribers", type=int, default=300, help="WebSocket connections listening for events")
+    parser.add_argument("--clients", type=int, default=200, help="concurrent HTTP connections")
+    parser.add_argument("--requests", type=int, default=50, help="requests per HTTP connection")
+    parser.add_argument("--commands", type=int, default=10, help="track skips sent while under load")
+    parser.add_argument("--interval", type=float, default=0.3, help="seconds between skips")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        # Both ends of every connection live in this process
+        wanted = 2 * (args.subscribers + args.clients) + 256
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    if args.port is not None:
+        results = asyncio.run(run_load(args.host, args.port, args))
+        write_report(report("remote_load", results), args.output)
+        return 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            core, remote = serve(args, directory)
+        except Skip as e:
+            print(f"Skipped: {e}")
+            return 0
+
+        outcome = {}
+        load = threading.Thread(target=lambda: outcome.update(asyncio.run(run_load(HOST, remote.port, args))))
+        load.start()
+        busy = []
+        while load.is_alive():
+            start = time.perf_counter()
+            remote.process()
+            busy.append((time.perf_counter() - start) * 1000)
+            if core.playing:
+                core.poll()
+            # The windows run the commands every 50 ms
+            time.sleep(0.05)
+        load.join()
+        core.stop()
+
+    outcome["owner_thread_busy"] = summarize(busy)
+    write_report(report("remote_load", outcome), args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,487 @@
+import os
+import sys
+import json
+import time
+import bisect
+import random
+import shutil
+import tempfile
+import argparse
+
+# SDL has to be told before pygame loads that there may be no sound card
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+# The player's data folder is fixed once app_paths is imported, so it has to point at a
+# scratch folder before any of the player's modules are loaded
+SCRATCH_HOME = None
+if "MUSIC_PLAYER_HOME" not in os.environ:
+    SCRATCH_HOME = os.environ["MUSIC_PLAYER_HOME"] = tempfile.mkdtemp(prefix="music_player_bench_")
+
+from common import Skip, require, measure, summarize, report, write_report, compare
+import corpus
+
+from duration_probe import probe_duration, find_first_frame, read_vbr_header
+from fingerprint import fingerprint_track, duplicate_groups
+from metadata_cache import MetadataCache, TrackInfo
+from play_history import PlayHistory, PLAYED, SKIPPED, COMPLETED, COMPACT_EVENTS
+from playback_clock import refresh_interval
+from player_core import PlayerCore
+from playlist import Playlist
+from seek_index import build_seek_index, seek_position
+from session_store import SessionStore
+
+
+def tk_root():
+    try:
+        from tkinter import Tk
+        root = Tk()
+    except Exception as e:
+        raise Skip(f"no Tk display: {e}")
+    root.withdraw()
+    return root
+
+
+def bench_duration_probe(manifest, args):
+    results = {}
+    for track in manifest["tracks"]:
+        kind = "vbr" if track["vbr"] else track["format"]
+        key = f"duration_probe/{kind}/{track['duration']}s"
+        if key not in results:
+            results[key] = measure(lambda: probe_duration(track["path"]), runs=args.runs)
+    return results
+
+
+def bench_metadata(manifest, args):
+    require("eyed3")
+    results = {}
+    for track in manifest["tracks"]:
+        key = f"metadata_parse/{track['format']}/art{track['art_size']}"
+        if key not in results:
+            results[key] = measure(lambda: MetadataCache().get(track["path"]), runs=args.runs)
+
+    cache = MetadataCache()
+    path = manifest["tracks"][0]["path"]
+    cache.get(path)
+    results["metadata_cached_get"] = measure(lambda: cache.get(path), runs=args.runs * 10)
+    return results
+
+
+def bench_load_and_play(manifest, args):
+    require("pygame")
+    core = PlayerCore(metadata=MetadataCache())
+    results = {}
+    for track in manifest["tracks"]:
+        kind = "vbr" if track["vbr"] else track["format"]
+        key = f"load_and_play/{kind}/{track['duration']}s"
+        if key not in results:
+            # Fresh cache every run, like a track that was never played before
+            def play():
+                core.metadata = core.engine.metadata = MetadataCache()
+                core.load_and_play(track["path"])
+            results[key] = measure(play, runs=args.runs)
+    core.stop()
+    return results
+
+
+def bench_album_art(manifest, args):
+    require("eyed3")
+    require("PIL")
+    from album_art import extract_album_art, prepare_album_art, load_cached_art
+    from art_cache import ArtCache, NOW_PLAYING, THUMB
+
+    results = {}
+    cache = ArtCache(tempfile.mkdtemp())
+    root = None
+    try:
+        root = tk_root()
+    except Skip:
+        pass
+
+    for track in manifest["tracks"]:
+        size = track["art_size"]
+        key = f"album_art/{size}px"
+        if not size or key in results:
+            continue
+        results[key + "/extract"] = measure(lambda: extract_album_art(track["path"]), runs=args.runs)
+        data = extract_album_art(track["path"])
+        results[key + "/prepare"] = measure(lambda: prepare_album_art(data, (750, 550)), runs=args.runs)
+        results[key + "/prepare_blur"] = measure(lambda: prepare_album_art(data, (750, 550), blur=True), runs=args.runs)
+        if root is not None:
+            from PIL import ImageTk
+            image = prepare_album_art(data, (750, 550))
+            results[key + "/display"] = measure(lambda: ImageTk.PhotoImage(image), runs=args.runs)
+
+        # The same cover through the art cache: written once by a scan, then only PNGs are read
+        art_hash = f"{size:040x}"
+        results[key + "/cache_store"] = measure(lambda: cache.store(art_hash, data), runs=max(1, args.runs // 5))
+        results[key + "/from_cache"] = measure(lambda: load_cached_art(cache.path(art_hash, NOW_PLAYING)), runs=args.runs)
+        if root is not None:
+            from tkinter import PhotoImage
+            results[key + "/grid_thumbnail"] = measure(lambda: PhotoImage(file=cache.path(art_hash, THUMB)), runs=args.runs)
+    if root is not None:
+        root.destroy()
+    shutil.rmtree(cache.directory, ignore_errors=True)
+    return results
+
+
+def bench_progress_tick(manifest, args):
+    # The work one progress tick does besides drawing: position, remaining time and the next interval
+    core = PlayerCore(metadata=MetadataCache())
+    core.current_track = manifest["tracks"][0]["path"]
+    core.track_info = TrackInfo(core.current_track, 0, 0, 240.0, 128, None, None, None, None, None, None)
+    core.engine.clock.start()
+
+    def tick():
+        for _ in range(1000):
+            refresh_interval(core.duration, 600, True, core.remaining(), labels=True)
+            divmod(int(core.position()), 60)
+    result = measure(tick, runs=args.runs)
+    return {"progress_tick/x1000": result}
+
+
+def synthetic_library(size):
+    return [f"/library/Artist {i % 500}/Album {i % 3000}/{i:07d} Track.mp3" for i in range(size)]
+
+
+def bench_library_update(manifest, args):
+    results = {}
+    for size in args.sizes:
+        paths = synthetic_library(size)
+        metadata = MetadataCache()
+        for path in paths:
+            metadata.put(TrackInfo(path, 0, 0, 200.0, 192, None, None, None, None, None, None))
+
+        def bulk():
+            core = PlayerCore(metadata=metadata)
+            for start in range(0, size, 250):
+                core.add_tracks(paths[start:start + 250])
+        results[f"library_bulk_add/{size}"] = measure(bulk, runs=max(1, args.runs // 10), warmup=0)
+
+        core = PlayerCore(metadata=metadata)
+        core.add_tracks(paths)
+        extra = paths[0] + ".extra.mp3"
+        metadata.put(TrackInfo(extra, 0, 0, 200.0, 192, None, None, None, None, None, None))
+
+        def add_one():
+            core.add_tracks([extra])
+            core.playlist.remove_at(len(core.playlist) - 1)
+        results[f"library_add_one/{size}"] = measure(add_one, runs=args.runs)
+
+        try:
+            root = tk_root()
+        except Skip:
+            continue
+        from tkinter import Listbox
+        from library_view import VirtualListView
+        view = VirtualListView(Listbox(root), core.playlist)
+
+        def scroll():
+            view.scroll_to((view.first + 997) % size)
+            view.render()
+        results[f"library_view_scroll/{size}"] = measure(scroll, runs=args.runs)
+        root.destroy()
+    return results
+
+
+def bench_play_next(manifest, args):
+    results = {}
+    for size in args.sizes:
+        playlist = Playlist(synthetic_library(size))
+        playlist.select(size // 2)
+        results[f"play_next/{size}"] = measure(lambda: playlist.advance(), runs=args.runs * 10)
+        playlist.set_shuffle(True)
+        playlist.advance()
+        results[f"play_next_shuffle/{size}"] = measure(lambda: playlist.advance(), runs=args.runs * 10)
+    return results
+
+
+def bench_session(manifest, args):
+    # Saving the session on exit and getting the library back at the next start
+    results = {}
+    for size in args.sizes:
+        paths = synthetic_library(size)
+        metadata = MetadataCache()
+        for path in paths:
+            metadata.put(TrackInfo(path, 0, 0, 200.0, 192, "Title", "Artist", "Album", None, None, None))
+        core = PlayerCore(metadata=metadata)
+        core.add_tracks(paths)
+
+        with tempfile.TemporaryDirectory() as directory:
+            core.session = SessionStore(directory)
+            results[f"session_save/{size}"] = measure(core.save_session, runs=max(1, args.runs // 10))
+            core.session.close()
+
+            def restore():
+                restored = PlayerCore(metadata=MetadataCache())
+                restored.restore_session(SessionStore(directory))
+                restored.session.snapshot.close()
+                restored.session.close()
+            results[f"session_restore/{size}"] = measure(restore, runs=max(1, args.runs // 10))
+    return results
+
+
+def bench_fingerprint(manifest, args):
+    # Fingerprinting one track, and the duplicate search over a library of random fingerprints
+    # (a worst case: nothing shares a bucket by accident in real music more than in noise)
+    require("numpy")
+    import numpy as np
+
+    results = {}
+    for track in manifest["tracks"]:
+        key = f"fingerprint/{track['format']}/{track['duration']}s"
+        if key not in results and fingerprint_track(track["path"])[2] is not None:
+            results[key] = measure(lambda: fingerprint_track(track["path"]), runs=max(1, args.runs // 5))
+
+    generator = np.random.default_rng(0)
+    for size in args.sizes:
+        fingerprints = [generator.integers(0, 2 ** 32, 319, dtype=np.uint32).tobytes() for _ in range(size)]
+        paths = list(range(size))
+        results[f"duplicate_search/{size}"] = measure(lambda: duplicate_groups(paths, fingerprints, [None] * size), runs=1, warmup=0)
+    return results
+
+
+def bench_dsp(manifest, args):
+    # CPU time per second of audio (in ms) for the equalizer, the crossfade and everything the
+    # decoder thread does to a block on its way into the ring
+    require("numpy")
+    import time
+    import numpy as np
+    from dsp import Equalizer, Crossfade, EQ_PRESETS
+    from streaming_engine import RingBuffer, RingWriter, BLOCK_SECONDS, MIXER_RATE, MIXER_CHANNELS
+
+    seconds = 30
+    block_frames = int(BLOCK_SECONDS * MIXER_RATE)
+    generator = np.random.default_rng(0)
+    blocks = [generator.uniform(-0.5, 0.5, (block_frames, MIXER_CHANNELS)).astype(np.float32)
+              for _ in range(int(seconds / BLOCK_SECONDS))]
+
+    def equalize():
+        equalizer = Equalizer(MIXER_RATE, MIXER_CHANNELS, block_frames, EQ_PRESETS["vocal"])
+        for block in blocks:
+            equalizer.process(block)
+
+    def crossfade():
+        fade = Crossfade(seconds, MIXER_RATE, MIXER_CHANNELS, block_frames)
+        fade.start()
+        for block in blocks:
+            fade.mix(block, block)
+
+    def chain():
+        ring = RingBuffer(len(blocks) + 1, block_frames * MIXER_CHANNELS * 2)
+        writer = RingWriter(ring, MIXER_CHANNELS)
+        equalizer = Equalizer(MIXER_RATE, MIXER_CHANNELS, block_frames, EQ_PRESETS["vocal"])
+        fade = Crossfade(seconds, MIXER_RATE, MIXER_CHANNELS, block_frames)
+        fade.start()
+        for block in blocks:
+            writer.write(equalizer.process(fade.mix(block, block)))
+        writer.write(equalizer.flush())
+        writer.finish()
+
+    results = {}
+    for name, function in (("equalizer", equalize), ("crossfade", crossfade), ("chain", chain)):
+        function()
+        times = []
+        for _ in range(max(1, args.runs // 5)):
+            start = time.process_time()
+            function()
+            times.append((time.process_time() - start) * 1000 / seconds)
+        results[f"dsp_cpu_per_audio_second/{name}"] = summarize(times)
+    return results
+
+
+def bench_smart_playlist(manifest, args):
+    # Smart playlist queries over the library's tags held as columns
+    require("numpy")
+    from library_columns import compile_query
+
+    queries = {
+        "filter": "genre = jazz and year < 1990",
+        "filter_sort": "genre != rock and bitrate >= 192 sorted by artist, year desc limit 500",
+        "substring": "artist ~ 'artist 1'",
+        "sort_all": "sorted by title",
+    }
+    genres = ["Rock", "Jazz", "Pop", "Blues", "Classical", "Electronic"]
+    results = {}
+    for size in args.sizes:
+        paths = synthetic_library(size)
+        metadata = MetadataCache()
+        for number, path in enumerate(paths):
+            metadata.put(TrackInfo(path, 0, 0, 120.0 + number % 400, (128, 192, 256, 320)[number % 4],
+                                   f"Track {number}", f"Artist {number % 500}", f"Album {number % 3000}",
+                                   genres[number % len(genres)], 1950 + number % 70, None))
+        core = PlayerCore(metadata=metadata)
+        core.add_tracks(paths)
+
+        def build():
+            core.columns.build()
+        results[f"smart_playlist_build/{size}"] = measure(build, runs=max(1, args.runs // 10), warmup=0)
+        for name, text in queries.items():
+            query = compile_query(text)
+            results[f"smart_playlist_{name}/{size}"] = measure(lambda: core.columns.select(query), runs=args.runs)
+    return results
+
+
+def bench_play_history(manifest, args):
+    # Years of plays folded into the counters, plus a log of recent ones still to be folded:
+    # opening the history, its views, recording a play, and writing and folding a full log
+    results = {}
+    for size in args.sizes:
+        paths = synthetic_library(min(size, 20000))
+        now = time.time()
+        # The plays spread over five years, the last ones this month
+        step = 5 * 365 * 86400 / size
+        with tempfile.TemporaryDirectory() as directory:
+            history = PlayHistory(directory)
+            for number in range(size):
+                path = paths[(number * 7919) % len(paths)]
+                history.record(PLAYED, path, timestamp=now - (size - number) * step)
+                history.record(SKIPPED if number % 3 else COMPLETED, path, 60.0, timestamp=now - (size - number) * step)
+            history.close()
+            history = PlayHistory(directory)
+            for number in range(COMPACT_EVENTS // 2):
+                history.record(PLAYED, paths[number % len(paths)], timestamp=now - number)
+            history.close()
+
+            def open_history():
+                PlayHistory(directory).close()
+            results[f"history_open/{size}"] = measure(open_history, runs=args.runs)
+            history = PlayHistory(directory)
+            results[f"history_most_played_month/{size}"] = measure(history.most_played, runs=args.runs)
+            results[f"history_recently_played/{size}"] = measure(history.recently_played, runs=args.runs)
+            results[f"history_all_plays/{size}"] = measure(history.plays, runs=max(1, args.runs // 10))
+            results[f"history_record/{size}"] = measure(lambda: history.record(PLAYED, paths[0]), runs=args.runs * 10)
+            history.close()
+
+            times = []
+            for _ in range(max(1, args.runs // 10)):
+                history = PlayHistory(directory)
+                for number in range(COMPACT_EVENTS):
+                    history.record(PLAYED, paths[number % len(paths)])
+                start = time.perf_counter()
+                history.close()
+                times.append((time.perf_counter() - start) * 1000)
+            results[f"history_write_and_compact/{size}"] = summarize(times)
+    return results
+
+
+def bench_seek(manifest, args):
+    # Where a seek starts decoding, by the seek index and by what decoders do without one: the
+    # Xing TOC, or the first frame's bitrate. The error is how far the frame decoding starts at
+    # is from the one that should be heard (from the generator's own frame layout), in ms.
+    duration = 3600 if args.long else 300
+    kinds = {"cbr128": (128, True), "vbr_xing": (None, True), "vbr_plain": (None, False)}
+    rng = random.Random(0)
+    targets = [rng.uniform(0, duration - 1) for _ in range(200)]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for kind, (bitrate, xing) in kinds.items():
+            path = os.path.join(directory, f"{kind}.mp3")
+            corpus.write_mp3(path, duration, bitrate, title=kind, xing=xing, seed=1)
+            offsets = []
+            position = len(corpus.id3v2(kind, None, None, None)) + (corpus.frame_length(128, 0) if xing else 0)
+            for _, length in corpus.mp3_frames(duration, bitrate, random.Random(1)):
+                offsets.append(position)
+                position += length
+
+            def heard(byte):
+                # Decoders start at the first frame header at or after the byte they are given
+                frame = min(bisect.bisect_left(offsets, byte), len(offsets) - 1)
+                return frame * corpus.SAMPLES_PER_FRAME / corpus.SAMPLE_RATE
+
+            results[f"seek_index_build/{kind}"] = measure(lambda: build_seek_index(path), runs=max(1, args.runs // 4))
+            index = build_seek_index(path)
+            results[f"seek_locate/{kind}"] = measure(lambda: seek_position(index, path, rng.uniform(0, duration)),
+                                                     runs=args.runs * 10)
+
+            with open(path, "rb") as f:
+                start = len(corpus.id3v2(kind, None, None, None))
+                first, header = find_first_frame(f, start, position)
+                vbr = read_vbr_header(f, first, header)
+            estimates = {"index": lambda target: seek_position(index, path, target)[0],
+                         "bitrate": lambda target: offsets[0] + target * header.bitrate * 125}
+            if vbr is not None and vbr[2]:
+                _, stream_bytes, toc = vbr
+
+                def from_toc(target):
+                    percent = 100 * target / duration
+                    low = min(99, int(percent))
+                    high = toc[low + 1] if low < 99 else 256
+                    return first + (toc[low] + (high - toc[low]) * (percent - low)) / 256 * stream_bytes
+                estimates["toc"] = from_toc
+            for method, estimate in estimates.items():
+                results[f"seek_error/{kind}/{method}"] = summarize(
+                    [abs(heard(estimate(target)) - target) * 1000 for target in targets])
+
+            # Seeking while playing, through pygame's music stream, with and without an index
+            try:
+                require("pygame")
+                from playback import PlaybackEngine
+                metadata = MetadataCache()
+                metadata.seek_index(path)
+                for method, engine in (("indexed", PlaybackEngine(metadata)), ("plain", PlaybackEngine())):
+                    engine.play(path)
+                    results[f"seek_engine/{kind}/{method}"] = measure(lambda: engine.set_pos(rng.uniform(0, duration)),
+                                                                      runs=args.runs)
+                    engine.stop()
+            except Skip:
+                pass
+            except Exception as e:
+                results[f"seek_engine/{kind}"] = {"skipped": str(e)}
+    return results
+
+
+BENCHMARKS = {
+    "duration_probe": bench_duration_probe,
+    "metadata": bench_metadata,
+    "load_and_play": bench_load_and_play,
+    "album_art": bench_album_art,
+    "progress_tick": bench_progress_tick,
+    "library_update": bench_library_update,
+    "play_next": bench_play_next,
+    "session": bench_session,
+    "fingerprint": bench_fingerprint,
+    "dsp": bench_dsp,
+    "smart_playlist": bench_smart_playlist,
+    "play_history": bench_play_history,
+    "seek": bench_seek,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the player's hot paths on a synthetic corpus")
+    parser.add_argument("--corpus", help="corpus directory (generated if missing, default: a temporary one)")
+    parser.add_argument("--long", action="store_true", help="include hour-long files in the corpus")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="earlier JSON report to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown before flagging")
+    args = parser.parse_args(argv)
+
+    try:
+        with tempfile.TemporaryDirectory() as scratch:
+            manifest = corpus.build(args.corpus or os.path.join(scratch, "corpus"),
+                                    corpus.LONG_SPEC if args.long else corpus.DEFAULT_SPEC)
+
+            results = {}
+            for name in args.only or BENCHMARKS:
+                try:
+                    results.update(BENCHMARKS[name](manifest, args))
+                except Skip as e:
+                    results[name] = {"skipped": str(e)}
+    finally:
+        if SCRATCH_HOME is not None:
+            shutil.rmtree(SCRATCH_HOME, ignore_errors=True)
+
+    data = report("hot_paths", results)
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            data["regressions"] = compare(data, json.load(f), args.threshold)
+        status = 1 if data["regressions"] else 0
+    write_report(data, args.output)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
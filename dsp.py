@@ -0,0 +1,165 @@
+import math
+
+# Centre frequencies of the equalizer's bands, in Hz
+EQ_BANDS = (32, 64, 125, 250, 500, 1000, 2000, 4000, 8000, 16000)
+MAX_GAIN_DB = 12.0
+EQ_PRESETS = {
+    "flat": (0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+    "bass": (6, 5, 4, 2, 0, 0, 0, 0, 0, 0),
+    "treble": (0, 0, 0, 0, 0, 0, 2, 4, 5, 6),
+    "vocal": (-2, -2, -1, 0, 2, 4, 4, 2, 0, -1),
+    "loudness": (5, 4, 2, 0, -1, 0, 0, 1, 3, 4),
+}
+
+# The equalizer is a linear-phase filter, which delays the sound by half its length. It is made
+# only as long as this allows; the delay is then taken back out, so what comes out lines up
+# with what went in and the added latency is this much decoding ahead, never more.
+LATENCY_SECONDS = 0.02
+
+CROSSFADE_CHOICES = (0.0, 2.0, 5.0, 8.0, 12.0)
+
+
+def flat(gains):
+    return not any(gains)
+
+
+def clamp_gains(gains):
+    gains = [max(-MAX_GAIN_DB, min(MAX_GAIN_DB, float(gain))) for gain in gains]
+    if len(gains) != len(EQ_BANDS):
+        raise ValueError(f"expected {len(EQ_BANDS)} band gains, got {len(gains)}")
+    return tuple(gains)
+
+
+def filter_response(gains, sample_rate, taps, size):
+    # Frequency response of a taps long linear-phase FIR following the band gains (interpolated
+    # on a log frequency scale), windowed and padded to size for overlap-save. The whole curve is
+    # lowered by the biggest boost so boosted bands can't clip.
+    import numpy as np
+
+    frequencies = np.fft.rfftfreq(size, 1 / sample_rate)
+    curve = np.interp(np.log2(np.maximum(frequencies, 1.0)), np.log2(EQ_BANDS), gains)
+    magnitude = 10 ** ((curve - max(0.0, max(gains))) / 20)
+    impulse = np.roll(np.fft.irfft(magnitude, size), taps // 2)[:taps] * np.hanning(taps + 2)[1:-1]
+    padded = np.zeros(size)
+    padded[:taps] = impulse
+    return np.fft.rfft(padded).astype(np.complex64)
+
+
+class Equalizer:
+    # Ten band graphic equalizer applied by overlap-save: each chunk of up to `hop` frames is
+    # filtered with one FFT per channel. Every buffer is allocated here, processing a block only
+    # writes into them. process() returns a view that is valid until the next call.
+    def __init__(self, sample_rate, channels, block_frames, gains=EQ_PRESETS["flat"]):
+        import numpy as np
+
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.delay = max(1, int(LATENCY_SECONDS * sample_rate))
+        self.taps = 2 * self.delay + 1
+        self.size = 1 << (4 * self.taps - 1).bit_length()
+        self.hop = self.size - self.taps + 1
+        self.gains = None
+        self.set_gains(gains)
+
+        self._frame = np.zeros((channels, self.size), np.float32)
+        self._history = np.zeros((channels, self.taps - 1), np.float32)
+        self._spectrum = np.zeros((channels, self.size // 2 + 1), np.complex64)
+        self._filtered = np.zeros((channels, self.size), np.float32)
+        self._out = np.zeros((block_frames + self.delay, channels), np.float32)
+        self._silence = np.zeros((self.delay, channels), np.float32)
+        # Output frames still to drop: the first `delay` are the filter's own lag
+        self._skip = self.delay
+
+    def set_gains(self, gains):
+        gains = clamp_gains(gains)
+        if gains != self.gains:
+            self.gains = gains
+            self._response = filter_response(gains, self.sample_rate, self.taps, self.size)
+
+    @property
+    def pending(self):
+        # Frames taken in but not given out yet
+        return self.delay - self._skip
+
+    def process(self, block):
+        # block is (frames, channels) with at most block_frames frames
+        count = 0
+        position = 0
+        while position < len(block):
+            frames = min(self.hop, len(block) - position)
+            filtered = self._filter(block[position:position + frames])
+            skip = min(self._skip, frames)
+            self._skip -= skip
+            self._out[count:count + frames - skip] = filtered[:, skip:].T
+            count += frames - skip
+            position += frames
+        return self._out[:count]
+
+    def flush(self):
+        # What is still inside the filter at the end of the stream
+        return self.process(self._silence)
+
+    def _filter(self, chunk):
+        import numpy as np
+
+        overlap = self.taps - 1
+        frames = len(chunk)
+        frame = self._frame
+        frame[:, :overlap] = self._history
+        frame[:, overlap:overlap + frames] = chunk.T
+        frame[:, overlap + frames:] = 0
+        self._history[:] = frame[:, frames:frames + overlap]
+        try:
+            np.fft.rfft(frame, axis=1, out=self._spectrum)
+            self._spectrum *= self._response
+            np.fft.irfft(self._spectrum, self.size, axis=1, out=self._filtered)
+        except TypeError:
+            # NumPy before 2.0 can't write FFTs into existing arrays
+            self._spectrum[:] = np.fft.rfft(frame, axis=1)
+            self._spectrum *= self._response
+            self._filtered[:] = np.fft.irfft(self._spectrum, self.size, axis=1)
+        return self._filtered[:, overlap:overlap + frames]
+
+
+class Crossfade:
+    # Mixes the end of one track into the start of the next with equal-power curves, so the
+    # loudness doesn't dip halfway through. The curves and the mix buffer are made once.
+    def __init__(self, seconds, sample_rate, channels, block_frames):
+        import numpy as np
+
+        self.frames = max(1, int(seconds * sample_rate))
+        angle = (np.arange(self.frames) + 0.5) / self.frames * (math.pi / 2)
+        self.fade_in = np.sin(angle).astype(np.float32)[:, None]
+        self.fade_out = np.cos(angle).astype(np.float32)[:, None]
+        self.position = self.frames
+        self._mix = np.zeros((block_frames, channels), np.float32)
+        self._scratch = np.zeros((block_frames, channels), np.float32)
+
+    @property
+    def active(self):
+        return self.position < self.frames
+
+    @property
+    def remaining(self):
+        return self.frames - self.position
+
+    def start(self):
+        self.position = 0
+
+    def mix(self, outgoing, incoming):
+        # Blends equally long stretches of both tracks; outgoing may run out early
+        import numpy as np
+
+        frames = len(incoming)
+        fading = min(frames, self.remaining)
+        ending = min(fading, len(outgoing))
+        first = self.position
+        mix = self._mix[:frames]
+        np.multiply(incoming[:fading], self.fade_in[first:first + fading], out=mix[:fading])
+        if ending:
+            scratch = self._scratch[:ending]
+            np.multiply(outgoing[:ending], self.fade_out[first:first + ending], out=scratch)
+            mix[:ending] += scratch
+        mix[fading:] = incoming[fading:]
+        self.position += fading
+        return mix
@@ -0,0 +1,271 @@
+import os
+import struct
+
+# Works out a track's length from its container headers, without decoding any audio
+
+# Bitrates in kbit/s by [MPEG-1?][layer][index]
+BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# How many frames have to agree on their bitrate before a file without a VBR header is taken as CBR
+CBR_PROBE_FRAMES = 32
+SCAN_BLOCK_SIZE = 256 * 1024
+
+
+class FrameHeader:
+    __slots__ = ("version", "layer", "bitrate", "sample_rate", "padding", "mono", "length", "samples")
+
+    def __init__(self, version, layer, bitrate, sample_rate, padding, mono):
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.mono = mono
+
+        mpeg1 = version == 3
+        if layer == 1:
+            self.samples = 384
+            self.length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+        else:
+            self.samples = 1152 if mpeg1 or layer == 2 else 576
+            self.length = (self.samples // 8) * bitrate * 1000 // sample_rate + padding
+
+
+def parse_frame_header(data, offset=0):
+    if len(data) < offset + 4:
+        return None
+    b1, b2, b3, b4 = data[offset], data[offset + 1], data[offset + 2], data[offset + 3]
+    if b1 != 0xFF or (b2 & 0xE0) != 0xE0:
+        return None
+
+    version = (b2 >> 3) & 0x03
+    layer = 4 - ((b2 >> 1) & 0x03)
+    bitrate_index = (b3 >> 4) & 0x0F
+    sample_rate_index = (b3 >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        # Reserved values, or free-format streams which can't be measured from headers
+        return None
+
+    bitrate = BITRATES[version == 3][layer][bitrate_index]
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    padding = (b3 >> 1) & 0x01
+    mono = (b4 >> 6) == 3
+    return FrameHeader(version, layer, bitrate, sample_rate, padding, mono)
+
+
+def id3v2_size(header):
+    # Size of an ID3v2 tag at the start of a file, including its header and footer
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def audio_end(f, file_size):
+    # Where the audio stops, ignoring an ID3v1 tag at the end of the file
+    if file_size >= 128:
+        f.seek(file_size - 128)
+        if f.read(3) == b"TAG":
+            return file_size - 128
+    return file_size
+
+
+def find_first_frame(f, start, end, limit=64 * 1024):
+    # The first offset at or after start where two consecutive valid frame headers line up
+    f.seek(start)
+    data = f.read(min(limit, end - start))
+    offset = data.find(b"\xff")
+    while 0 <= offset < len(data) - 4:
+        header = parse_frame_header(data, offset)
+        if header is not None and header.length > 0:
+            following = offset + header.length
+            if following + 4 > len(data) or parse_frame_header(data, following) is not None:
+                return start + offset, header
+        offset = data.find(b"\xff", offset + 1)
+    return None, None
+
+
+def side_info_size(header):
+    if header.version == 3:
+        return 17 if header.mono else 32
+    return 9 if header.mono else 17
+
+
+def read_vbr_header(f, offset, header):
+    # Frame count, byte count and TOC from a Xing/Info or VBRI header in the first frame
+    f.seek(offset)
+    frame = f.read(max(header.length, 4 + 32 + 26))
+
+    xing = 4 + side_info_size(header)
+    if frame[xing:xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack_from(">I", frame, xing + 4)[0]
+        position = xing + 8
+        frames = size = toc = None
+        if flags & 0x1:
+            frames = struct.unpack_from(">I", frame, position)[0]
+            position += 4
+        if flags & 0x2:
+            size = struct.unpack_from(">I", frame, position)[0]
+            position += 4
+        if flags & 0x4:
+            toc = bytes(frame[position:position + 100])
+        return frames, size, toc
+
+    vbri = 4 + 32
+    if frame[vbri:vbri + 4] == b"VBRI":
+        size, frames = struct.unpack_from(">II", frame, vbri + 10)
+        return frames, size, None
+
+    return None
+
+
+def probe_mp3(path):
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = id3v2_size(f.read(10))
+        end = audio_end(f, file_size)
+        offset, header = find_first_frame(f, start, end)
+        if header is None:
+            return None
+
+        vbr = read_vbr_header(f, offset, header)
+        if vbr is not None and vbr[0]:
+            return vbr[0] * header.samples / header.sample_rate
+
+        # No VBR header: if the first frames share a bitrate, treat the file as constant bitrate
+        frames, samples, bitrates, position = count_frames(f, offset, end, CBR_PROBE_FRAMES)
+        if len(bitrates) == 1 and frames == CBR_PROBE_FRAMES:
+            return (end - offset) * 8 / (header.bitrate * 1000)
+
+        frames, samples, bitrates, position = count_frames(f, offset, end)
+        return samples / header.sample_rate
+
+
+def count_frames(f, offset, end, limit=None):
+    # Walks frame headers from offset, reading the file in blocks so memory use stays constant
+    frames = samples = 0
+    bitrates = set()
+    block_start = offset
+    f.seek(block_start)
+    block = f.read(min(SCAN_BLOCK_SIZE, end - block_start))
+    while offset < end and (limit is None or frames < limit):
+        if offset + 4 > block_start + len(block):
+            if block_start + len(block) >= end:
+                break
+            block_start = offset
+            f.seek(block_start)
+            block = f.read(min(SCAN_BLOCK_SIZE, end - block_start))
+            if len(block) < 4:
+                break
+        header = parse_frame_header(block, offset - block_start)
+        if header is None or header.length <= 0:
+            # Lost sync, usually trailing junk or an APE tag
+            break
+        frames += 1
+        samples += header.samples
+        bitrates.add(header.bitrate)
+        offset += header.length
+    return frames, samples, bitrates, offset
+
+
+def probe_wav(path):
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] not in (b"RIFF", b"RF64") or riff[8:12] != b"WAVE":
+            return None
+
+        byte_rate = None
+        position = 12
+        while position + 8 <= file_size:
+            f.seek(position)
+            chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+            if chunk_id == b"fmt ":
+                fmt = f.read(16)
+                if len(fmt) < 16:
+                    return None
+                byte_rate = struct.unpack_from("<I", fmt, 8)[0]
+            elif chunk_id == b"data":
+                if not byte_rate:
+                    return None
+                available = file_size - position - 8
+                if chunk_size == 0xFFFFFFFF or chunk_size > available:
+                    # Streamed or truncated files don't have a trustworthy size
+                    chunk_size = available
+                return chunk_size / byte_rate
+            position += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def probe_flac(path):
+    with open(path, "rb") as f:
+        start = id3v2_size(f.read(10))
+        f.seek(start)
+        # "fLaC", then the STREAMINFO block, which always comes first
+        header = f.read(4 + 4 + 18)
+        if len(header) < 26 or header[:4] != b"fLaC" or header[4] & 0x7F != 0:
+            return None
+        packed = int.from_bytes(header[18:26], "big")
+        sample_rate = packed >> 44
+        total_samples = packed & ((1 << 36) - 1)
+        if not sample_rate or not total_samples:
+            return None
+        return total_samples / sample_rate
+
+
+def probe_ogg(path):
+    # The granule position of the last page is the sample count (at 48 kHz for Opus)
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        first = f.read(SCAN_BLOCK_SIZE // 4)
+        if first[:4] != b"OggS" or len(first) < 28:
+            return None
+        packet = first[27 + first[26]:]
+        if packet[:7] == b"\x01vorbis" and len(packet) >= 16:
+            sample_rate = struct.unpack_from("<I", packet, 12)[0]
+            skip = 0
+        elif packet[:8] == b"OpusHead" and len(packet) >= 12:
+            sample_rate = 48000
+            skip = struct.unpack_from("<H", packet, 10)[0]
+        else:
+            return None
+
+        f.seek(max(0, file_size - SCAN_BLOCK_SIZE))
+        tail = f.read()
+        position = tail.rfind(b"OggS")
+        while position != -1:
+            if position + 14 <= len(tail):
+                granule = struct.unpack_from("<q", tail, position + 6)[0]
+                if granule > 0:
+                    return max(0, granule - skip) / sample_rate
+            position = tail.rfind(b"OggS", 0, position)
+    return None
+
+
+PROBES = {".mp3": probe_mp3, ".wav": probe_wav, ".flac": probe_flac, ".ogg": probe_ogg, ".oga": probe_ogg,
+          ".opus": probe_ogg}
+
+
+def probe_duration(path):
+    # Track length in seconds, or None when the headers don't tell
+    probe = PROBES.get(os.path.splitext(path)[1].lower())
+    if probe is None:
+        return None
+    try:
+        return probe(path)
+    except (OSError, struct.error) as e:
+        print(f"Error probing duration: {e}")
+        return None
@@ -0,0 +1,454 @@
+import os
+import sys
+import math
+import sqlite3
+import argparse
+import threading
+
+from audio_decode import open_pcm, supported_extensions
+from instrumentation import timed
+from playlist_files import split_entry
+
+# Fingerprints are taken from this much audio, once any leading silence is skipped, mixed to
+# mono at the file's own rate (resampling without a proper low-pass would alias differently
+# depending on where a copy happens to start)
+WINDOW_SECONDS = 15.0
+SILENCE = 10 ** (-45 / 20)
+
+# One 32 bit sub-fingerprint per frame: the signs of how the energy differences between 33
+# neighbouring bands (300 Hz to 2 kHz, log spaced) change over STEP frames
+FRAME_SECONDS = 0.372
+HOP_SECONDS = FRAME_SECONDS / 8
+STEP = 4
+BANDS = 33
+LOW_HZ = 300.0
+HIGH_HZ = 2000.0
+
+# Bit-sampling LSH: each table keys frames by a different fixed subset of their bits, so frames
+# that differ in a few bits still collide in some tables. Buckets bigger than MAX_BUCKET are
+# things like silence that every track has, and are skipped.
+KEY_BITS = 26
+TABLES = 6
+MAX_BUCKET = 32
+# Frames of one track that have to collide with another at the same time offset before the two
+# are compared at all
+MIN_VOTES = 2
+MAX_OFFSET = 255
+# Frames whose buckets are sorted together, about 100 MB of working memory
+SLICE_FRAMES = 1 << 22
+
+# Two fingerprints aligned at their best offset differing in fewer than this share of bits are
+# the same recording; unrelated audio differs in about half
+DUPLICATE_BER = 0.3
+MIN_FRAMES = 64
+# ... unless their lengths say one is a different edit
+DURATION_SLACK = 0.05
+
+SCHEMA_VERSION = 1
+
+# How the library shows duplicates
+DUPLICATES_SHOW = "show"
+DUPLICATES_HIDE = "hide"
+DUPLICATES_GROUP = "group"
+DUPLICATE_MODES = (DUPLICATES_SHOW, DUPLICATES_HIDE, DUPLICATES_GROUP)
+
+LOSSLESS = (".flac", ".wav")
+
+
+def band_bins(sample_rate, frame):
+    import numpy as np
+
+    edges = np.geomspace(LOW_HZ, HIGH_HZ, BANDS + 1)
+    return np.round(edges * frame / sample_rate).astype(np.int64)
+
+
+@timed("fingerprint_compute")
+def fingerprint_track(path):
+    # (path, duration in seconds or None, sub-fingerprints as uint32 bytes) of one track, or
+    # (path, None, None) if it can't be decoded. Runs in the worker processes.
+    import numpy as np
+
+    source, start, end = split_entry(path)
+    stream = open_pcm(source, start, channels=1)
+    if stream is None:
+        return path, None, None
+    sample_rate = stream.sample_rate
+    window = int((WINDOW_SECONDS + FRAME_SECONDS) * sample_rate)
+    with stream:
+        duration = stream.frames / sample_rate if stream.frames else None
+        if end is not None:
+            duration = end - start
+        samples = np.empty(window, np.float32)
+        filled = 0
+        for block in stream.blocks(sample_rate):
+            block = block[:, 0]
+            if not filled:
+                # Skip leading silence, which differs between rips of the same song
+                loud = np.flatnonzero(np.abs(block) > SILENCE)
+                if not len(loud):
+                    continue
+                block = block[loud[0]:]
+            count = min(len(block), window - filled)
+            samples[filled:filled + count] = block[:count]
+            filled += count
+            if filled == window:
+                break
+    return path, duration, fingerprint_samples(samples[:filled], sample_rate).tobytes()
+
+
+def fast_length(length):
+    # The smallest length of at least `length` with no prime factors above 5, which FFTs handle quickly
+    best = 1 << math.ceil(math.log2(length))
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            size = power35 << max(0, math.ceil(math.log2(length / power35)))
+            best = min(best, size)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+def fingerprint_samples(samples, sample_rate):
+    import numpy as np
+
+    # Frames are the same length in seconds at any rate; the FFT is zero padded to a fast size
+    frame = int(FRAME_SECONDS * sample_rate)
+    hop = int(HOP_SECONDS * sample_rate)
+    size = fast_length(frame)
+    if len(samples) < frame + (STEP + 1) * hop:
+        return np.zeros(0, np.uint32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, frame)[::hop]
+    spectrum = np.fft.rfft(frames * np.hanning(frame).astype(np.float32), n=size, axis=1)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    bins = band_bins(sample_rate, size)
+    energy = np.add.reduceat(power[:, bins[0]:bins[-1]], bins[:-1] - bins[0], axis=1)
+    difference = energy[:, :-1] - energy[:, 1:]
+    bits = (difference[STEP:] - difference[:-STEP]) > 0
+    return (bits.astype(np.uint64) << np.arange(BANDS - 1, dtype=np.uint64)).sum(axis=1).astype(np.uint32)
+
+
+def bit_error_rate(first, second, offset):
+    # Share of differing bits with second shifted by offset frames against first
+    import numpy as np
+
+    if offset >= 0:
+        second = second[offset:]
+    else:
+        first = first[-offset:]
+    count = min(len(first), len(second))
+    if count < MIN_FRAMES:
+        return 1.0
+    different = np.bitwise_xor(first[:count], second[:count])
+    return int(np.unpackbits(different.view(np.uint8)).sum()) / (32 * count)
+
+
+def table_masks():
+    # The same bit samples every run, so keys mean the same thing across processes and runs
+    import numpy as np
+
+    generator = np.random.default_rng(1770)
+    masks = []
+    for _ in range(TABLES):
+        bits = generator.choice(32, KEY_BITS, replace=False)
+        masks.append(int(sum(1 << int(bit) for bit in bits)))
+    return masks
+
+
+def candidate_pairs(fingerprints):
+    # (first, second, offset) of fingerprints that collide on at least MIN_VOTES frames at the
+    # same offset. Everything is sorted arrays: n log n in the number of frames, not n^2 in tracks.
+    # Each table is boiled down to votes per pair and offset before the next one is built, and
+    # its buckets are sorted a slice of the key space at a time, so what is held besides the
+    # frames themselves is one slice's sorting and the collisions counted so far.
+    import numpy as np
+
+    lengths = np.array([len(words) for words in fingerprints], np.int64)
+    if not lengths.sum():
+        return []
+    words = np.concatenate(fingerprints)
+    # Where each fingerprint's frames start; frames are numbered through all of them
+    doc_starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    # A power of two, so a slice is the top bits of a multiplicative hash of the key
+    slice_bits = max(0, math.ceil(math.log2(len(words) / SLICE_FRAMES)))
+
+    masks = table_masks()
+    # Pair and offset codes with enough votes in one table, and the rest once per vote
+    strong, single = [], []
+    for table, mask in enumerate(masks):
+        key_slices = None
+        if slice_bits:
+            key_slices = ((words & np.uint32(mask)) * np.uint32(0x9E3779B1) >> np.uint32(32 - slice_bits)).astype(np.uint16)
+        codes = []
+        for number in range(1 << slice_bits):
+            frames = np.flatnonzero(key_slices == number) if slice_bits else np.arange(len(words))
+            codes += bucket_pairs(words, frames, masks[:table + 1], doc_starts)
+        del key_slices
+        if codes:
+            codes, table_votes = np.unique(np.concatenate(codes), return_counts=True)
+            strong.append(codes[table_votes >= MIN_VOTES])
+            weak = table_votes < MIN_VOTES
+            single.append(np.repeat(codes[weak], table_votes[weak]))
+            del codes, table_votes, weak
+
+    if not strong:
+        return []
+    # Votes from different tables add up: sorted, a code that is repeated as often as a code
+    # needs votes is there MIN_VOTES - 1 places further on as well
+    codes = np.empty(sum(len(votes) for votes in single), np.int64)
+    position = 0
+    while single:
+        votes = single.pop()
+        codes[position:position + len(votes)] = votes
+        position += len(votes)
+    del votes
+    codes.sort()
+    later = MIN_VOTES - 1
+    codes = np.unique(np.concatenate(strong + [codes[later:][codes[later:] == codes[:-later]]]))
+    pairs, offsets = np.divmod(codes, 2 * MAX_OFFSET + 1)
+    first, second = np.divmod(pairs, len(fingerprints))
+    return list(zip(first.tolist(), second.tolist(), (offsets - MAX_OFFSET).tolist()))
+
+
+def bucket_pairs(words, frames, masks, doc_starts):
+    # Pair and offset codes, one per vote, of the given frames colliding in the table of the
+    # last mask; a frame pair that collides in an earlier table too has voted there already
+    import numpy as np
+
+    if len(frames) < 2:
+        return []
+    count = len(doc_starts)
+    span = 2 * MAX_OFFSET + 1
+    # Key and frame number in one word, so a plain in-place sort groups the buckets
+    entries = (words[frames] & np.uint32(masks[-1])).astype(np.uint64)
+    entries <<= np.uint64(32)
+    entries |= frames.astype(np.uint64)
+    del frames
+    entries.sort()
+    keys = (entries >> np.uint64(32)).astype(np.uint32)
+
+    # Only buckets holding more than one frame matter, and oversized ones are left out
+    same = keys[1:] == keys[:-1]
+    shared = np.r_[same, False] | np.r_[False, same]
+    keys, entries = keys[shared], entries[shared]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(keys)])
+    keep = np.repeat(sizes <= MAX_BUCKET, sizes)
+    keys, key_frames = keys[keep], (entries[keep] & np.uint64(0xFFFFFFFF)).astype(np.int64)
+    del entries
+    key_docs = np.searchsorted(doc_starts, key_frames, side="right") - 1
+
+    codes = []
+    # Within a sorted run every pair is some distance apart, so walking the distances finds them all
+    for distance in range(1, MAX_BUCKET):
+        same = keys[:-distance] == keys[distance:]
+        if not same.any():
+            break
+        first_frame, second_frame = key_frames[:-distance][same], key_frames[distance:][same]
+        first, second = key_docs[:-distance][same], key_docs[distance:][same]
+        other = first != second
+        difference = words[first_frame] ^ words[second_frame]
+        for earlier in masks[:-1]:
+            other &= (difference & np.uint32(earlier)) != 0
+        first, second = first[other], second[other]
+        first_position = first_frame[other] - doc_starts[first]
+        second_position = second_frame[other] - doc_starts[second]
+        swap = first > second
+        first, second = np.where(swap, second, first), np.where(swap, first, second)
+        offset = np.where(swap, first_position - second_position, second_position - first_position)
+        near = np.abs(offset) <= MAX_OFFSET
+        codes.append((first[near] * count + second[near]) * span + offset[near] + MAX_OFFSET)
+    return codes
+
+
+def similar_durations(first, second):
+    if not first or not second:
+        return True
+    return abs(first - second) <= DURATION_SLACK * max(first, second) + 1.0
+
+
+def duplicate_groups(paths, fingerprints, durations):
+    # Groups (lists of indexes into paths) of tracks that are the same recording
+    import numpy as np
+
+    fingerprints = [np.frombuffer(words, np.uint32) if words else np.zeros(0, np.uint32) for words in fingerprints]
+    parent = list(range(len(paths)))
+
+    def root(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    checked = set()
+    for first, second, offset in candidate_pairs(fingerprints):
+        if (first, second) in checked or root(first) == root(second):
+            continue
+        if not similar_durations(durations[first], durations[second]):
+            continue
+        if bit_error_rate(fingerprints[first], fingerprints[second], offset) < DUPLICATE_BER:
+            checked.add((first, second))
+            parent[root(second)] = root(first)
+
+    groups = {}
+    for index in range(len(paths)):
+        groups.setdefault(root(index), []).append(index)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def keeper_rank(path, info):
+    # The copy to keep: lossless first, then the highest bitrate
+    extension = os.path.splitext(split_entry(path)[0])[1].lower()
+    return (extension in LOSSLESS, info.bitrate if info is not None and info.bitrate else 0)
+
+
+class FingerprintCache:
+    # Fingerprints keyed by path and validated against the file's size and mtime, like the
+    # metadata cache, so only new or changed files are decoded again
+    def __init__(self, db_path=None):
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path):
+        try:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._db.execute("DROP TABLE IF EXISTS fingerprints")
+                self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._db.execute("CREATE TABLE IF NOT EXISTS fingerprints "
+                             "(path TEXT PRIMARY KEY, size, mtime, duration, words BLOB)")
+            self._db.commit()
+        except sqlite3.Error as e:
+            print(f"Error opening fingerprint cache: {e}")
+            self._db = None
+
+    def get(self, path, st):
+        # (duration, words) if the cached fingerprint still matches the stat result
+        with self._lock:
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT size, mtime, duration, words FROM fingerprints WHERE path = ?",
+                                   (path,)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+            return None
+        return row[2], row[3]
+
+    def put(self, path, st, duration, words):
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)",
+                                 (path, st.st_size, st.st_mtime, duration, words))
+
+    def commit(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def find_duplicates(paths, cache, metadata=None, workers=None, on_track=None):
+    # Fingerprints every track that isn't cached yet across a pool of processes, then returns
+    # the groups of duplicates as lists of paths, the copy worth keeping first
+    paths = list(dict.fromkeys(paths))
+    known = {}
+    todo = []
+    stats = {}
+    for path in paths:
+        try:
+            st = stats[path] = os.stat(split_entry(path)[0])
+        except OSError:
+            continue
+        cached = cache.get(path, st)
+        if cached is None:
+            todo.append(path)
+        else:
+            known[path] = cached
+
+    if todo:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Spawned rather than forked: this usually runs next to Tk and pygame threads
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for path, duration, words in pool.map(fingerprint_track, todo, chunksize=8):
+                if words is not None:
+                    known[path] = (duration, words)
+                    cache.put(path, stats[path], duration, words)
+                if on_track is not None:
+                    on_track(path)
+        cache.commit()
+
+    paths = [path for path in paths if path in known]
+    groups = duplicate_groups(paths, [known[path][1] for path in paths], [known[path][0] for path in paths])
+    result = []
+    for group in groups:
+        members = [paths[index] for index in group]
+        if metadata is not None:
+            # Stable, so among equals the one earliest in the library is kept
+            members.sort(key=lambda path: keeper_rank(path, metadata.peek(path)), reverse=True)
+        result.append(members)
+    return result
+
+
+class Duplicates:
+    # The result of a duplicate search, applied to lists of tracks for display
+    def __init__(self, groups):
+        self.groups = groups
+        self.keeper = {duplicate: group[0] for group in groups for duplicate in group[1:]}
+        self.members = {group[0]: group[1:] for group in groups}
+
+    def __len__(self):
+        return len(self.keeper)
+
+    def is_duplicate(self, path):
+        return path in self.keeper
+
+    def arrange(self, tracks, mode):
+        # Hide the extra copies, or list them right after the copy that is kept
+        if mode == DUPLICATES_SHOW or not self.keeper:
+            return list(tracks)
+        if mode == DUPLICATES_HIDE:
+            return [track for track in tracks if track not in self.keeper]
+        shown = set(tracks)
+        arranged = []
+        for track in tracks:
+            keeper = self.keeper.get(track)
+            if keeper is not None and keeper in shown:
+                continue
+            arranged.append(track)
+            arranged.extend(member for member in self.members.get(track, ()) if member in shown)
+        return arranged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List tracks that are the same recording under different files")
+    parser.add_argument("paths", nargs="+", help="audio files or folders")
+    parser.add_argument("--workers", type=int, help="processes to use (default: one per core)")
+    args = parser.parse_args(argv)
+
+    from app_paths import data_path
+    from metadata_cache import MetadataCache
+    from player_core import collect_tracks
+
+    metadata = MetadataCache(data_path("metadata.db"))
+    cache = FingerprintCache(data_path("fingerprints.db"))
+    tracks = collect_tracks(args.paths, metadata, supported_extensions())
+    for group in find_duplicates(tracks, cache, metadata, args.workers):
+        print(group[0])
+        for duplicate in group[1:]:
+            print(f"  = {duplicate}")
+    cache.close()
+    metadata.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
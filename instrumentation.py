@@ -0,0 +1,228 @@
+import os
+import sys
+import atexit
+import json
+import time
+import bisect
+import threading
+import traceback
+import functools
+
+from app_paths import data_path
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+LAG_INTERVAL_MS = 100
+STALL_THRESHOLD_MS = 250
+FLUSH_INTERVAL_S = 10
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.maximum = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.total += ms
+        self.count += 1
+        if ms > self.maximum:
+            self.maximum = ms
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.maximum)
+        return self.maximum
+
+
+class Metrics:
+    # Latency histograms for the player's hot paths. Recording is always on and cheap; writing
+    # them out (file, Prometheus endpoint) and watching the Tk thread only happen after start().
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._records = []
+        self.path = None
+
+    def observe(self, name, ms):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(ms)
+
+    def timed(self, name):
+        # Decorator recording how long each call takes
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, (time.perf_counter() - start) * 1000)
+            return wrapper
+        return decorate
+
+    def record(self, kind, **fields):
+        # Queue an event (e.g. a stall) for the metrics file
+        with self._lock:
+            self._records.append(dict(fields, kind=kind, time=time.time()))
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {"count": h.count, "sum_ms": round(h.total, 3), "max_ms": round(h.maximum, 3),
+                           "p50_ms": h.quantile(0.5), "p99_ms": h.quantile(0.99),
+                           "buckets": dict(zip([str(b) for b in BUCKETS_MS] + ["+Inf"], h.counts))}
+                    for name, h in self.histograms.items()}
+
+    def flush(self):
+        # Append pending events and a histogram snapshot to the metrics file (JSON lines)
+        if self.path is None:
+            return
+        with self._lock:
+            records, self._records = self._records, []
+        records.append({"kind": "histograms", "time": time.time(), "histograms": self.snapshot()})
+        try:
+            with open(self.path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Error writing metrics: {e}")
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            items = sorted(self.histograms.items())
+            for name, histogram in items:
+                metric = "music_player_" + name.replace(".", "_").replace("/", "_") + "_ms"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS_MS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum {histogram.total}")
+                lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+timed = metrics.timed
+
+
+class TkWatchdog:
+    # Measures how late Tk runs after() callbacks (event loop lag) and, from a separate thread,
+    # dumps the Tk thread's stack whenever it hasn't come back to the event loop for too long
+    def __init__(self, master, metrics, interval_ms=LAG_INTERVAL_MS, stall_ms=STALL_THRESHOLD_MS):
+        self.master = master
+        self.metrics = metrics
+        self.interval_ms = interval_ms
+        self.stall_ms = stall_ms
+        self.ui_thread = threading.get_ident()
+        self._expected = None
+        self._heartbeat = time.monotonic()
+        self._stopped = threading.Event()
+        self._stall_reported = False
+
+    def start(self):
+        self._schedule()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _schedule(self):
+        self._expected = time.monotonic() + self.interval_ms / 1000
+        self.master.after(self.interval_ms, self._beat)
+
+    def _beat(self):
+        now = time.monotonic()
+        self.metrics.observe("tk_event_loop_lag", max(0.0, now - self._expected) * 1000)
+        self._heartbeat = now
+        self._stall_reported = False
+        if not self._stopped.is_set():
+            self._schedule()
+
+    def _watch(self):
+        while not self._stopped.wait(self.stall_ms / 2000):
+            blocked_ms = (time.monotonic() - self._heartbeat) * 1000 - self.interval_ms
+            if blocked_ms > self.stall_ms and not self._stall_reported:
+                self._stall_reported = True
+                self.report_stall(blocked_ms)
+
+    def report_stall(self, blocked_ms):
+        frame = sys._current_frames().get(self.ui_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        self.metrics.record("stall", blocked_ms=round(blocked_ms, 1), stack=stack)
+        print(f"UI thread blocked for {blocked_ms:.0f} ms:\n{stack}", file=sys.stderr)
+
+
+def write_periodically(metrics, interval=FLUSH_INTERVAL_S):
+    # File writes happen off the Tk thread, plus once more at exit
+    def loop():
+        while True:
+            time.sleep(interval)
+            metrics.flush()
+    threading.Thread(target=loop, daemon=True).start()
+    atexit.register(metrics.flush)
+
+
+def serve_prometheus(metrics, port):
+    # Plain-text /metrics on localhost only, from a daemon thread
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start(master=None):
+    # Turned on by the environment: MUSIC_PLAYER_METRICS=1 (or a file path) writes the metrics file,
+    # MUSIC_PLAYER_METRICS_PORT=<port> serves them for Prometheus
+    setting = os.environ.get("MUSIC_PLAYER_METRICS")
+    port = os.environ.get("MUSIC_PLAYER_METRICS_PORT")
+    if not setting and not port:
+        return None
+
+    if setting:
+        metrics.path = data_path("metrics.jsonl") if setting == "1" else setting
+        write_periodically(metrics)
+    if port:
+        try:
+            serve_prometheus(metrics, int(port))
+        except (OSError, ValueError) as e:
+            print(f"Error starting metrics endpoint: {e}")
+
+    watchdog = None
+    if master is not None:
+        watchdog = TkWatchdog(master, metrics)
+        watchdog.start()
+    return watchdog
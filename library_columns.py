@@ -0,0 +1,449 @@
+import re
+import bisect
+import functools
+from collections import namedtuple, Counter
+
+from instrumentation import timed
+from library_view import INSERT, REMOVE, MOVE, RESET
+from search_index import normalize
+
+# Smart playlists are queries over the library's tags, typed where a search would go:
+#   genre = jazz and year < 1970 sorted by album
+#   artist ~ miles or (plays >= 10 and not genre = rock) sorted by plays desc, title limit 50
+# Comparisons are =, !=, <, <=, >, >= and ~ (contains); text is compared without case or
+# accents, and a value of several words needs no quotes. Durations can be given as m:ss.
+STRING_FIELDS = ("title", "artist", "album", "genre")
+NUMBER_FIELDS = ("year", "duration", "bitrate", "plays")
+FIELD_ALIASES = {"length": "duration", "time": "duration", "played": "plays"}
+
+TOKEN = re.compile(r"""\s*(?:("[^"]*"|'[^']*')|(<=|>=|!=|=|<|>|~)|([(),])|([^\s()=!<>~,"']+))""")
+# Words that end a value written without quotes
+VALUE_END = {"and", "or", "sorted", "sort", "order", "limit"}
+QUERY_HINT = re.compile(r"[=<>~]|\b(?:sorted|sort|order)\s+by\b", re.I)
+
+Query = namedtuple("Query", "where order limit")
+
+
+def looks_like_query(text):
+    # Anything with a comparison or a sort is a smart playlist, anything else a plain search
+    return QUERY_HINT.search(text) is not None
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError(f"can't read the query from {text[position:]!r}")
+        string, operator, punctuation, word = match.groups()
+        if string is not None:
+            tokens.append(("string", string[1:-1]))
+        elif operator is not None:
+            tokens.append(("operator", operator))
+        elif punctuation is not None:
+            tokens.append(("punctuation", punctuation))
+        else:
+            tokens.append(("word", word))
+        position = match.end()
+    return tokens
+
+
+@functools.lru_cache(maxsize=64)
+def compile_query(text):
+    # A Query whose where(columns) gives a mask over the library's rows, and whose order is
+    # [(field, descending)]; raises ValueError saying what is wrong with the text
+    return QueryParser(tokenize(text)).parse()
+
+
+def field_name(word):
+    name = FIELD_ALIASES.get(word.lower(), word.lower())
+    if name not in STRING_FIELDS and name not in NUMBER_FIELDS:
+        raise ValueError(f"unknown field {word!r}, expected one of {', '.join(STRING_FIELDS + NUMBER_FIELDS)}")
+    return name
+
+
+def parse_number(text):
+    # 1969, 4.5 or a duration such as 3:30
+    try:
+        if ":" in text:
+            minutes, _, seconds = text.partition(":")
+            return int(minutes) * 60 + float(seconds)
+        return float(text)
+    except ValueError:
+        raise ValueError(f"{text!r} isn't a number")
+
+
+class QueryParser:
+    # or_query := and_query ("or" and_query)*
+    # and_query := term ("and" term)*
+    # term := "not" term | "(" or_query ")" | field operator value
+    # query := [or_query] ["sorted by" field [asc|desc] ("," ...)*] ["limit" n]
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ValueError("the query ends too early")
+        self.position += 1
+        return token
+
+    def keyword(self, *words):
+        kind, value = self.peek()
+        if kind == "word" and value.lower() in words:
+            self.position += 1
+            return value.lower()
+        return None
+
+    def punctuation(self, mark):
+        if self.peek() == ("punctuation", mark):
+            self.position += 1
+            return True
+        return False
+
+    def parse(self):
+        where = None
+        kind, value = self.peek()
+        if kind is not None and not (kind == "word" and value.lower() in ("sorted", "sort", "order", "limit")):
+            where = self.parse_or()
+
+        order = []
+        if self.keyword("sorted", "sort", "order"):
+            if not self.keyword("by"):
+                raise ValueError('expected "by" after "sorted"')
+            order.append(self.parse_key())
+            while self.punctuation(","):
+                order.append(self.parse_key())
+
+        limit = None
+        if self.keyword("limit"):
+            kind, value = self.take()
+            if kind != "word" or not value.isdigit():
+                raise ValueError(f"the limit has to be a whole number, not {value!r}")
+            limit = int(value)
+
+        kind, value = self.peek()
+        if kind is not None:
+            raise ValueError(f"unexpected {value!r} in the query")
+        return Query(where, tuple(order), limit)
+
+    def parse_key(self):
+        kind, value = self.take()
+        if kind != "word":
+            raise ValueError(f"expected a field to sort by, not {value!r}")
+        field = field_name(value)
+        return field, self.keyword("asc", "desc") == "desc"
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.keyword("or"):
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda columns: functools.reduce(lambda mask, term: mask | term(columns), terms[1:], terms[0](columns))
+
+    def parse_and(self):
+        terms = [self.parse_term()]
+        while self.keyword("and"):
+            terms.append(self.parse_term())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda columns: functools.reduce(lambda mask, term: mask & term(columns), terms[1:], terms[0](columns))
+
+    def parse_term(self):
+        if self.keyword("not"):
+            term = self.parse_term()
+            return lambda columns: ~term(columns)
+        if self.punctuation("("):
+            term = self.parse_or()
+            if not self.punctuation(")"):
+                raise ValueError('missing ")"')
+            return term
+
+        kind, value = self.take()
+        if kind != "word":
+            raise ValueError(f"expected a field, not {value!r}")
+        field = field_name(value)
+        kind, operator = self.take()
+        if kind != "operator":
+            raise ValueError(f"expected =, !=, <, <=, >, >= or ~ after {field}, not {operator!r}")
+        return comparison(field, operator, self.parse_value())
+
+    def parse_value(self):
+        kind, value = self.take()
+        if kind == "string":
+            return value
+        if kind != "word":
+            raise ValueError(f"expected a value, not {value!r}")
+        words = [value]
+        while True:
+            kind, value = self.peek()
+            if kind != "word" or value.lower() in VALUE_END:
+                return " ".join(words)
+            words.append(value)
+            self.position += 1
+
+
+def comparison(field, operator, value):
+    if field in NUMBER_FIELDS:
+        if operator == "~":
+            raise ValueError(f"{field} is a number, ~ only works on text")
+        number = parse_number(value)
+
+        def compare_number(columns):
+            import numpy as np
+
+            compare = {"=": np.equal, "!=": np.not_equal, "<": np.less, "<=": np.less_equal, ">": np.greater,
+                       ">=": np.greater_equal}[operator]
+            # Unknown values are NaN, which no comparison but != is true for
+            return compare(columns.number(field), number)
+        return compare_number
+
+    key = normalize(value)
+
+    def compare_string(columns):
+        # Decided once per distinct value, then looked up for every row by its code
+        column = columns.strings[field]
+        return column.matching(operator, key)[columns.codes(field)]
+    return compare_string
+
+
+class StringColumn:
+    # The distinct values of a text field; rows hold codes into it. Code 0 is the missing value.
+    def __init__(self):
+        self.values = [""]
+        self.keys = [""]
+        self._ids = {"": 0}
+        self._raw = {None: 0, "": 0}
+        self._ranks = None
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def code(self, value):
+        code = self._raw.get(value)
+        if code is None:
+            # Normalizing is the slow part, so it is done once per distinct spelling
+            key = normalize(value)
+            code = self._ids.get(key)
+            if code is None:
+                code = self._ids[key] = len(self.keys)
+                self.keys.append(key)
+                self.values.append(value)
+                self._ranks = None
+            self._raw[value] = code
+        return code
+
+    def ranks(self):
+        # Every code's position in sorted order: the column's sort key
+        import numpy as np
+
+        if self._ranks is None:
+            order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+            ranks = np.empty(len(order), np.int32)
+            ranks[order] = np.arange(len(order), dtype=np.int32)
+            self._ranks = ranks
+            self._sorted = [self.keys[code] for code in order]
+        return self._ranks
+
+    def matching(self, operator, key):
+        # Which codes satisfy the comparison, as a mask over the codes
+        import numpy as np
+
+        if operator in ("=", "!="):
+            mask = np.zeros(len(self.keys), bool)
+            code = self._ids.get(key)
+            if code is not None:
+                mask[code] = True
+            return ~mask if operator == "!=" else mask
+        if operator == "~":
+            return np.fromiter((key in text for text in self.keys), bool, len(self.keys))
+
+        ranks = self.ranks()
+        if operator == "<":
+            return ranks < bisect.bisect_left(self._sorted, key)
+        if operator == "<=":
+            return ranks < bisect.bisect_right(self._sorted, key)
+        if operator == ">":
+            return ranks >= bisect.bisect_right(self._sorted, key)
+        return ranks >= bisect.bisect_left(self._sorted, key)
+
+
+class LibraryColumns:
+    # The library's tags as NumPy columns, one row per distinct track, so a smart playlist
+    # filters and sorts the whole library in a few vectorised steps. self.rows maps every playlist
+    # position to its row. The columns are built on first use from info_for(path) (metadata
+    # that is already in memory), then kept in step through the playlist's change notifications
+    # and update() for retagged tracks. Rows of tracks that left the playlist stay until a reset.
+    def __init__(self, playlist, info_for):
+        self.playlist = playlist
+        self.info_for = info_for
+        self.built = False
+        self.count = 0
+        self.rows = None
+        self.strings = {}
+        self._ids = {}
+        self._paths = None
+        self._codes = {}
+        self._numbers = {}
+        self._plays = Counter()
+        self._sort_keys = {}
+        playlist.add_listener(self.on_playlist_change)
+
+    def codes(self, field):
+        return self._codes[field][:self.count]
+
+    def number(self, field):
+        return self._numbers[field][:self.count]
+
+    @timed("library_columns_build")
+    def build(self):
+        import numpy as np
+
+        self.count = 0
+        self._ids = {}
+        self.strings = {field: StringColumn() for field in STRING_FIELDS}
+        self._paths = np.empty(0, object)
+        self._codes = {field: np.zeros(0, np.int32) for field in STRING_FIELDS}
+        self._numbers = {field: np.zeros(0) for field in NUMBER_FIELDS}
+        self._sort_keys = {}
+        playlist = list(self.playlist)
+        self._ids = dict.fromkeys(playlist)
+        paths = list(self._ids)
+        for row, path in enumerate(paths):
+            self._ids[path] = row
+        self._reserve(len(paths))
+        self.count = len(paths)
+        self._paths[:self.count] = paths
+
+        # Whole columns at a time; filling row by row costs a NumPy scalar store per field
+        infos = [self.info_for(path) for path in paths]
+        for field in STRING_FIELDS:
+            code = self.strings[field].code
+            self._codes[field][:self.count] = [code(getattr(info, field) if info is not None else None)
+                                               for info in infos]
+        for field in ("year", "duration", "bitrate"):
+            # Zero means unknown for all of these
+            self._numbers[field][:self.count] = [(getattr(info, field) if info is not None else None) or np.nan
+                                                 for info in infos]
+        self._numbers["plays"][:self.count] = [self._plays[path] for path in paths]
+        self.rows = np.fromiter((self._ids[path] for path in playlist), np.int32, len(playlist))
+        self.built = True
+
+    def _reserve(self, rows):
+        # Room for this many more rows, growing by doubling
+        import numpy as np
+
+        needed = self.count + rows
+        if needed <= len(self._paths):
+            return
+        capacity = max(needed, 2 * len(self._paths), 1024)
+        paths = np.empty(capacity, object)
+        paths[:self.count] = self._paths[:self.count]
+        self._paths = paths
+        for field, codes in self._codes.items():
+            self._codes[field] = np.concatenate([codes[:self.count], np.zeros(capacity - self.count, np.int32)])
+        for field, numbers in self._numbers.items():
+            self._numbers[field] = np.concatenate([numbers[:self.count], np.full(capacity - self.count, np.nan)])
+
+    def _row(self, path):
+        row = self._ids.get(path)
+        if row is None:
+            self._reserve(1)
+            row = self._ids[path] = self.count
+            self.count += 1
+            self._paths[row] = path
+            self._fill(row, self.info_for(path))
+        return row
+
+    def _fill(self, row, info):
+        for field in STRING_FIELDS:
+            self._codes[field][row] = self.strings[field].code(getattr(info, field) if info is not None else None)
+        numbers = self._numbers
+        for field in ("year", "duration", "bitrate"):
+            # Zero means unknown for all of these
+            numbers[field][row] = (getattr(info, field) if info is not None else None) or float("nan")
+        numbers["plays"][row] = self._plays[self._paths[row]]
+        self._sort_keys.clear()
+
+    def update(self, info):
+        # A retagged track
+        row = self._ids.get(info.path) if self.built else None
+        if row is not None:
+            self._fill(row, info)
+
+    def count_play(self, path):
+        self._plays[path] += 1
+        row = self._ids.get(path) if self.built else None
+        if row is not None:
+            self._numbers["plays"][row] = self._plays[path]
+            self._sort_keys.pop(("plays", False), None)
+            self._sort_keys.pop(("plays", True), None)
+
+    def set_plays(self, plays):
+        # Play counts by path, e.g. from the play history
+        self._plays = Counter(plays)
+        if self.built:
+            column = self._numbers["plays"]
+            for path, row in self._ids.items():
+                column[row] = self._plays[path]
+            self._sort_keys.clear()
+
+    def on_playlist_change(self, kind, index, value):
+        import numpy as np
+
+        if not self.built:
+            return
+        if kind == INSERT:
+            added = [self._row(path) for path in self.playlist[index:index + value]]
+            self.rows = np.insert(self.rows, index, added) if index < len(self.rows) else np.append(self.rows, added)
+        elif kind == REMOVE:
+            self.rows = np.delete(self.rows, np.s_[index:index + value])
+        elif kind == MOVE:
+            row = self.rows[index]
+            self.rows = np.insert(np.delete(self.rows, index), value, row)
+        elif kind == RESET:
+            # A different library: start over the next time the columns are needed
+            self.built = False
+            self.rows = None
+
+    def sort_key(self, field, descending=False):
+        # Precomputed per column: ranks for text, the values themselves for numbers
+        key = self._sort_keys.get((field, descending))
+        if key is None:
+            if field in STRING_FIELDS:
+                key = self.strings[field].ranks()[self.codes(field)]
+            else:
+                key = self.number(field).copy()
+            if descending:
+                key = -key
+            self._sort_keys[(field, descending)] = key
+        return key
+
+    @timed("smart_playlist")
+    def select(self, query):
+        # Paths of the playlist entries matching the query, in its order (playlist order otherwise)
+        import numpy as np
+
+        if not self.built:
+            self.build()
+        selected = self.rows
+        if query.where is not None:
+            mask = query.where(self)
+            selected = selected[mask[selected]]
+        if query.order:
+            keys = [self.sort_key(field, descending)[selected] for field, descending in reversed(query.order)]
+            # Both sorts are stable, so ties keep their playlist order
+            order = np.argsort(keys[0], kind="stable") if len(keys) == 1 else np.lexsort(keys)
+            selected = selected[order]
+        if query.limit is not None:
+            selected = selected[:query.limit]
+        return self._paths[selected].tolist()
+
@@ -0,0 +1,156 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metadata_cache import parse_track
+
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+
+
+class LibraryScanner:
+    # Walks folders on a background thread and parses new or changed files in a thread pool.
+    # on_batch(infos) and on_done(scanner) are called from the scanner thread, so a UI has to
+    # hand the results over to its own thread. Covers found on the way go to art_cache.
+    def __init__(self, metadata, on_batch, on_done=None, batch_size=250, workers=None, extensions=AUDIO_EXTENSIONS,
+                 art_cache=None):
+        self.metadata = metadata
+        self.art_cache = art_cache
+        self.extensions = tuple(extensions)
+        self.on_batch = on_batch
+        self.on_done = on_done
+        self.batch_size = batch_size
+        self.workers = workers or min(16, (os.cpu_count() or 1) * 2)
+
+        self.files_found = 0
+        self.files_parsed = 0
+        self.files_skipped = 0
+        self.started_at = None
+        self.finished_at = None
+
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def start(self, roots):
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, args=(list(roots),), daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def files_per_second(self):
+        if self.started_at is None:
+            return 0.0
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return self.files_found / elapsed if elapsed > 0 else 0.0
+
+    def _run(self, roots):
+        batch = []
+        pending = set()
+        max_pending = self.workers * 4
+        # Covers the art cache had no room for, by hash, queued once the scan is done; parsing
+        # never waits for covers to be scaled
+        missed = {}
+
+        def art_for(path):
+            if self.art_cache is None:
+                return None
+
+            def on_art(art_hash, image_data):
+                if not self.art_cache.add(art_hash, image_data, block=False):
+                    missed.setdefault(art_hash, path)
+            return on_art
+
+        def flush():
+            if batch:
+                self.metadata.commit()
+                self.on_batch(list(batch))
+                batch.clear()
+
+        def collect(done):
+            for future in done:
+                try:
+                    info = future.result()
+                except Exception as e:
+                    print(f"Error scanning track: {e}")
+                    continue
+                self.metadata.put(info, commit=False)
+                self.files_parsed += 1
+                batch.append(info)
+                if len(batch) >= self.batch_size:
+                    flush()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for path, st in self._walk(roots):
+                    self.files_found += 1
+                    info = self.metadata.lookup(path, st)
+                    if info is not None:
+                        # Unchanged since the last scan
+                        self.files_skipped += 1
+                        if self.art_cache is not None and info.art_hash:
+                            # Scanned before its cover was cached
+                            if not self.art_cache.add_file(path, info.art_hash, block=False):
+                                missed.setdefault(info.art_hash, path)
+                        batch.append(info)
+                        if len(batch) >= self.batch_size:
+                            flush()
+                        continue
+
+                    pending.add(pool.submit(parse_track, path, st, art_for(path)))
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+
+                if self.cancelled:
+                    for future in pending:
+                        future.cancel()
+                else:
+                    collect(pending)
+            flush()
+        finally:
+            self.finished_at = time.monotonic()
+            if self.on_done:
+                self.on_done(self)
+        for art_hash, path in missed.items():
+            if self.cancelled:
+                break
+            self.art_cache.add_file(path, art_hash)
+
+    def _walk(self, roots):
+        stack = list(reversed(roots))
+        while stack and not self.cancelled:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    entries = sorted(entries, key=lambda entry: entry.name.lower())
+            except OSError as e:
+                print(f"Error scanning folder: {e}")
+                continue
+
+            subdirectories = []
+            for entry in entries:
+                if self.cancelled:
+                    return
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.name.lower().endswith(self.extensions):
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
+            stack.extend(reversed(subdirectories))
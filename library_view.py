@@ -0,0 +1,213 @@
+import os
+
+from instrumentation import timed
+
+# Change kinds passed to LibraryModel listeners as listener(kind, index, count_or_target)
+INSERT = "insert"
+REMOVE = "remove"
+MOVE = "move"
+RESET = "reset"
+
+
+class LibraryModel:
+    # A list of track paths that tells its listeners what changed instead of making them
+    # re-read everything
+    def __init__(self, items=()):
+        self._items = list(items)
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, kind, index, value):
+        for listener in self._listeners:
+            listener(kind, index, value)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __bool__(self):
+        return bool(self._items)
+
+    def index(self, item):
+        return self._items.index(item)
+
+    def append(self, item):
+        self.insert(len(self._items), item)
+
+    def extend(self, items):
+        items = list(items)
+        if items:
+            index = len(self._items)
+            self._items.extend(items)
+            self._notify(INSERT, index, len(items))
+
+    def insert(self, index, item):
+        index = max(0, min(index, len(self._items)))
+        self._items.insert(index, item)
+        self._notify(INSERT, index, 1)
+
+    def remove_at(self, index, count=1):
+        del self._items[index:index + count]
+        self._notify(REMOVE, index, count)
+
+    def move(self, source, target):
+        item = self._items.pop(source)
+        self._items.insert(target, item)
+        self._notify(MOVE, source, target)
+
+    def reset(self, items):
+        self._items = list(items)
+        self._notify(RESET, 0, len(self._items))
+
+
+class VirtualListView:
+    # Drives a Listbox that only ever holds the rows currently on screen, so the cost of
+    # scrolling and of model changes depends on the window height, not the library size
+    def __init__(self, listbox, model, label=os.path.basename, scrollbar=None):
+        self.listbox = listbox
+        self.model = model
+        self.label = label
+        self.scrollbar = scrollbar
+
+        self.first = 0
+        self.selected = None
+        self._render_pending = False
+
+        model.add_listener(self.on_model_change)
+        if scrollbar is not None:
+            scrollbar.config(command=self.yview)
+        listbox.config(yscrollcommand="")
+        listbox.bind("<<ListboxSelect>>", self.on_select)
+        listbox.bind("<MouseWheel>", self.on_mouse_wheel)
+        listbox.bind("<Button-4>", lambda event: self.scroll(-3))
+        listbox.bind("<Button-5>", lambda event: self.scroll(3))
+        self.render()
+
+    @property
+    def rows(self):
+        return int(self.listbox.cget("height")) or 10
+
+    def selected_index(self):
+        return self.selected
+
+    def selected_item(self):
+        return self.model[self.selected] if self.selected is not None else None
+
+    def set_model(self, model):
+        # Show a different model, e.g. search results instead of the whole library
+        if model is self.model:
+            return
+        self.model.remove_listener(self.on_model_change)
+        self.model = model
+        model.add_listener(self.on_model_change)
+        self.first = 0
+        self.selected = None
+        self.schedule_render()
+
+    def on_select(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.first + selection[0]
+
+    def on_mouse_wheel(self, event):
+        self.scroll(-1 if event.delta > 0 else 1)
+        return "break"
+
+    def scroll(self, rows):
+        self.scroll_to(self.first + rows)
+        return "break"
+
+    def scroll_to(self, first):
+        first = max(0, min(first, len(self.model) - self.rows))
+        if first != self.first:
+            self.first = first
+            self.schedule_render()
+
+    def see(self, index):
+        if index < self.first:
+            self.scroll_to(index)
+        elif index >= self.first + self.rows:
+            self.scroll_to(index - self.rows + 1)
+
+    def yview(self, *args):
+        # Scrollbar protocol: ("moveto", fraction) or ("scroll", amount, "units"/"pages")
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * len(self.model)))
+        elif args[0] == "scroll":
+            amount = int(args[1])
+            self.scroll(amount * self.rows if args[2] == "pages" else amount)
+
+    def on_model_change(self, kind, index, value):
+        if kind == INSERT:
+            if self.selected is not None and self.selected >= index:
+                self.selected += value
+            if index < self.first:
+                # Keep the same rows on screen
+                self.first += value
+        elif kind == REMOVE:
+            if self.selected is not None:
+                if self.selected >= index + value:
+                    self.selected -= value
+                elif self.selected >= index:
+                    self.selected = None
+            if index < self.first:
+                self.first = max(index, self.first - value)
+        elif kind == MOVE:
+            if self.selected == index:
+                self.selected = value
+            elif self.selected is not None:
+                if index < self.selected <= value:
+                    self.selected -= 1
+                elif value <= self.selected < index:
+                    self.selected += 1
+        elif kind == RESET:
+            self.first = 0
+            self.selected = None
+
+        if kind in (INSERT, REMOVE) and index >= self.first + self.rows:
+            # Nothing on screen moved, only the scrollbar needs to know
+            self.update_scrollbar()
+        else:
+            self.schedule_render()
+
+    def schedule_render(self):
+        # Coalesce a burst of changes into a single redraw
+        if not self._render_pending:
+            self._render_pending = True
+            self.listbox.after_idle(self.render)
+
+    @timed("library_view_render")
+    def render(self):
+        self._render_pending = False
+        rows = self.rows
+        self.first = max(0, min(self.first, len(self.model) - rows))
+        visible = [self.label(item) for item in self.model[self.first:self.first + rows]]
+
+        self.listbox.delete(0, "end")
+        if visible:
+            self.listbox.insert("end", *visible)
+        if self.selected is not None and self.first <= self.selected < self.first + rows:
+            self.listbox.selection_set(self.selected - self.first)
+        self.update_scrollbar()
+
+    def update_scrollbar(self):
+        if self.scrollbar is None:
+            return
+        total = len(self.model)
+        if total <= self.rows:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(self.first / total, (self.first + self.rows) / total)
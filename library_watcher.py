@@ -0,0 +1,340 @@
+import os
+import sys
+import time
+import queue
+import struct
+import select
+import threading
+
+from library_scanner import AUDIO_EXTENSIONS
+from metadata_cache import parse_track
+
+# A burst of events (a folder of new rips being copied, a tagger saving a whole album) is
+# handled once nothing has happened for QUIET_SECONDS, or at the latest MAX_DELAY after it began
+QUIET_SECONDS = 1.0
+MAX_DELAY = 5.0
+# Changed tracks are handed over this many at a time
+BATCH_SIZE = 250
+
+# Folders that can't be watched through inotify are walked every POLL_SECONDS, or less often
+# for big folders, so the walks take no more than POLL_SHARE of the time
+POLL_SECONDS = 10.0
+POLL_SHARE = 0.05
+
+# How often the watcher thread looks for newly added folders while nothing else happens
+WAKE_SECONDS = 0.5
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT = struct.Struct("iIII")  # watch descriptor, mask, cookie, name length
+
+# What a pending path needs once the burst is over
+FILE = "file"
+DIRECTORY = "directory"
+GONE = "gone"
+
+
+def inotify_available():
+    # MUSIC_PLAYER_WATCHER=inotify|poll overrides the choice
+    choice = os.environ.get("MUSIC_PLAYER_WATCHER")
+    if choice:
+        return choice == "inotify"
+    return sys.platform.startswith("linux")
+
+
+class Inotify:
+    # The kernel's inotify, through ctypes. It doesn't watch subfolders, so every folder gets
+    # a watch of its own.
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._ctypes = ctypes
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise("inotify_init1")
+        self.folders = {}
+        self.watches = {}
+
+    def _raise(self, what, path=None):
+        number = self._ctypes.get_errno()
+        raise OSError(number, f"{what}: {os.strerror(number)}", path)
+
+    def add(self, folder):
+        if folder in self.watches:
+            return
+        watch = self._add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if watch < 0:
+            self._raise("inotify_add_watch", folder)
+        self.folders[watch] = folder
+        self.watches[folder] = watch
+
+    def forget(self, folder):
+        # Drop the watches of a folder that was moved away or deleted, and of its subfolders
+        prefix = folder + os.sep
+        for path in [path for path in self.watches if path == folder or path.startswith(prefix)]:
+            watch = self.watches.pop(path)
+            self.folders.pop(watch, None)
+            self._rm_watch(self.fd, watch)
+
+    def read(self, timeout):
+        # (mask, path) of the events that arrive within timeout; path is None when the kernel's
+        # queue overflowed and events were lost
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            watch, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, None))
+                continue
+            folder = self.folders.get(watch)
+            if mask & IN_IGNORED:
+                if folder is not None:
+                    del self.folders[watch]
+                    if self.watches.get(folder) == watch:
+                        del self.watches[folder]
+                continue
+            if folder is not None:
+                events.append((mask, os.path.join(folder, os.fsdecode(name)) if name else folder))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    # Keeps watched library folders in step with the disk on a background thread: through
+    # inotify on Linux, by walking them now and then anywhere else. A folder is compared with
+    # what the library already knows of it (path -> (size, mtime)) when it is first watched,
+    # so changes made while the player was closed come through too. Only files whose size or
+    # mtime changed are parsed again. on_changes(infos, removed_paths) is called from the
+    # watcher thread, so a UI has to hand the changes over to its own thread. Covers of changed
+    # tracks go to art_cache.
+    def __init__(self, metadata, on_changes, extensions=AUDIO_EXTENSIONS, art_cache=None):
+        self.metadata = metadata
+        self.art_cache = art_cache
+        self.on_changes = on_changes
+        self.extensions = tuple(extensions)
+        self.folders = []
+        self.backend = None
+
+        self._requests = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._known = {}
+        self._pending = {}
+        self._first_event = self._last_event = None
+        # Folder -> when it is next walked, for folders without inotify
+        self._polled = {}
+
+    def watch(self, folder, known=None):
+        # known: path -> (size, mtime) of the folder's tracks the library already has
+        self._requests.put((os.path.abspath(folder), dict(known or {})))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        if inotify_available():
+            try:
+                self._inotify = Inotify()
+                self.backend = "inotify"
+            except (OSError, AttributeError) as e:
+                print(f"Error starting inotify, polling instead: {e}")
+        if self._inotify is None:
+            self.backend = "poll"
+
+        try:
+            while not self._stopped.is_set():
+                self._take_requests()
+                now = time.monotonic()
+                deadlines = list(self._polled.values())
+                if self._pending:
+                    deadlines.append(min(self._last_event + QUIET_SECONDS, self._first_event + MAX_DELAY))
+                timeout = min([WAKE_SECONDS] + [max(0.0, deadline - now) for deadline in deadlines])
+
+                if self._inotify is not None:
+                    for mask, path in self._inotify.read(timeout):
+                        self._on_event(mask, path)
+                else:
+                    self._stopped.wait(timeout)
+
+                now = time.monotonic()
+                if self._pending and (now - self._last_event >= QUIET_SECONDS or now - self._first_event >= MAX_DELAY):
+                    self._flush()
+                for folder, due in list(self._polled.items()):
+                    if now >= due:
+                        started = time.monotonic()
+                        self._reconcile(folder)
+                        took = time.monotonic() - started
+                        self._polled[folder] = time.monotonic() + max(POLL_SECONDS, took / POLL_SHARE)
+        except Exception as e:
+            print(f"Error watching library: {e}")
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+
+    def _take_requests(self):
+        while True:
+            try:
+                folder, known = self._requests.get_nowait()
+            except queue.Empty:
+                return
+            if folder in self.folders:
+                continue
+            self.folders.append(folder)
+            self._known.update(known)
+            self._reconcile(folder)
+            if self._inotify is None or folder not in self._inotify.watches:
+                self._polled.setdefault(folder, time.monotonic() + POLL_SECONDS)
+
+    def _on_event(self, mask, path):
+        if path is None:
+            # Events were lost, so compare everything with the disk again
+            self._pending.clear()
+            for folder in self.folders:
+                self._reconcile(folder)
+            return
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            kind = GONE
+        elif mask & IN_ISDIR:
+            kind = GONE if mask & (IN_DELETE | IN_MOVED_FROM) else DIRECTORY
+        else:
+            if not path.lower().endswith(self.extensions):
+                return
+            kind = FILE
+        if kind == GONE:
+            self._inotify.forget(path)
+
+        now = time.monotonic()
+        if not self._pending:
+            self._first_event = now
+        self._last_event = now
+        # The latest event for a path wins: a file written to a temporary name and renamed over
+        # the old one is just a changed file
+        self._pending.pop(path, None)
+        self._pending[path] = kind
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        files = {}
+        removed = set()
+        for path, kind in pending.items():
+            if kind == GONE:
+                removed.update(self._known_under(path))
+            elif kind == DIRECTORY:
+                files.update(self._walk(path))
+            else:
+                try:
+                    files[path] = os.stat(path)
+                except OSError:
+                    if path in self._known:
+                        removed.add(path)
+        self._apply(files, removed)
+
+    def _reconcile(self, folder):
+        # Compare a whole folder with what is known of it
+        files = dict(self._walk(folder))
+        removed = {path for path in self._known_under(folder) if path not in files}
+        self._apply(files, removed)
+
+    def _known_under(self, folder):
+        prefix = folder + os.sep
+        return [path for path in self._known if path == folder or path.startswith(prefix)]
+
+    def _apply(self, files, removed):
+        removed = {path for path in removed if path not in files}
+        for path in removed:
+            del self._known[path]
+
+        changed = [(path, st) for path, st in files.items() if self._known.get(path) != (st.st_size, st.st_mtime)]
+        batch = []
+        for path, st in changed:
+            if self._stopped.is_set():
+                return
+            info = self.metadata.lookup(path, st)
+            if info is None:
+                try:
+                    info = parse_track(path, st, self.art_cache.add if self.art_cache is not None else None)
+                except Exception as e:
+                    print(f"Error reading changed track: {e}")
+                    continue
+                self.metadata.put(info, commit=False)
+            self._known[path] = (info.size, info.mtime)
+            batch.append(info)
+            if len(batch) >= BATCH_SIZE:
+                self.metadata.commit()
+                self.on_changes(batch, [])
+                batch = []
+
+        if batch:
+            self.metadata.commit()
+        if batch or removed:
+            self.on_changes(batch, sorted(removed))
+
+    def _walk(self, folder):
+        # (path, stat) of the tracks under folder, watching each subfolder before it is listed
+        # so nothing created in the meantime is missed
+        stack = [folder]
+        while stack and not self._stopped.is_set():
+            directory = stack.pop()
+            if self._inotify is not None:
+                try:
+                    self._inotify.add(directory)
+                except OSError as e:
+                    root = next((root for root in self.folders if directory == root or directory.startswith(root + os.sep)), folder)
+                    if root not in self._polled:
+                        # Usually the per-user limit on watches (fs.inotify.max_user_watches)
+                        print(f"Error watching folder, polling it instead: {e}")
+                        self._polled[root] = time.monotonic() + POLL_SECONDS
+            try:
+                with os.scandir(directory) as entries:
+                    entries = list(entries)
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(self.extensions):
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
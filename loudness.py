@@ -0,0 +1,225 @@
+import os
+import sys
+import math
+import argparse
+
+from audio_decode import open_pcm, supported_extensions
+from instrumentation import timed
+
+# ReplayGain 2.0 plays everything as if it had been mastered to this loudness
+REFERENCE_LUFS = -18.0
+
+# EBU R128 / ITU-R BS.1770 gating: 400 ms blocks every 100 ms, an absolute gate at -70 LUFS
+# and a relative gate 10 LU below the loudness of what passed the absolute one
+SEGMENT_SECONDS = 0.1
+SEGMENTS_PER_BLOCK = 4
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+
+def biquad_power(b, a, frequencies, sample_rate):
+    # |H|^2 of a biquad at the given frequencies
+    import numpy as np
+
+    z = np.exp(-2j * np.pi * frequencies / sample_rate)
+    response = (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+    return np.abs(response) ** 2
+
+
+def k_weighting(sample_rate, length):
+    # Power response of the BS.1770 K-weighting filter (a high shelf modelling the head, then a
+    # high-pass) on the rfft bins of a segment, so it can be applied in the frequency domain
+    import numpy as np
+
+    frequencies = np.fft.rfftfreq(length, 1 / sample_rate)
+
+    gain, q, cutoff = 4.0, 1 / math.sqrt(2), 1500.0
+    A = 10 ** (gain / 40)
+    w0 = 2 * math.pi * cutoff / sample_rate
+    alpha = math.sin(w0) / (2 * q)
+    cos_w0 = math.cos(w0)
+    shelf_b = (A * ((A + 1) + (A - 1) * cos_w0 + 2 * math.sqrt(A) * alpha),
+               -2 * A * ((A - 1) + (A + 1) * cos_w0),
+               A * ((A + 1) + (A - 1) * cos_w0 - 2 * math.sqrt(A) * alpha))
+    shelf_a = ((A + 1) - (A - 1) * cos_w0 + 2 * math.sqrt(A) * alpha,
+               2 * ((A - 1) - (A + 1) * cos_w0),
+               (A + 1) - (A - 1) * cos_w0 - 2 * math.sqrt(A) * alpha)
+
+    q, cutoff = 0.5, 38.0
+    w0 = 2 * math.pi * cutoff / sample_rate
+    alpha = math.sin(w0) / (2 * q)
+    cos_w0 = math.cos(w0)
+    highpass_b = ((1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2)
+    highpass_a = (1 + alpha, -2 * cos_w0, 1 - alpha)
+
+    weights = biquad_power(shelf_b, shelf_a, frequencies, sample_rate) * biquad_power(highpass_b, highpass_a, frequencies, sample_rate)
+    # Parseval for a one-sided spectrum: every bin but DC (and Nyquist) stands for two
+    weights[1:] *= 2
+    if length % 2 == 0:
+        weights[-1] /= 2
+    return weights / (length * length)
+
+
+@timed("loudness_measure")
+def measure_loudness(path):
+    # (path, integrated loudness in LUFS, sample peak, per-block energies) of one track. The
+    # energies are kept so an album's loudness can be gated over all of its tracks together.
+    import numpy as np
+
+    stream = open_pcm(path)
+    if stream is None:
+        return path, None, None, None
+    with stream:
+        segment = int(stream.sample_rate * SEGMENT_SECONDS)
+        weights = k_weighting(stream.sample_rate, segment)
+        energies = []
+        peak = 0.0
+        # Blocks are a whole number of segments, so only the very last one can leave a remainder
+        for block in stream.blocks(segment * 16):
+            peak = max(peak, float(np.abs(block).max()))
+            count = len(block) // segment
+            if not count:
+                break
+            segments = block[:count * segment].reshape(count, segment, -1)
+            spectrum = np.fft.rfft(segments, axis=1)
+            power = spectrum.real ** 2 + spectrum.imag ** 2
+            # Mean square of the K-weighted signal, summed over channels, per 100 ms segment
+            energies.append(np.einsum("sfc,f->s", power, weights))
+
+    if not energies:
+        return path, None, peak, None
+    segments = np.concatenate(energies)
+    if len(segments) < SEGMENTS_PER_BLOCK:
+        # Shorter than one gating block, measure it as a whole
+        blocks = segments.mean(keepdims=True)
+    else:
+        # 400 ms blocks overlapping by 75%, each the mean of four consecutive segments
+        blocks = np.convolve(segments, np.full(SEGMENTS_PER_BLOCK, 1 / SEGMENTS_PER_BLOCK), mode="valid")
+    blocks = blocks.astype(np.float32)
+    return path, gated_loudness(blocks), peak, blocks
+
+
+def block_loudness(energy):
+    import numpy as np
+    return -0.691 + 10 * np.log10(np.maximum(energy, 1e-12))
+
+
+def gated_loudness(blocks):
+    import numpy as np
+
+    if blocks is None or not len(blocks):
+        return None
+    blocks = blocks[block_loudness(blocks) > ABSOLUTE_GATE]
+    if not len(blocks):
+        return None
+    threshold = block_loudness(blocks.mean()) + RELATIVE_GATE
+    blocks = blocks[block_loudness(blocks) > threshold]
+    return float(block_loudness(blocks.mean()))
+
+
+def gain_for(loudness):
+    # ReplayGain style gain in dB that brings a track to the reference loudness
+    return None if loudness is None else REFERENCE_LUFS - loudness
+
+
+def gain_to_volume(gain, peak=None):
+    # Mixer volume for a gain in dB. The mixer can only attenuate, so louder-than-1.0 is clipped,
+    # and a known peak keeps the gain from pushing the track into clipping.
+    if gain is None:
+        return 1.0
+    volume = 10 ** (gain / 20)
+    if peak:
+        volume = min(volume, 1.0 / peak)
+    return min(1.0, volume)
+
+
+def album_key(info):
+    # Tracks in the same folder with the same album tag; the folder keeps two "Greatest Hits" apart
+    return (os.path.dirname(info.path), info.album) if info.album else None
+
+
+def measure_group(paths, album):
+    # Runs in a worker process: [(path, loudness, peak)] for the tracks, and for an album the
+    # loudness gated over the blocks of all of them (None unless every track could be measured).
+    # The blocks stay in the worker and only one album's worth is held at a time.
+    import numpy as np
+
+    results = []
+    album_blocks = []
+    for path in paths:
+        path, loudness, peak, blocks = measure_loudness(path)
+        results.append((path, loudness, peak))
+        album_blocks.append(blocks)
+    album_loudness = None
+    if album and all(blocks is not None for blocks in album_blocks):
+        album_loudness = gated_loudness(np.concatenate(album_blocks))
+    return results, album_loudness
+
+
+def analyze_library(paths, metadata, workers=None, on_track=None):
+    # Measures every track that doesn't have a gain yet (from ReplayGain tags or an earlier run)
+    # across a pool of processes, and stores track and album gains in the metadata cache. An
+    # album with any track missing a gain is measured as a whole, one album per job, since its
+    # gain depends on all of its tracks. Returns the number of tracks analysed.
+    infos = [info for info in (metadata.get(path) for path in dict.fromkeys(paths)) if info is not None]
+    albums = {}
+    singles = []
+    for info in infos:
+        key = album_key(info)
+        if key is not None:
+            albums.setdefault(key, []).append(info)
+        elif info.track_gain is None:
+            singles.append([info])
+
+    groups = [tracks for tracks in albums.values()
+              if any(info.track_gain is None or info.album_gain is None for info in tracks)]
+    albums_todo = len(groups)
+    groups += singles
+    if not groups:
+        return 0
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    count = 0
+    # Spawned rather than forked: this usually runs next to Tk and pygame threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        jobs = pool.map(measure_group, [[info.path for info in tracks] for tracks in groups],
+                        [number < albums_todo for number in range(len(groups))])
+        for tracks, (results, album_loudness) in zip(groups, jobs):
+            album_gain = gain_for(album_loudness)
+            for info, (path, loudness, peak) in zip(tracks, results):
+                updated = info._replace(
+                    track_gain=info.track_gain if info.track_gain is not None else gain_for(loudness),
+                    track_peak=info.track_peak if info.track_peak is not None else peak,
+                    # Measured over the album as it is now, which may have gained tracks since
+                    album_gain=album_gain if album_gain is not None else info.album_gain)
+                if updated != info:
+                    metadata.put(updated, commit=False)
+                count += 1
+                if on_track is not None:
+                    on_track(path)
+    metadata.commit()
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the loudness of a music library for volume normalization")
+    parser.add_argument("paths", nargs="+", help="audio files or folders")
+    parser.add_argument("--workers", type=int, help="processes to use (default: one per core)")
+    args = parser.parse_args(argv)
+
+    from app_paths import data_path
+    from metadata_cache import MetadataCache
+    from player_core import collect_tracks
+
+    metadata = MetadataCache(data_path("metadata.db"))
+    tracks = collect_tracks(args.paths, metadata, supported_extensions())
+    count = analyze_library(tracks, metadata, args.workers)
+    print(f"Analysed {count} of {len(tracks)} tracks")
+    metadata.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import namedtuple, OrderedDict
+
+from duration_probe import probe_duration
+from playlist_files import split_entry
+from seek_index import build_seek_index, indexable, encode, decode
+
+SCHEMA_VERSION = 2
+# Seek indexes kept in memory (the rest stay in the database)
+SEEK_INDEX_MEMORY = 32
+
+FIELDS = ("path", "size", "mtime", "duration", "bitrate", "title", "artist", "album", "genre", "year", "art_hash",
+          "track_gain", "album_gain", "track_peak")
+# Gains (dB) and peak come from ReplayGain tags or from loudness analysis, and may not be known yet
+TrackInfo = namedtuple("TrackInfo", FIELDS, defaults=(None, None, None))
+
+
+class MetadataCache:
+    # Track metadata keyed by path and validated against the file's size and mtime,
+    # so a file is only parsed again when it actually changes on disk
+    def __init__(self, db_path=None):
+        self._entries = {}
+        # Seek indexes by file path, with the size and mtime they were built for, least recently
+        # used first; the engine's indexing thread and the player's thread both use them
+        self._seek_indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._snapshot = None
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path):
+        try:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                # The cache can always be rebuilt from the files, so just start over
+                self._db.execute("DROP TABLE IF EXISTS tracks")
+                self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            columns = ", ".join(FIELDS[1:])
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, {columns})")
+            self._db.execute("CREATE TABLE IF NOT EXISTS seek_indexes (path TEXT PRIMARY KEY, size, mtime, sample_rate, "
+                             "frame_samples, step, frames, offsets BLOB)")
+            self._db.commit()
+        except sqlite3.Error as e:
+            print(f"Error opening metadata cache: {e}")
+            self._db = None
+
+    def attach(self, snapshot):
+        # Metadata saved with the last session, consulted before SQLite and read on demand
+        self._snapshot = snapshot
+
+    def get(self, path):
+        # A CUE track is validated against, and parsed from, the file it is part of
+        source, start, end = split_entry(path)
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+
+        info = self.lookup(path, st)
+        if info is None:
+            info = parse_track(source, st)
+            if source != path:
+                length = (end if end is not None else info.duration) - start
+                info = info._replace(path=path, duration=max(0.0, length))
+            self.put(info)
+        return info
+
+    def lookup(self, path, st):
+        # The cached entry if it still matches the given stat result, without parsing
+        with self._lock:
+            info = self._entries.get(path)
+            if info is None and self._snapshot is not None:
+                info = self._snapshot.info(path)
+            if info is None and self._db is not None:
+                row = self._db.execute("SELECT * FROM tracks WHERE path = ?", (path,)).fetchone()
+                if row:
+                    info = TrackInfo(*row)
+            if info is not None and info.size == st.st_size and info.mtime == st.st_mtime:
+                self._entries[path] = info
+                return info
+        return None
+
+    def peek(self, path):
+        # Whatever is in memory or in the session snapshot, without touching the file system
+        info = self._entries.get(path)
+        if info is None and self._snapshot is not None:
+            info = self._snapshot.info(path)
+            if info is not None:
+                self._entries[path] = info
+        return info
+
+    def put(self, info, commit=True):
+        with self._lock:
+            self._entries[info.path] = info
+            if self._db is not None:
+                placeholders = ", ".join("?" * len(FIELDS))
+                self._db.execute(f"INSERT OR REPLACE INTO tracks VALUES ({placeholders})", info)
+                if commit:
+                    self._db.commit()
+
+    def seek_index(self, path, build=True):
+        # The file's seek index (seek_index.py), built the first time it is asked for and kept
+        # until the file changes. None for formats without one, or if build is False and it
+        # hasn't been built yet, since building reads the whole file.
+        source = split_entry(path)[0]
+        if not indexable(source):
+            return None
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+
+        stamp = (st.st_size, st.st_mtime)
+        index = None
+        with self._lock:
+            cached = self._seek_indexes.get(source)
+            if cached is not None and cached[0] == stamp:
+                self._seek_indexes.move_to_end(source)
+                return cached[1]
+            if self._db is not None:
+                row = self._db.execute("SELECT size, mtime, sample_rate, frame_samples, step, frames, offsets "
+                                       "FROM seek_indexes WHERE path = ?", (source,)).fetchone()
+                if row and tuple(row[:2]) == stamp:
+                    index = decode(*row[2:])
+        if index is None:
+            if not build:
+                return None
+            try:
+                index = build_seek_index(source)
+            except OSError as e:
+                print(f"Error indexing track: {e}")
+                return None
+            if index is None:
+                return None
+            with self._lock:
+                if self._db is not None:
+                    self._db.execute("INSERT OR REPLACE INTO seek_indexes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (source, *stamp, index.sample_rate, index.frame_samples, index.step,
+                                      index.frames, encode(index)))
+                    self._db.commit()
+        with self._lock:
+            self._seek_indexes[source] = (stamp, index)
+            self._seek_indexes.move_to_end(source)
+            while len(self._seek_indexes) > SEEK_INDEX_MEMORY:
+                self._seek_indexes.popitem(last=False)
+        return index
+
+    def commit(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def parse_track(path, st=None, on_art=None):
+    # on_art(art_hash, image_data) gets the embedded cover, while it is at hand anyway
+    if st is None:
+        st = os.stat(path)
+
+    duration = probe_duration(path) or 0.0
+    bitrate = 0
+    title = artist = album = genre = art_hash = None
+    year = None
+    track_gain = album_gain = track_peak = None
+    audiofile = None
+    if path.lower().endswith(".mp3"):
+        # Tags of other formats aren't read (yet), their length comes from the headers alone
+        try:
+            import eyed3
+            audiofile = eyed3.load(path)
+        except Exception as e:
+            print(f"Error reading metadata: {e}")
+
+    if audiofile is not None:
+        if audiofile.info:
+            duration = duration or float(audiofile.info.time_secs or 0)
+            bitrate = audiofile.info.bit_rate[1] if audiofile.info.bit_rate else 0
+        tag = audiofile.tag
+        if tag:
+            title, artist, album = tag.title, tag.artist, tag.album
+            genre = tag.genre.name if tag.genre else None
+            release_date = tag.getBestDate()
+            year = release_date.year if release_date else None
+            if tag.images:
+                art_hash = hashlib.sha1(tag.images[0].image_data).hexdigest()
+                if on_art is not None:
+                    on_art(art_hash, tag.images[0].image_data)
+            track_gain, album_gain, track_peak = replaygain_tags(tag)
+
+    return TrackInfo(path, st.st_size, st.st_mtime, duration, bitrate, title, artist, album, genre, year, art_hash,
+                     track_gain, album_gain, track_peak)
+
+
+def replaygain_tags(tag):
+    # ReplayGain values written by other tools, stored as TXXX frames like "REPLAYGAIN_TRACK_GAIN: -7.89 dB"
+    values = {}
+    for frame in tag.user_text_frames:
+        if frame.description:
+            values[frame.description.upper()] = frame.text
+    return (parse_number(values.get("REPLAYGAIN_TRACK_GAIN")), parse_number(values.get("REPLAYGAIN_ALBUM_GAIN")),
+            parse_number(values.get("REPLAYGAIN_TRACK_PEAK")))
+
+
+def parse_number(text):
+    try:
+        return float(text.split()[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
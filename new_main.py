@@ -1,16 +1,19 @@
-import os
-import pygame
-from tkinter import Tk, filedialog, Button, Label, Listbox, Scrollbar, DoubleVar
+from tkinter import Tk, StringVar, Button, Label, Listbox, Scrollbar, DoubleVar
 from tkinter import ttk, Canvas
 
-class MusicPlayer:
+import instrumentation
+from instrumentation import timed
+from library_view import VirtualListView
+from player_core import PlayerCore
+from playback_clock import refresh_interval
+from player_window import PlayerWindow
+
+class MusicPlayer(PlayerWindow):
     def __init__(self, master):
-        self.master = master
         master.title("Music Player")
 
-        self.current_track = None
-        self.playing = False
-        self.playlist = []
+        # Playback and the playlist live in the UI-free core, this class only draws them
+        self.attach(master, PlayerCore())
 
         # Create a canvas
         self.canvas = Canvas(master, width=750, height=550, bg="#a7cf70")
@@ -27,6 +30,17 @@ class MusicPlayer:
         self.select_button = ttk.Button(self.canvas, text="Select Track", command=self.select_track, style="TButton")
         self.select_button_window = self.canvas.create_window(375, 120, anchor="center", window=self.select_button)
 
+        self.playlist_button = ttk.Button(self.canvas, text="Playlist...", command=self.show_playlist_menu, style="TButton")
+        self.playlist_button_window = self.canvas.create_window(200, 120, anchor="center", window=self.playlist_button)
+
+        self.build_playlist_menu()
+
+        self.scan_button = ttk.Button(self.canvas, text="Scan Folder", command=self.scan_folder, style="TButton")
+        self.scan_button_window = self.canvas.create_window(550, 120, anchor="center", window=self.scan_button)
+
+        self.scan_status_label = ttk.Label(self.canvas, text="", font=("Helvetica", 10))
+        self.scan_status_label_window = self.canvas.create_window(375, 160, anchor="center", window=self.scan_status_label)
+
         self.play_button = ttk.Button(self.canvas, text="Play", command=self.toggle_play, style="TButton")
         self.play_button_window = self.canvas.create_window(200, 200, anchor="center", window=self.play_button)
 
@@ -36,6 +50,17 @@ class MusicPlayer:
         self.prev_button = ttk.Button(self.canvas, text="Previous", command=self.play_previous, style="TButton")
         self.prev_button_window = self.canvas.create_window(550, 200, anchor="center", window=self.prev_button)
 
+        self.shuffle_button = ttk.Button(self.canvas, text="Shuffle: Off", command=self.toggle_shuffle, style="TButton")
+        self.shuffle_button_window = self.canvas.create_window(200, 250, anchor="center", window=self.shuffle_button)
+
+        self.repeat_button = ttk.Button(self.canvas, text="Repeat: All", command=self.cycle_repeat, style="TButton")
+        self.repeat_button_window = self.canvas.create_window(550, 250, anchor="center", window=self.repeat_button)
+
+        self.sound_button = ttk.Button(self.canvas, text="Sound...", command=self.show_sound_menu, style="TButton")
+        self.sound_button_window = self.canvas.create_window(375, 250, anchor="center", window=self.sound_button)
+
+        self.build_sound_menu()
+
         # Create a progress bar
         self.progress_bar_var = DoubleVar()
         self.progress_bar = ttk.Progressbar(self.canvas, variable=self.progress_bar_var, length=600, mode="determinate")
@@ -48,97 +73,67 @@ class MusicPlayer:
         self.song_listbox_window = self.canvas.create_window(375, 500, anchor="center", window=self.song_listbox)
 
         self.scrollbar = Scrollbar(self.canvas, orient="vertical")
-        self.scrollbar.config(command=self.song_listbox.yview)
         self.scrollbar_window = self.canvas.create_window(570, 500, anchor="center", window=self.scrollbar)
 
-        self.song_listbox.config(yscrollcommand=self.scrollbar.set)
+        # Only the visible rows of the library are ever put into the Listbox
+        self.library_view = VirtualListView(self.song_listbox, self.playlist, label=self.entry_label, scrollbar=self.scrollbar)
+        self.song_listbox.bind("<Double-Button-1>", self.load_selected_song)
+
+        # Search box, filtering the library on every keystroke
+        self.search_label = ttk.Label(self.canvas, text="Search", font=("Helvetica", 10))
+        self.search_label_window = self.canvas.create_window(200, 350, anchor="e", window=self.search_label)
 
-        # Example songs for the song library
-        self.populate_song_library()
+        self.search_var = StringVar()
+        self.search_var.trace_add("write", self.on_search)
+        self.search_entry = ttk.Entry(self.canvas, textvariable=self.search_var, width=40)
+        self.search_entry_window = self.canvas.create_window(400, 350, anchor="center", window=self.search_entry)
 
-        self.song_listbox.bind("<Double-Button-1>", self.load_selected_song)
+        self.start()
 
-        # Initialize Pygame
-        pygame.init()
-
-        # Update the progress bar periodically
-        self.update_progress_bar()
-
-    def select_track(self):
-        file_path = filedialog.askopenfilename(filetypes=[("Audio Files", "*.mp3;*.wav")])
-        if file_path:
-            self.playlist.append(file_path)
-            self.update_song_library()
-            if not self.current_track:
-                self.load_and_play(file_path)
-
-    def toggle_play(self):
-        if self.current_track:
-            if not self.playing:
-                pygame.mixer.music.unpause()
-                self.playing = True
-                self.play_button.configure(text="Pause", style="TButton")
-            else:
-                pygame.mixer.music.pause()
-                self.playing = False
-                self.play_button.configure(text="Play", style="TButton")
-
-    def play_next(self):
-        if self.playlist:
-            current_index = self.playlist.index(self.current_track)
-            next_index = (current_index + 1) % len(self.playlist)
-            self.load_and_play(self.playlist[next_index])
-
-    def play_previous(self):
-        if self.playlist:
-            current_index = self.playlist.index(self.current_track)
-            prev_index = (current_index - 1) % len(self.playlist)
-            self.load_and_play(self.playlist[prev_index])
-
-    def load_and_play(self, file_path):
-        pygame.mixer.init()
-        pygame.mixer.music.load(file_path)
-        pygame.mixer.music.play()
-        self.playing = True
-        self.play_button.configure(text="Pause", style="TButton")
-        self.current_track = file_path
-        self.label.configure(text=os.path.basename(file_path))
+    def show_track(self):
+        self.label.configure(text=self.core.entry_label(self.core.current_track))
 
         # Reset progress bar
         self.progress_bar_var.set(0)
 
-        # Update progress bar length based on the song's duration
-        total_time = pygame.mixer.Sound(self.current_track).get_length()
-        self.progress_bar.configure(maximum=total_time)
-
-    def populate_song_library(self):
-        # Example songs for the song library
-        songs = ["Song 1", "Song 2", "Song 3"]
-        for song in songs:
-            self.song_listbox.insert("end", song)
+        # Update progress bar length based on the song's duration, read from the file's headers
+        self.progress_bar.configure(maximum=self.core.duration or 1)
 
-    def update_song_library(self):
-        self.song_listbox.delete(0, "end")
-        for song in self.playlist:
-            self.song_listbox.insert("end", os.path.basename(song))
+    @timed("progress_tick")
+    def update_progress_bar(self):
+        # Only keep one pending tick, however often this gets called
+        if self.progress_job is not None:
+            self.master.after_cancel(self.progress_job)
+            self.progress_job = None
 
-    def load_selected_song(self, event):
-        selected_song_index = self.song_listbox.curselection()
-        if selected_song_index:
-            selected_song = self.playlist[selected_song_index[0]]
-            self.load_and_play(selected_song)
+        # A finished track starts the next one, which restarts the tick by itself
+        if self.core.playing and self.core.poll():
+            return
 
-    def update_progress_bar(self):
-        if self.playing:
-            current_time = pygame.mixer.music.get_pos() / 1000  # Convert milliseconds to seconds
+        if self.core.current_track and self.visible:
+            current_time = self.core.position()
             self.progress_bar_var.set(current_time)
-        self.master.after(100, self.update_progress_bar)
 
-# Create the Tkinter window
-root = Tk()
+        # Nothing to do while paused; otherwise come back when the bar has moved about a pixel
+        if self.core.playing:
+            interval = refresh_interval(self.core.duration, self.progress_bar.winfo_width(), self.visible,
+                                        self.core.remaining())
+            self.progress_job = self.master.after(interval, self.update_progress_bar)
+
+
+def main():
+    # Create the Tkinter window
+    root = Tk()
+
+    # Create an instance of the MusicPlayer class
+    music_player = MusicPlayer(root)
+
+    # Latency metrics and UI stall detection, when enabled through the environment
+    instrumentation.start(root)
+
+    # Run the Tkinter event loop
+    root.mainloop()
 
-# Create an instance of the MusicPlayer class
-music_player = MusicPlayer(root)
 
-# Run the Tkinter event loop
-root.mainloop()
+if __name__ == "__main__":
+    main()
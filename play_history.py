@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import zlib
+import struct
+import sqlite3
+import threading
+from collections import Counter
+
+from app_paths import data_path
+from instrumentation import timed
+from session_store import RECORD
+
+# What happened to a track: it started, the listener moved on before the end, or it played out
+PLAYED = "play"
+SKIPPED = "skip"
+COMPLETED = "complete"
+EVENTS = (PLAYED, SKIPPED, COMPLETED)
+
+# Every event is appended to a log as a small checksummed record, in batches written by a
+# thread of its own, so playing a track never waits for the disk. Every so often the log is
+# folded into counters per track and per month (SQLite), then kept as an archive and started
+# afresh, so queries only ever add up the short log written since:
+#   <directory>/log        events not folded in yet
+#   <directory>/log.<n>    the log folded into generation n, kept as a record of everything played
+#   <directory>/counts.db  plays, skips, completions and last played per track; plays per month
+LOG_MAGIC = b"MPHL"
+LOG_HEADER = struct.Struct("<4sQ")  # magic, generation of the counters the log adds to
+
+# How often a batch is written (a crash loses at most this many seconds of history)
+FLUSH_SECONDS = 2.0
+# Fold the log into the counters once it holds this many events
+COMPACT_EVENTS = 2000
+# Paths looked up per query (SQLite limits the number of parameters)
+QUERY_BATCH = 500
+
+
+def month_of(timestamp):
+    return time.strftime("%Y-%m", time.localtime(timestamp))
+
+
+def month_range(month):
+    # The timestamps a month ("2024-05") starts and ends at, local time
+    year, number = (int(part) for part in month.split("-"))
+    return (time.mktime((year, number, 1, 0, 0, 0, 0, 0, -1)),
+            time.mktime((year + number // 12, number % 12 + 1, 1, 0, 0, 0, 0, 0, -1)))
+
+
+def read_log(path):
+    # (generation, events, end of the last intact record), or (None, [], None) for a missing or
+    # foreign log; a record cut short by a crash ends the log
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None, [], None
+    if len(data) < LOG_HEADER.size or data[:4] != LOG_MAGIC:
+        return None, [], None
+    _, generation = LOG_HEADER.unpack_from(data, 0)
+
+    events = []
+    position = LOG_HEADER.size
+    while position + RECORD.size <= len(data):
+        size, checksum = RECORD.unpack_from(data, position)
+        payload = data[position + RECORD.size:position + RECORD.size + size]
+        if len(payload) < size or zlib.crc32(payload) != checksum:
+            break
+        try:
+            timestamp, event, path, seconds = json.loads(payload)
+        except ValueError:
+            break
+        events.append((timestamp, event, path, seconds))
+        position += RECORD.size + size
+    return generation, events, position
+
+
+class PlayHistory:
+    # record() can be called from any thread and only appends to a list; the log and the
+    # counters are written by the history's own thread. Queries add the events not folded in
+    # yet to what the counters say, so they are up to date the moment record() returns.
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.dirname(data_path("history", "log"))
+        os.makedirs(self.directory, exist_ok=True)
+        self.log_path = os.path.join(self.directory, "log")
+
+        # Events not in the counters yet, oldest first; the first _written of them are in the log
+        self._events = []
+        self._written = 0
+        # _lock guards the events and is only ever held briefly, so record() never waits on the
+        # disk; _db_lock is held across a compaction so no query sees events counted twice
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._worker = None
+        self._log = None
+        self._db = None
+        self.generation = 0
+        self._open()
+
+    def _open(self):
+        try:
+            self._db = sqlite3.connect(os.path.join(self.directory, "counts.db"), check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, plays INTEGER, skips INTEGER, "
+                             "completions INTEGER, last_played REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS tracks_last_played ON tracks (last_played)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS months (month TEXT, path TEXT, plays INTEGER, "
+                             "PRIMARY KEY (month, path))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS months_plays ON months (month, plays)")
+            self._db.commit()
+            self.generation = self._db.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"Error opening play history: {e}")
+            self._db = None
+            return
+
+        generation, events, end = read_log(self.log_path)
+        if generation == self.generation:
+            self._log = open(self.log_path, "r+b")
+            # Drop a half-written record at the end, so new ones follow the last good one
+            self._log.truncate(end)
+            self._log.seek(end)
+            self._events = events
+            self._written = len(events)
+        else:
+            if generation is not None:
+                # Folded in already, by a compaction cut short before it could start a new log
+                self._archive(generation)
+            self._start_log()
+
+    def _archive(self, generation):
+        try:
+            os.replace(self.log_path, f"{self.log_path}.{generation}")
+        except OSError as e:
+            print(f"Error archiving play history: {e}")
+
+    def _start_log(self):
+        if self._log is not None:
+            self._log.close()
+        temporary = self.log_path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(LOG_HEADER.pack(LOG_MAGIC, self.generation))
+        os.replace(temporary, self.log_path)
+        self._log = open(self.log_path, "r+b")
+        self._log.seek(0, os.SEEK_END)
+
+    def record(self, event, path, seconds=0.0, timestamp=None):
+        if self._db is None or self._closed.is_set():
+            return
+        with self._lock:
+            self._events.append((timestamp if timestamp is not None else time.time(), event, path, round(seconds, 1)))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, daemon=True)
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            closing = self._closed.wait(FLUSH_SECONDS)
+            self.flush()
+            # Not on every close either, or each run would leave an archive of a few events
+            if self._written >= COMPACT_EVENTS:
+                self.compact()
+            if closing:
+                return
+
+    def flush(self):
+        # Appends everything recorded since the last batch, in one write
+        with self._lock:
+            batch = self._events[self._written:]
+        if not batch or self._log is None:
+            return
+        data = bytearray()
+        for entry in batch:
+            payload = json.dumps(entry, separators=(",", ":")).encode()
+            data += RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+        try:
+            self._log.write(data)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        except OSError as e:
+            print(f"Error writing play history: {e}")
+            return
+        with self._lock:
+            self._written += len(batch)
+
+    @timed("play_history_compact")
+    def compact(self):
+        # Adds the logged events to the counters and moves to the next generation in one
+        # transaction; a crash before the new log is started leaves the old one behind with an
+        # older generation, which is then known to be folded in already
+        with self._lock:
+            events = self._events[:self._written]
+        if not events or self._db is None:
+            return
+        tracks = {}
+        months = Counter()
+        for timestamp, event, path, seconds in events:
+            counts = tracks.setdefault(path, [0, 0, 0, None])
+            if event == PLAYED:
+                counts[0] += 1
+                counts[3] = max(counts[3] or timestamp, timestamp)
+                months[(month_of(timestamp), path)] += 1
+            elif event == SKIPPED:
+                counts[1] += 1
+            elif event == COMPLETED:
+                counts[2] += 1
+
+        with self._db_lock:
+            try:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT INTO tracks VALUES (?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET "
+                        "plays = plays + excluded.plays, skips = skips + excluded.skips, "
+                        "completions = completions + excluded.completions, "
+                        "last_played = max(coalesce(last_played, excluded.last_played), "
+                        "coalesce(excluded.last_played, last_played))",
+                        [(path, *counts) for path, counts in tracks.items()])
+                    self._db.executemany(
+                        "INSERT INTO months VALUES (?, ?, ?) ON CONFLICT (month, path) DO UPDATE SET "
+                        "plays = plays + excluded.plays",
+                        [(month, path, plays) for (month, path), plays in months.items()])
+                    self._db.execute(f"PRAGMA user_version = {self.generation + 1}")
+            except sqlite3.Error as e:
+                print(f"Error compacting play history: {e}")
+                return
+            with self._lock:
+                del self._events[:len(events)]
+                self._written -= len(events)
+
+        folded = self.generation
+        self.generation += 1
+        self._log.close()
+        self._log = None
+        self._archive(folded)
+        try:
+            self._start_log()
+        except OSError as e:
+            print(f"Error writing play history: {e}")
+        # Recorded while the counters were being written, and in no log now
+        self.flush()
+
+    def _pending(self):
+        with self._lock:
+            return list(self._events)
+
+    def most_played(self, month=None, limit=50):
+        # [(path, plays)] for a month ("2024-05", this one by default), most played first
+        month = month or month_of(time.time())
+        start, end = month_range(month)
+        with self._db_lock:
+            if self._db is None:
+                return []
+            pending = Counter(path for timestamp, event, path, _ in self._pending()
+                              if event == PLAYED and start <= timestamp < end)
+            plays = dict(self._db.execute("SELECT path, plays FROM months WHERE month = ? ORDER BY plays DESC LIMIT ?",
+                                          (month, limit)))
+            # Whatever isn't among those can't outplay them, unless it was played since
+            others = [path for path in pending if path not in plays]
+            plays.update(dict.fromkeys(others, 0))
+            for start in range(0, len(others), QUERY_BATCH):
+                batch = others[start:start + QUERY_BATCH]
+                plays.update(self._db.execute(f"SELECT path, plays FROM months WHERE month = ? AND path IN "
+                                              f"({', '.join('?' * len(batch))})", (month, *batch)))
+        for path, count in pending.items():
+            plays[path] += count
+        return sorted(plays.items(), key=lambda item: -item[1])[:limit]
+
+    def recently_played(self, limit=50):
+        # [(path, when last played)], most recent first, each track once
+        with self._db_lock:
+            if self._db is None:
+                return []
+            recent = {}
+            for timestamp, event, path, _ in sorted(self._pending(), reverse=True):
+                if event == PLAYED and path not in recent:
+                    recent[path] = timestamp
+                    if len(recent) == limit:
+                        return list(recent.items())
+            # Tracks played since the last compaction may come up again with an older time
+            rows = self._db.execute("SELECT path, last_played FROM tracks WHERE last_played IS NOT NULL "
+                                    "ORDER BY last_played DESC LIMIT ?", (limit + len(recent),)).fetchall()
+        for path, timestamp in rows:
+            recent.setdefault(path, timestamp)
+        return list(recent.items())[:limit]
+
+    def plays(self):
+        # All time play counts by path
+        with self._db_lock:
+            if self._db is None:
+                return Counter()
+            plays = Counter(dict(self._db.execute("SELECT path, plays FROM tracks")))
+            plays.update(path for _, event, path, _ in self._pending() if event == PLAYED)
+        return plays
+
+    def close(self):
+        # Writes out whatever is left
+        if self._db is None or self._closed.is_set():
+            return
+        self._closed.set()
+        if self._worker is not None:
+            self._worker.join()
+        with self._db_lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            self._db.close()
+            self._db = None
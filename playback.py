@@ -0,0 +1,227 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from playback_clock import PlaybackClock
+from seek_index import FileSlice, seek_position
+
+# pygame takes a while to import, so it is only loaded once something is actually played
+pygame = None
+
+# What poll() reports when the playing track finishes
+ADVANCED = "advanced"
+ENDED = "ended"
+
+# What pygame.mixer.music can play by itself
+MUSIC_EXTENSIONS = (".mp3", ".wav", ".ogg")
+
+
+class PlaybackEngine:
+    # Owns pygame's music stream: the mixer is initialised once, the following track is queued
+    # for gapless playback, and neighbouring tracks have their metadata and art resolved ahead
+    # of time so a skip doesn't have to wait on the disk.
+    def __init__(self, metadata=None, art_loader=None):
+        self.metadata = metadata
+        self.art_loader = art_loader
+        self.current = None
+        self.queued = None
+        self.playing = False
+        self.volume = 1.0
+        # Seconds to fade between tracks, and the equalizer's band gains (None is off); only
+        # engines that process the samples themselves apply them
+        self.crossfade = 0.0
+        self.equalizer = None
+
+        self.clock = PlaybackClock()
+        self.end_event = None
+        self._ready = False
+        self._events = True
+        # The part of a file the music stream is reading, when a seek started it part way in
+        self._slice = None
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def extensions(self):
+        return MUSIC_EXTENSIONS
+
+    @property
+    def processes_audio(self):
+        # Whether crossfade and equalizer settings have any effect
+        return False
+
+    def _init_mixer(self):
+        global pygame
+        if self._ready:
+            return
+        if pygame is None:
+            import pygame
+        pygame.init()
+        pygame.mixer.init()
+        self.end_event = pygame.USEREVENT + 1
+        pygame.mixer.music.set_endevent(self.end_event)
+        self._ready = True
+
+    def play(self, file_path, start=0.0):
+        self._init_mixer()
+        start = self._load(file_path, start)
+        self.clock.start(start)
+        self.current = file_path
+        self.queued = None
+        self.playing = True
+        self._clear_end_event()
+        self._index_later(file_path)
+
+    def _load(self, file_path, start):
+        # Starts file_path `start` seconds in, and returns where it really started
+        seek_index = self.metadata.seek_index(file_path, build=False) if start > 0 and self.metadata is not None else None
+        # The music stream reads from the previous slice until it is replaced, so that one is
+        # only closed after the load
+        previous, self._slice = self._slice, None
+        if seek_index is not None:
+            # Decoding from the first byte of the frame that holds `start`: exact for VBR files,
+            # and no slower for long ones, where SDL would decode or scan up to it
+            offset, start = seek_position(seek_index, file_path, start)
+            self._slice = FileSlice(file_path, offset)
+            pygame.mixer.music.load(self._slice, "mp3")
+            self._close_slice(previous)
+            pygame.mixer.music.set_volume(self.volume)
+            pygame.mixer.music.play()
+            return start
+        pygame.mixer.music.load(file_path)
+        self._close_slice(previous)
+        pygame.mixer.music.set_volume(self.volume)
+        try:
+            pygame.mixer.music.play(start=start)
+        except pygame.error:
+            # Not every format can start part way through
+            start = 0.0
+            pygame.mixer.music.play()
+        return start
+
+    def _close_slice(self, file_slice):
+        if file_slice is not None:
+            file_slice.close()
+
+    def _clear_end_event(self):
+        if self._events:
+            # Drop the end event of whatever was playing before
+            try:
+                pygame.event.clear(self.end_event)
+            except pygame.error:
+                self._events = False
+
+    def _index_later(self, file_path):
+        # Built once per track, off the caller's thread, for the seeks to come
+        if self.metadata is not None:
+            self._prefetch_pool.submit(self._build_seek_index, file_path)
+
+    def _build_seek_index(self, file_path):
+        try:
+            self.metadata.seek_index(file_path)
+        except Exception as e:
+            print(f"Error indexing track: {e}")
+
+    def queue(self, file_path):
+        # Start file_path as soon as the current track ends, without a gap
+        if self.current is None or file_path == self.queued or not self._events:
+            # Without end events a queued track can't be told apart from the current one
+            return
+        try:
+            pygame.mixer.music.queue(file_path)
+            self.queued = file_path
+        except pygame.error as e:
+            print(f"Error queueing track: {e}")
+            self.queued = None
+
+    def set_volume(self, volume):
+        # 0.0 to 1.0, applied to whatever plays from now on
+        self.volume = volume
+        if self._ready:
+            pygame.mixer.music.set_volume(volume)
+
+    def pause(self):
+        if self.current is not None:
+            pygame.mixer.music.pause()
+            self.clock.pause()
+            self.playing = False
+
+    def unpause(self):
+        if self.current is not None:
+            pygame.mixer.music.unpause()
+            self.clock.resume()
+            self.playing = True
+
+    def stop(self):
+        if self.current is not None:
+            pygame.mixer.music.stop()
+            if self._slice is not None:
+                # Stopping keeps the music loaded, and with it the open file
+                pygame.mixer.music.unload()
+                self._slice.close()
+                self._slice = None
+            self.clock.stop()
+            self.current = None
+            self.queued = None
+            self.playing = False
+
+    def get_pos(self):
+        # Seconds into the current track, seeks included
+        return self.clock.position()
+
+    def set_pos(self, seconds):
+        if self.current is None:
+            return
+        if self.metadata is not None and self.metadata.seek_index(self.current, build=False) is not None:
+            # Reloaded from the right frame, which drops the queued track and starts playing
+            seconds = self._load(self.current, seconds)
+            self._clear_end_event()
+            if self.queued is not None:
+                queued, self.queued = self.queued, None
+                self.queue(queued)
+            if not self.playing:
+                pygame.mixer.music.pause()
+            self.clock.seek(seconds)
+            return
+        if os.path.splitext(self.current)[1].lower() == ".mp3":
+            # pygame seeks MP3s relative to the current position, so go back to the start first
+            pygame.mixer.music.rewind()
+        pygame.mixer.music.set_pos(seconds)
+        self.clock.seek(seconds)
+
+    def poll(self):
+        # Returns ADVANCED when the queued track took over, ENDED when playback stopped, else None
+        if not self._ready or self.current is None:
+            return None
+
+        finished = False
+        if self._events:
+            try:
+                finished = bool(pygame.event.get(self.end_event))
+            except pygame.error:
+                # No event queue without a video subsystem, fall back to watching the stream
+                self._events = False
+        if not self._events:
+            finished = self.playing and not pygame.mixer.music.get_busy() and self.queued is None
+
+        if not finished:
+            return None
+        if self.queued is not None:
+            self.current, self.queued = self.queued, None
+            self.clock.start()
+            return ADVANCED
+        self.playing = False
+        self.clock.stop()
+        return ENDED
+
+    def prefetch(self, file_paths):
+        # Warm the metadata cache and art LRU for tracks that are likely to play next
+        for file_path in file_paths:
+            if self.metadata is not None:
+                self._prefetch_pool.submit(self._prefetch_metadata, file_path)
+            if self.art_loader is not None:
+                self.art_loader.prefetch(file_path)
+
+    def _prefetch_metadata(self, file_path):
+        try:
+            self.metadata.get(file_path)
+        except Exception as e:
+            print(f"Error prefetching metadata: {e}")
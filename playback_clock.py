@@ -0,0 +1,65 @@
+import time
+
+# Bounds for the progress refresh interval, in milliseconds
+MIN_INTERVAL_MS = 100
+LABEL_INTERVAL_MS = 1000
+MAX_INTERVAL_MS = 5000
+# How long after the expected end of a track to look for its end event
+END_GRACE_MS = 50
+
+
+class PlaybackClock:
+    # Keeps the playing position itself rather than asking pygame, whose get_pos() only counts
+    # time since play() and knows nothing about seeks
+    def __init__(self, now=time.monotonic):
+        self._now = now
+        self._offset = 0.0
+        self._started = None
+
+    @property
+    def running(self):
+        return self._started is not None
+
+    def start(self, position=0.0):
+        self._offset = position
+        self._started = self._now()
+
+    def pause(self):
+        if self._started is not None:
+            self._offset = self.position()
+            self._started = None
+
+    def resume(self):
+        if self._started is None:
+            self._started = self._now()
+
+    def seek(self, position):
+        self._offset = position
+        if self._started is not None:
+            self._started = self._now()
+
+    def stop(self):
+        self._offset = 0.0
+        self._started = None
+
+    def position(self):
+        if self._started is None:
+            return self._offset
+        return self._offset + self._now() - self._started
+
+
+def refresh_interval(duration, pixels, visible=True, remaining=None, labels=False):
+    # How long until the progress display needs redrawing. There is no point redrawing faster than
+    # the bar can move a pixel (or a time label can change a second), and nothing to redraw while
+    # the window is minimised, except for noticing the track end on time.
+    if not visible:
+        interval = MAX_INTERVAL_MS
+    elif duration and pixels > 1:
+        interval = duration * 1000 / pixels
+        interval = max(MIN_INTERVAL_MS, min(interval, LABEL_INTERVAL_MS if labels else MAX_INTERVAL_MS))
+    else:
+        interval = LABEL_INTERVAL_MS
+
+    if remaining is not None:
+        interval = min(interval, max(remaining * 1000, 0) + END_GRACE_MS)
+    return int(interval)
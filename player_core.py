@@ -0,0 +1,688 @@
+import os
+import sys
+import time
+import queue
+import threading
+import argparse
+
+import instrumentation
+from album_grid import group_albums
+from app_paths import data_path
+from art_cache import ArtCache
+from dsp import EQ_PRESETS, clamp_gains, flat
+from fingerprint import FingerprintCache, Duplicates, find_duplicates, DUPLICATES_SHOW, DUPLICATES_GROUP
+from instrumentation import timed
+from library_columns import LibraryColumns, compile_query, looks_like_query
+from library_scanner import LibraryScanner, AUDIO_EXTENSIONS
+from library_watcher import LibraryWatcher
+from library_view import INSERT, REMOVE, MOVE, RESET
+from loudness import analyze_library, gain_to_volume
+from metadata_cache import MetadataCache
+from play_history import PlayHistory, PLAYED, SKIPPED, COMPLETED
+from playback import PlaybackEngine, ADVANCED
+from playback_clock import refresh_interval
+from playlist import Playlist, REPEAT_MODES, REPEAT_OFF
+from playlist_files import split_entry, is_slice, read_playlist, write_playlist, entry_label, PLAYLIST_EXTENSIONS
+from search_index import SearchIndex
+from session_store import SessionStore, SessionState
+import streaming_engine
+
+# Events passed to PlayerCore listeners
+TRACK_CHANGED = "track"
+STATE_CHANGED = "state"
+
+# How often the playing position is written to the session journal
+POSITION_INTERVAL = 10.0
+
+# Playlist entries added per step of an import
+IMPORT_BATCH = 1000
+
+# How close the next CUE track has to start to where this one ends to simply play on
+SLICE_TOLERANCE = 0.05
+
+
+class PlayerCore:
+    # Everything the player does apart from drawing it. The Tk windows (and anything else that
+    # wants to drive playback) call into this and listen for TRACK_CHANGED / STATE_CHANGED.
+    # Nothing here imports pygame, eyed3 or PIL until they are actually needed.
+    def __init__(self, metadata=None, art_loader=None, art_cache=None):
+        self.metadata = metadata if metadata is not None else MetadataCache(data_path("metadata.db"))
+        # Covers scaled for the album grid and the now playing view, filled in by scans
+        self.art_cache = art_cache if art_cache is not None else ArtCache(data_path("art"))
+        self.playlist = Playlist()
+        self.search_index = SearchIndex()
+        # Tags as NumPy columns for smart playlists, built the first time one is asked for
+        self.columns = LibraryColumns(self.playlist, self.metadata.peek)
+        # Streaming through our own decoders when they can handle everything, else pygame's music stream
+        engine = streaming_engine.StreamingEngine if streaming_engine.available() else PlaybackEngine
+        self.engine = engine(self.metadata, art_loader)
+
+        self.current_track = None
+        self.track_info = None
+        # Where the current entry starts and ends in its file; only a CUE track doesn't span all of it
+        self.span = (0.0, None)
+        self.playing = False
+        self.volume = 1.0
+        self.normalize = True
+        self._listeners = []
+        self._analysis = None
+        # Duplicates found by the last fingerprint search, and how the library shows them
+        self.duplicates = None
+        self.duplicate_mode = DUPLICATES_SHOW
+        self.fingerprinted = 0
+        self._fingerprinting = None
+        # Library folders kept in step with the disk, and the changes found there
+        self.folders = []
+        self.watcher = None
+        self._library_changes = queue.Queue()
+        # Where to start the restored track when play is pressed
+        self.resume_position = 0.0
+        self.session = None
+        self._position_saved = 0.0
+        # What was played, skipped and played out, once open_history() is called; _listening is
+        # set while the current track's play hasn't been recorded as skipped or completed yet
+        self.history = None
+        self._listening = False
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, event):
+        for listener in self._listeners:
+            listener(event)
+
+    @property
+    def extensions(self):
+        return self.engine.extensions
+
+    def file_types(self):
+        # For Tk file dialogs
+        return [("Audio Files", tuple("*" + extension for extension in self.extensions))]
+
+    @property
+    def duration(self):
+        return self.track_info.duration if self.track_info else 0.0
+
+    def position(self):
+        if not self.current_track:
+            return 0.0
+        return self.engine.get_pos() - self.span[0] if self.engine.current is not None else self.resume_position
+
+    def remaining(self):
+        # Seconds until the current track should end, or None when its length is unknown
+        if not self.current_track or not self.duration:
+            return None
+        return self.duration - self.position()
+
+    @timed("library_add")
+    def add_tracks(self, file_paths, parse=True, new_only=False):
+        # parse=False indexes tracks that aren't in memory by file name alone, without touching the disk.
+        # new_only=True leaves out tracks already in the library, e.g. when a folder is scanned again.
+        if new_only:
+            file_paths = [path for path in dict.fromkeys(file_paths) if path not in self.playlist]
+        file_paths = list(file_paths)
+        for file_path in file_paths:
+            # Scanned tracks are already in memory; a single picked file is cheap to parse here
+            info = self.metadata.peek(file_path)
+            if info is None and parse:
+                info = self.metadata.get(file_path)
+            self.search_index.add(file_path, info)
+        self.playlist.extend(file_paths)
+        self.queue_next_track()
+
+    def import_playlist(self, path):
+        # Adds the entries of an M3U, PLS or CUE file a batch at a time, yielding each batch, so the
+        # caller can keep a window responsive while a huge playlist streams in. Files aren't
+        # checked here; a missing one only fails when it is played.
+        sources = {}
+        batch = []
+        for entry in read_playlist(path):
+            if is_slice(entry.path):
+                self._put_slice_info(entry, sources)
+            batch.append(entry.path)
+            if len(batch) >= IMPORT_BATCH:
+                self.add_tracks(batch, parse=False)
+                yield batch
+                batch = []
+        if batch:
+            self.add_tracks(batch, parse=False)
+            yield batch
+        self.metadata.commit()
+
+    def _put_slice_info(self, entry, sources):
+        # CUE tracks get their title and length from the sheet; the file they are part of is
+        # looked at once per sheet, not once per track
+        source, start, end = split_entry(entry.path)
+        if source not in sources:
+            info = self.metadata.get(source)
+            sources[source] = info
+        info = sources[source]
+        if info is None:
+            return
+        length = (end if end is not None else info.duration) - start
+        self.metadata.put(info._replace(path=entry.path, duration=max(0.0, length), title=entry.title or info.title,
+                                        artist=entry.artist or info.artist), commit=False)
+
+    def export_playlist(self, path):
+        write_playlist(path, list(self.playlist), self.metadata.peek)
+
+    def entry_label(self, path):
+        return entry_label(path, self.metadata.peek(path) if is_slice(path) else None)
+
+    def albums(self):
+        # The library by album, for the album grid
+        return group_albums(self.playlist, self.metadata.peek)
+
+    def analyze_loudness(self):
+        # Measure tracks without a gain in the background, one process per core
+        if self._analysis is not None and self._analysis.is_alive():
+            return
+        self._analysis = threading.Thread(target=self._analyze_loudness, args=(list(self.playlist),), daemon=True)
+        self._analysis.start()
+
+    def _analyze_loudness(self, paths):
+        try:
+            analyze_library(paths, self.metadata)
+        except Exception as e:
+            print(f"Error analysing loudness: {e}")
+
+    def watch_folder(self, folder):
+        # Picks up new, changed and deleted tracks under folder from now on; call it once the
+        # folder's tracks are in the library, e.g. after it was scanned
+        folder = os.path.abspath(folder)
+        if folder in self.folders:
+            return
+        self.folders.append(folder)
+        self._journal("folder", folder)
+        self._start_watching(folder)
+
+    def _start_watching(self, folder):
+        if self.watcher is None:
+            self.watcher = LibraryWatcher(self.metadata, lambda infos, removed: self._library_changes.put((infos, removed)),
+                                          extensions=self.extensions, art_cache=self.art_cache)
+        prefix = folder + os.sep
+        known = {}
+        for path in self.playlist:
+            if path.startswith(prefix) and not is_slice(path):
+                info = self.metadata.peek(path)
+                if info is not None:
+                    known[path] = (info.size, info.mtime)
+        self.watcher.watch(folder, known)
+
+    def apply_library_changes(self):
+        # Applies whatever the watcher found since the last call, returning whether anything changed;
+        # to be called now and then from the thread that owns the playlist
+        applied = False
+        while True:
+            try:
+                infos, removed = self._library_changes.get_nowait()
+            except queue.Empty:
+                return applied
+            self._apply_library_changes(infos, removed)
+            applied = True
+
+    def _apply_library_changes(self, infos, removed):
+        added = []
+        for info in infos:
+            if info.path in self.search_index:
+                # Retagged: the same entries, new text to search and show
+                self.search_index.update(info.path, info)
+                self.columns.update(info)
+                if info.path == self.current_track:
+                    self.track_info = info
+                    self._notify(TRACK_CHANGED)
+            else:
+                added.append(info.path)
+        if added:
+            self.add_tracks(added)
+
+        if removed:
+            removed = set(removed)
+            positions = [index for index, path in enumerate(self.playlist) if path in removed]
+            # Runs of neighbouring entries go in one step, from the end so earlier positions hold
+            runs = []
+            for index in positions:
+                if runs and runs[-1][0] + runs[-1][1] == index:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([index, 1])
+            for index, count in reversed(runs):
+                for path in self.playlist[index:index + count]:
+                    self.search_index.remove(path)
+                self.playlist.remove_at(index, count)
+
+    def find_duplicates(self):
+        # Fingerprint the library in the background; self.duplicates is set once it is done
+        if self.searching_duplicates():
+            return
+        self.fingerprinted = 0
+        self._fingerprinting = threading.Thread(target=self._find_duplicates, args=(list(self.playlist),), daemon=True)
+        self._fingerprinting.start()
+
+    def searching_duplicates(self):
+        return self._fingerprinting is not None and self._fingerprinting.is_alive()
+
+    def _find_duplicates(self, paths):
+        cache = None
+        try:
+            cache = FingerprintCache(data_path("fingerprints.db"))
+            self.duplicates = Duplicates(find_duplicates(paths, cache, self.metadata, on_track=self._fingerprinted))
+        except Exception as e:
+            print(f"Error finding duplicates: {e}")
+        finally:
+            if cache is not None:
+                cache.close()
+
+    def _fingerprinted(self, path):
+        self.fingerprinted += 1
+
+    def arrange_duplicates(self, tracks):
+        if self.duplicates is None:
+            return list(tracks)
+        return self.duplicates.arrange(tracks, self.duplicate_mode)
+
+    def duplicate_label(self, path):
+        # Extra copies are indented under the one kept when duplicates are grouped
+        label = self.entry_label(path)
+        if self.duplicate_mode == DUPLICATES_GROUP and self.duplicates is not None and self.duplicates.is_duplicate(path):
+            return "    = " + label
+        return label
+
+    def track_volume(self, info):
+        if not self.normalize or info is None:
+            return self.volume
+        # Album gain keeps an album's quiet songs quiet, unless shuffle mixes albums together
+        gain = info.album_gain if info.album_gain is not None and not self.playlist.shuffle else info.track_gain
+        return self.volume * gain_to_volume(gain, info.track_peak)
+
+    def restore_session(self, store=None):
+        # Picks up the library and playlist where the last run left off: the snapshot is mapped
+        # rather than parsed, then the journal written since is replayed on top of it. Changes
+        # from here on are journaled as they happen.
+        self.session = store if store is not None else SessionStore()
+        records = self.session.load()
+        snapshot = self.session.snapshot
+        if snapshot is not None:
+            self.metadata.attach(snapshot)
+            state = snapshot.state()
+            self.search_index = snapshot.search_index()
+            if self.search_index is None:
+                self.search_index = SearchIndex()
+                for path in state.playlist:
+                    self.search_index.add(path, self.metadata.peek(path))
+            self.playlist.restore(state.playlist, state.cursor, state.shuffle, state.order, state.repeat)
+            self.volume = state.volume
+            self.current_track = state.current
+            self.resume_position = state.position
+            self.folders = list(state.folders)
+            self._apply_settings(state.settings)
+        for record in records:
+            try:
+                self._replay(*record)
+            except (TypeError, ValueError, IndexError) as e:
+                print(f"Error replaying session: {e}")
+                break
+
+        self.playlist.add_listener(self._record_change)
+        for folder in self.folders:
+            self._start_watching(folder)
+        if self.current_track:
+            self.track_info = self.metadata.peek(self.current_track)
+            self._notify(TRACK_CHANGED)
+        self._notify(STATE_CHANGED)
+
+    def _replay(self, kind, *args):
+        if kind == INSERT:
+            index, paths = args
+            for path in paths:
+                self.search_index.add(path, self.metadata.peek(path) or self.metadata.get(path))
+            if index == len(self.playlist):
+                self.playlist.extend(paths)
+            else:
+                for offset, path in enumerate(paths):
+                    self.playlist.insert(index + offset, path)
+        elif kind == REMOVE:
+            index, count = args
+            for path in self.playlist[index:index + count]:
+                self.search_index.remove(path)
+            self.playlist.remove_at(index, count)
+        elif kind == MOVE:
+            self.playlist.move(*args)
+        elif kind == RESET:
+            paths, = args
+            self.search_index.clear()
+            for path in paths:
+                self.search_index.add(path, self.metadata.peek(path) or self.metadata.get(path))
+            self.playlist.reset(paths)
+        elif kind == "track":
+            self.playlist.cursor, self.current_track = args
+            self.resume_position = 0.0
+        elif kind == "position":
+            self.resume_position, = args
+        elif kind == "shuffle":
+            self.playlist.set_shuffle(*args)
+        elif kind == "repeat":
+            self.playlist.set_repeat(*args)
+        elif kind == "volume":
+            self.volume, = args
+        elif kind == "crossfade":
+            self.engine.crossfade, = args
+        elif kind == "equalizer":
+            self.engine.equalizer = clamp_gains(args[0]) if args[0] else None
+        elif kind == "folder":
+            if args[0] not in self.folders:
+                self.folders.append(args[0])
+
+    def _record_change(self, kind, index, value):
+        if kind == INSERT:
+            self._journal(INSERT, index, self.playlist[index:index + value])
+        elif kind == REMOVE:
+            self._journal(REMOVE, index, value)
+        elif kind == MOVE:
+            self._journal(MOVE, index, value)
+        elif kind == RESET:
+            self._journal(RESET, list(self.playlist))
+
+    def _journal(self, *change):
+        if self.session is None:
+            return
+        self.session.record(*change)
+        if self.session.needs_compaction:
+            self.save_session(background=True)
+
+    def _journal_position(self):
+        self._position_saved = time.monotonic()
+        if self.current_track:
+            self._journal("position", round(self.position(), 2))
+
+    def save_session(self, background=False):
+        # Folds everything into a fresh snapshot; called on exit and, in the background, when
+        # the journal gets long. Metadata is looked up from the snapshot's thread (TrackInfo
+        # tuples never change, only get replaced); what can change in place is copied here.
+        if self.session is None:
+            return
+        playlist = self.playlist
+        state = SessionState(list(playlist), playlist.cursor, playlist.shuffle, playlist.order, playlist.repeat,
+                             self.current_track, self.position(), self.volume, list(self.folders), self.settings())
+        search_index = self.search_index.copy() if background else self.search_index
+        self.session.save(state, self.metadata.peek, search_index, background=background)
+
+    def open_history(self, history=None):
+        self.history = history if history is not None else PlayHistory()
+        # Play counts for smart playlists ("plays > 10")
+        self.columns.set_plays(self.history.plays())
+
+    def close_history(self):
+        if self.history is not None:
+            self.history.close()
+
+    def recently_played(self, limit=100):
+        if self.history is None:
+            return []
+        return self._in_library(path for path, _ in self.history.recently_played(limit))
+
+    def most_played(self, month=None, limit=100):
+        # This month's unless another ("2024-05") is given
+        if self.history is None:
+            return []
+        return self._in_library(path for path, _ in self.history.most_played(month, limit))
+
+    def _in_library(self, paths):
+        # Played tracks that have since left the library aren't shown
+        library = set(self.playlist)
+        return [path for path in paths if path in library]
+
+    def _end_listening(self, event, seconds):
+        # How the current track's play ended: skipped, or played to its end
+        if self._listening and self.history is not None:
+            self.history.record(event, self.current_track, seconds)
+        self._listening = False
+
+    def settings(self):
+        return {"crossfade": self.engine.crossfade, "equalizer": self.engine.equalizer}
+
+    def _apply_settings(self, settings):
+        settings = settings or {}
+        try:
+            self.engine.crossfade = max(0.0, float(settings.get("crossfade") or 0.0))
+            gains = settings.get("equalizer")
+            self.engine.equalizer = clamp_gains(gains) if gains else None
+        except (TypeError, ValueError) as e:
+            print(f"Error restoring sound settings: {e}")
+
+    def set_crossfade(self, seconds):
+        # Fade this many seconds between tracks (0 for none), whether they change by themselves or are picked
+        self.engine.crossfade = max(0.0, float(seconds))
+        self._journal("crossfade", self.engine.crossfade)
+
+    def set_equalizer(self, gains):
+        # Band gains in dB for dsp.EQ_BANDS, the name of one of dsp.EQ_PRESETS, or None for off
+        if isinstance(gains, str):
+            gains = EQ_PRESETS[gains]
+        gains = clamp_gains(gains) if gains is not None else None
+        self.engine.equalizer = None if gains is None or flat(gains) else gains
+        self._journal("equalizer", self.engine.equalizer)
+
+    def equalizer_preset(self):
+        # Name of the preset the equalizer is set to, "flat" when it is off, None for custom gains
+        gains = self.engine.equalizer or EQ_PRESETS["flat"]
+        return next((name for name, preset in EQ_PRESETS.items() if clamp_gains(preset) == tuple(gains)), None)
+
+    def set_volume(self, volume):
+        self.volume = max(0.0, min(1.0, volume))
+        self.engine.set_volume(self.track_volume(self.track_info))
+        self._journal("volume", self.volume)
+
+    def start_remote(self, port=None):
+        # HTTP and WebSocket remote control (remote_api), on when a port is given or
+        # MUSIC_PLAYER_REMOTE_PORT is set. Whoever owns this core has to call process() on the
+        # returned server regularly, that is where the commands run.
+        port = port if port is not None else os.environ.get("MUSIC_PLAYER_REMOTE_PORT")
+        if port is None or port == "":
+            return None
+        # asyncio takes as long to import as everything else here, so only when it is wanted
+        import remote_api
+        return remote_api.start(self, port)
+
+    def search(self, query, limit=None):
+        # Words to find, or a smart playlist such as "genre = jazz and year < 1970 sorted by album"
+        # (library_columns); raises ValueError for a query that doesn't parse
+        if looks_like_query(query):
+            paths = self.columns.select(compile_query(query))
+            return paths[:limit] if limit is not None else paths
+        return self.search_index.search(query, limit)
+
+    def toggle_play(self):
+        if self.current_track and self.engine.current is None:
+            # Nothing loaded yet, e.g. the track restored from the last session
+            self.load_and_play(self.current_track, self.resume_position)
+        elif self.current_track:
+            if not self.playing:
+                self.engine.unpause()
+                self.playing = True
+            else:
+                self.engine.pause()
+                self.playing = False
+                self._journal_position()
+            self._notify(STATE_CHANGED)
+
+    def stop(self):
+        self._end_listening(SKIPPED, self.position())
+        self.engine.stop()
+        self.playing = False
+        self.resume_position = 0.0
+        self._journal("position", 0.0)
+        self._notify(STATE_CHANGED)
+
+    def play_next(self):
+        index = self.playlist.advance()
+        if index is not None:
+            self.load_and_play(self.playlist[index])
+
+    def play_previous(self):
+        index = self.playlist.retreat()
+        if index is not None:
+            self.load_and_play(self.playlist[index])
+
+    def play_index(self, index):
+        self.load_and_play(self.playlist.select(index))
+
+    @timed("load_and_play")
+    def load_and_play(self, file_path, start=0.0):
+        self._end_listening(SKIPPED, self.position())
+        # The gain is set before the track starts so its first moments aren't at the old level
+        self.engine.set_volume(self.track_volume(self.metadata.get(file_path)))
+        # A CUE track is its file, seeked to where the track starts
+        source, offset, _ = split_entry(file_path)
+        self.engine.play(source, offset + start)
+        self.playing = True
+        self.show_track(file_path)
+        self.queue_next_track()
+        self._notify(STATE_CHANGED)
+
+    def show_track(self, file_path):
+        self.current_track = file_path
+        self.span = split_entry(file_path)[1:]
+        self.track_info = self.metadata.get(file_path)
+        self.engine.set_volume(self.track_volume(self.track_info))
+        self.columns.count_play(file_path)
+        if self.history is not None:
+            self.history.record(PLAYED, file_path)
+            self._listening = True
+        self._journal("track", self.playlist.cursor, file_path)
+        self._position_saved = time.monotonic()
+        self._notify(TRACK_CHANGED)
+
+    def seek(self, seconds):
+        if self.current_track and self.engine.current is None:
+            self.resume_position = seconds
+            self._journal_position()
+        elif self.current_track:
+            self.engine.set_pos(self.span[0] + seconds)
+            self._journal_position()
+
+    def toggle_shuffle(self):
+        self.playlist.set_shuffle(not self.playlist.shuffle)
+        self._journal("shuffle", self.playlist.shuffle)
+        self.queue_next_track()
+        return self.playlist.shuffle
+
+    def cycle_repeat(self):
+        mode = self.playlist.cycle_repeat()
+        self._journal("repeat", mode)
+        self.queue_next_track()
+        return mode
+
+    def queue_next_track(self):
+        # Queue the next track for gapless playback and warm up both neighbours
+        next_index = self.playlist.next_index(auto=True)
+        # The engine can only queue whole files, so CUE tracks are switched in poll() instead
+        if next_index is not None and self.span[1] is None and not is_slice(self.playlist[next_index]):
+            self.engine.queue(self.playlist[next_index])
+        neighbours = [self.playlist.next_index(), self.playlist.previous_index()]
+        self.engine.prefetch([self.playlist[index] for index in neighbours if index is not None])
+
+    def poll(self):
+        # Call regularly while playing. Returns True when a track had to be (re)started or
+        # playback stopped, False when nothing changed or the queued track simply took over.
+        finished_at = self.position()
+        status = self.engine.poll()
+        if status is None:
+            if self.span[1] is not None and self.playing and self.engine.get_pos() >= self.span[1]:
+                return self._end_slice()
+            if self.playing and time.monotonic() - self._position_saved > POSITION_INTERVAL:
+                self._journal_position()
+            return False
+
+        self._end_listening(COMPLETED, finished_at)
+        index = self.playlist.advance(auto=True)
+        if status == ADVANCED and index is not None and self.playlist[index] == self.engine.current:
+            # The end event is only seen on the next poll, so the new track has already been playing a little
+            if self.duration and finished_at > self.duration:
+                self.engine.clock.seek(finished_at - self.duration)
+            self.show_track(self.engine.current)
+            self.queue_next_track()
+            return False
+
+        # Either playback stopped, or the queued track is no longer what the playlist wants next
+        if index is None:
+            self.stop()
+        else:
+            self.load_and_play(self.playlist[index])
+        return True
+
+    def _end_slice(self):
+        # The current CUE track reached its end while its file plays on
+        self._end_listening(COMPLETED, self.position())
+        index = self.playlist.advance(auto=True)
+        if index is None:
+            self.stop()
+            return True
+        following = self.playlist[index]
+        source, start, _ = split_entry(following)
+        if following != self.current_track and source == self.engine.current and abs(start - self.span[1]) < SLICE_TOLERANCE:
+            # The next track of the same sheet: keep playing, only the track changes
+            self.show_track(following)
+            self.queue_next_track()
+            return False
+        self.load_and_play(following)
+        return True
+
+
+def collect_tracks(paths, metadata, extensions=AUDIO_EXTENSIONS):
+    tracks = []
+    for path in paths:
+        if os.path.isdir(path):
+            scanner = LibraryScanner(metadata, lambda batch: tracks.extend(info.path for info in batch), extensions=extensions)
+            scanner.start([path])
+            scanner.join()
+        elif os.path.splitext(path)[1].lower() in PLAYLIST_EXTENSIONS:
+            tracks.extend(entry.path for entry in read_playlist(path))
+        elif os.path.isfile(path):
+            tracks.append(path)
+    return tracks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play tracks without opening a window")
+    parser.add_argument("paths", nargs="*", help="audio files, folders or playlists to play")
+    parser.add_argument("--shuffle", action="store_true")
+    parser.add_argument("--repeat", choices=REPEAT_MODES, default=REPEAT_OFF)
+    parser.add_argument("--remote", type=int, metavar="PORT", help="take commands over HTTP and WebSocket on this port")
+    args = parser.parse_args(argv)
+
+    instrumentation.start()
+    core = PlayerCore()
+    core.open_history()
+    core.add_listener(lambda event: event == TRACK_CHANGED and print(f"Now playing: {core.entry_label(core.current_track)}"))
+    core.playlist.set_repeat(args.repeat)
+    core.add_tracks(collect_tracks(args.paths, core.metadata, core.extensions))
+    if args.shuffle:
+        core.toggle_shuffle()
+    # With remote control it keeps running, waiting for commands, after the playlist is done
+    remote = core.start_remote(args.remote)
+    if not core.playlist and remote is None:
+        print("No tracks to play")
+        return 1
+
+    if core.playlist:
+        core.play_next()
+    try:
+        while core.playing or remote is not None:
+            # Nothing to draw, so only wake up around the end of each track (or for remote commands)
+            timeout = refresh_interval(core.duration, 0, visible=False, remaining=core.remaining()) / 1000
+            if remote is not None:
+                remote.process(timeout)
+            else:
+                time.sleep(timeout)
+            if core.playing:
+                core.poll()
+    except KeyboardInterrupt:
+        core.stop()
+    finally:
+        core.close_history()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+import queue
+from tkinter import StringVar, DoubleVar, filedialog, Scrollbar, Canvas, Menu, Toplevel, EventType
+
+from album_grid import AlbumGrid, CELL_WIDTH, CELL_HEIGHT
+from dsp import CROSSFADE_CHOICES, EQ_PRESETS
+from fingerprint import DUPLICATE_MODES, DUPLICATES_SHOW
+from library_scanner import LibraryScanner
+from library_view import LibraryModel
+from player_core import TRACK_CHANGED, STATE_CHANGED
+from playlist_files import ExistenceChecker, PLAYLIST_FILE_TYPES
+
+
+class PlayerWindow:
+    # What the player windows share apart from their layout: the menus, scanning, importing and
+    # searching, the playback controls, and the polling that brings work done on other threads onto
+    # the Tk thread. A window calls attach() before building its widgets and start() once they are all
+    # there, and draws the track and its progress in its own show_track() and update_progress_bar().
+    def attach(self, master, core):
+        self.master = master
+        self.scanner = None
+        self.scan_results = queue.Queue()
+        self.scanned_folder = None
+        self.album_window = None
+        self.progress_job = None
+        self.visible = True
+
+        # Playback and the playlist live in the UI-free core, the window only draws them
+        self.core = core
+        self.core.add_listener(self.on_player_event)
+        self.playlist = self.core.playlist
+
+        # Imported playlists show at once; entries whose file is gone are marked as they are found
+        self.file_checker = ExistenceChecker(master, self.on_missing_files)
+        self.import_batches = None
+        self.imported = 0
+
+    def build_playlist_menu(self):
+        self.playlist_menu = Menu(self.master, tearoff=0)
+        self.playlist_menu.add_command(label="Import Playlist...", command=self.import_playlist)
+        self.playlist_menu.add_command(label="Export Playlist...", command=self.export_playlist)
+        self.playlist_menu.add_command(label="Albums...", command=self.show_albums)
+        self.playlist_menu.add_command(label="Recently Played", command=self.show_recently_played)
+        self.playlist_menu.add_command(label="Most Played This Month", command=self.show_most_played)
+        # Other copies of the same recording, found by how they sound rather than by their tags
+        self.playlist_menu.add_separator()
+        self.playlist_menu.add_command(label="Find Duplicates", command=self.find_duplicates)
+        self.duplicate_mode = StringVar(value=DUPLICATES_SHOW)
+        for mode in DUPLICATE_MODES:
+            self.playlist_menu.add_radiobutton(label=f"Duplicates: {mode.title()}", value=mode, variable=self.duplicate_mode,
+                                               command=self.set_duplicate_mode)
+
+    def build_sound_menu(self):
+        # Crossfade and equalizer, applied by the engine that decodes the audio itself
+        self.sound_menu = Menu(self.master, tearoff=0)
+        self.crossfade_var = DoubleVar(value=0.0)
+        for seconds in CROSSFADE_CHOICES:
+            self.sound_menu.add_radiobutton(label=f"Crossfade: {seconds:g} s" if seconds else "Crossfade: Off", value=seconds,
+                                            variable=self.crossfade_var, command=self.set_crossfade)
+        self.sound_menu.add_separator()
+        self.equalizer_var = StringVar(value="flat")
+        for name in EQ_PRESETS:
+            self.sound_menu.add_radiobutton(label=f"Equalizer: {name.title()}", value=name, variable=self.equalizer_var,
+                                            command=self.set_equalizer)
+        if not self.core.engine.processes_audio:
+            self.sound_button.state(["disabled"])
+
+    def start(self):
+        # Stop redrawing the progress while the window is minimised
+        self.master.bind("<Unmap>", self.on_visibility_change)
+        self.master.bind("<Map>", self.on_visibility_change)
+
+        # Back to the library, playlist and track of the last run; saved again on close
+        self.core.restore_session()
+        self.core.open_history()
+        self.shuffle_button.configure(text="Shuffle: On" if self.playlist.shuffle else "Shuffle: Off")
+        self.repeat_button.configure(text=f"Repeat: {self.playlist.repeat.title()}")
+        self.crossfade_var.set(self.core.engine.crossfade)
+        self.equalizer_var.set(self.core.equalizer_preset() or "")
+        self.update_progress_bar()
+        self.file_checker.check(list(self.playlist))
+        self.poll_library_changes()
+        # Remote control, when MUSIC_PLAYER_REMOTE_PORT is set
+        self.remote = self.core.start_remote()
+        if self.remote is not None:
+            self.poll_remote()
+        self.master.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def on_close(self):
+        self.core.save_session()
+        self.core.close_history()
+        self.master.destroy()
+
+    def select_track(self):
+        file_path = filedialog.askopenfilename(filetypes=self.core.file_types())
+        if file_path:
+            self.core.add_tracks([file_path])
+            self.on_search()
+            if not self.core.current_track:
+                self.core.play_index(len(self.playlist) - 1)
+
+    def show_playlist_menu(self):
+        button = self.playlist_button
+        self.playlist_menu.tk_popup(button.winfo_rootx(), button.winfo_rooty() + button.winfo_height())
+
+    def show_albums(self):
+        # The album grid, in a window of its own that is hidden rather than closed
+        if self.album_window is None:
+            self.album_window = Toplevel(self.master)
+            self.album_window.title("Albums")
+            self.album_window.protocol("WM_DELETE_WINDOW", self.album_window.withdraw)
+            canvas = Canvas(self.album_window, width=CELL_WIDTH * 5, height=CELL_HEIGHT * 3, bd=0, highlightthickness=0,
+                            background="black")
+            scrollbar = Scrollbar(self.album_window, orient="vertical")
+            scrollbar.pack(side="right", fill="y")
+            canvas.pack(side="left", fill="both", expand=True)
+            self.album_grid = AlbumGrid(canvas, self.core.art_cache, self.open_album, scrollbar=scrollbar)
+        else:
+            self.album_window.deiconify()
+        self.album_grid.set_albums(self.core.albums())
+
+    def open_album(self, album):
+        # The album's tracks in the library list, playing from the first
+        self.library_view.set_model(LibraryModel(album.paths))
+        # From the first of its tracks still in the library; the watcher may have removed some
+        for path in album.paths:
+            index = self.playlist.index_of(path)
+            if index is not None:
+                self.core.play_index(index)
+                break
+
+    def show_recently_played(self):
+        self.library_view.set_model(LibraryModel(self.core.recently_played()))
+
+    def show_most_played(self):
+        self.library_view.set_model(LibraryModel(self.core.most_played()))
+
+    def import_playlist(self):
+        file_path = filedialog.askopenfilename(filetypes=PLAYLIST_FILE_TYPES)
+        if file_path:
+            self.import_batches = self.core.import_playlist(file_path)
+            self.imported = 0
+            self.poll_import()
+
+    def poll_import(self):
+        # One batch per turn of the event loop, so a long playlist fills in while it is read
+        try:
+            batch = next(self.import_batches)
+        except StopIteration:
+            self.scan_status_label["text"] = f"Imported {self.imported} tracks"
+            return
+        except (OSError, ValueError) as e:
+            print(f"Error importing playlist: {e}")
+            self.scan_status_label["text"] = f"Import failed after {self.imported} tracks"
+            return
+        self.imported += len(batch)
+        self.file_checker.check(batch)
+        self.on_search()
+        self.scan_status_label["text"] = f"Importing... {self.imported} tracks"
+        self.master.after(1, self.poll_import)
+
+    def export_playlist(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".m3u8", filetypes=PLAYLIST_FILE_TYPES)
+        if file_path:
+            try:
+                self.core.export_playlist(file_path)
+            except (OSError, ValueError) as e:
+                print(f"Error exporting playlist: {e}")
+
+    def find_duplicates(self):
+        if not self.core.searching_duplicates():
+            self.core.find_duplicates()
+            self.poll_duplicates()
+
+    def set_duplicate_mode(self):
+        self.core.duplicate_mode = self.duplicate_mode.get()
+        if self.core.duplicate_mode != DUPLICATES_SHOW and self.core.duplicates is None:
+            self.find_duplicates()
+        self.on_search()
+
+    def poll_duplicates(self):
+        if self.core.searching_duplicates():
+            self.scan_status_label["text"] = f"Finding duplicates... {self.core.fingerprinted} tracks fingerprinted"
+            self.master.after(500, self.poll_duplicates)
+            return
+        if self.core.duplicates is None:
+            self.scan_status_label["text"] = "Finding duplicates failed"
+            return
+        self.scan_status_label["text"] = f"Found {len(self.core.duplicates)} duplicates"
+        self.on_search()
+
+    def entry_label(self, path):
+        label = self.core.duplicate_label(path)
+        return f"(missing) {label}" if path in self.file_checker.missing else label
+
+    def on_missing_files(self, paths):
+        self.library_view.schedule_render()
+
+    def scan_folder(self):
+        if self.scanner and self.scanner.running:
+            self.scanner.cancel()
+            return
+
+        folder = filedialog.askdirectory()
+        if folder:
+            self.scanner = LibraryScanner(self.core.metadata, self.scan_results.put, extensions=self.core.extensions,
+                                          art_cache=self.core.art_cache)
+            self.scanner.start([folder])
+            self.scanned_folder = folder
+            self.scan_button.configure(text="Cancel Scan")
+            self.poll_scan_results()
+
+    def poll_scan_results(self):
+        # The scanner runs on its own threads, so its batches are picked up here on the Tk thread
+        while True:
+            try:
+                batch = self.scan_results.get_nowait()
+            except queue.Empty:
+                break
+            # Scanning a folder again reports the tracks already in the library too
+            self.core.add_tracks((info.path for info in batch), new_only=True)
+            self.on_search()
+
+        scanner = self.scanner
+        status = f"{scanner.files_found} files, {scanner.files_per_second:.0f} files/s"
+        if scanner.running or not self.scan_results.empty():
+            self.scan_status_label["text"] = f"Scanning... {status}"
+            self.master.after(200, self.poll_scan_results)
+        else:
+            self.scan_status_label["text"] = ("Scan cancelled: " if scanner.cancelled else "Scan finished: ") + status
+            if not scanner.cancelled:
+                # Volume normalization for whatever the scan found that has no gain yet
+                self.core.analyze_loudness()
+                # From now on the folder's changes on disk show up by themselves
+                self.core.watch_folder(self.scanned_folder)
+            self.scan_button.configure(text="Scan Folder")
+
+    def poll_library_changes(self):
+        # Tracks added, retagged or deleted in the watched folders
+        if self.core.apply_library_changes():
+            if self.library_view.model is self.playlist:
+                self.library_view.schedule_render()
+            else:
+                self.on_search()
+        self.master.after(500, self.poll_library_changes)
+
+    def poll_remote(self):
+        # Commands from remote clients run here, on the Tk thread
+        self.remote.process()
+        self.master.after(50, self.poll_remote)
+
+    def toggle_play(self):
+        self.core.toggle_play()
+
+    def toggle_shuffle(self):
+        shuffle = self.core.toggle_shuffle()
+        self.shuffle_button.configure(text="Shuffle: On" if shuffle else "Shuffle: Off")
+
+    def show_sound_menu(self):
+        button = self.sound_button
+        self.sound_menu.tk_popup(button.winfo_rootx(), button.winfo_rooty() + button.winfo_height())
+
+    def set_crossfade(self):
+        self.core.set_crossfade(self.crossfade_var.get())
+
+    def set_equalizer(self):
+        self.core.set_equalizer(self.equalizer_var.get())
+
+    def cycle_repeat(self):
+        mode = self.core.cycle_repeat()
+        self.repeat_button.configure(text=f"Repeat: {mode.title()}")
+
+    def play_next(self):
+        self.core.play_next()
+
+    def play_previous(self):
+        self.core.play_previous()
+
+    def on_player_event(self, event):
+        if event == TRACK_CHANGED:
+            self.show_track()
+        elif event == STATE_CHANGED:
+            self.play_button.configure(text="Pause" if self.core.playing else "Play", style="TButton")
+            if self.core.playing:
+                self.update_progress_bar()
+
+    def load_selected_song(self, event):
+        selected_song = self.library_view.selected_item()
+        if selected_song is None:
+            return
+        if self.library_view.model is self.playlist:
+            self.core.play_index(self.library_view.selected_index())
+        else:
+            # A search result, play the library entry it came from, unless it has left the library
+            index = self.playlist.index_of(selected_song)
+            if index is not None:
+                self.core.play_index(index)
+
+    def on_search(self, *args):
+        query = self.search_var.get().strip()
+        if query:
+            try:
+                tracks = self.core.search(query)
+            except ValueError as e:
+                # Most likely a smart playlist that is still being typed
+                self.scan_status_label["text"] = f"Query: {e}"
+                return
+            if self.scan_status_label["text"].startswith("Query: "):
+                self.scan_status_label["text"] = ""
+            self.library_view.set_model(LibraryModel(self.core.arrange_duplicates(tracks)))
+        elif self.core.duplicate_mode != DUPLICATES_SHOW and self.core.duplicates:
+            self.library_view.set_model(LibraryModel(self.core.arrange_duplicates(self.playlist)))
+        else:
+            self.library_view.set_model(self.playlist)
+
+    def on_visibility_change(self, event):
+        if event.widget is not self.master:
+            return
+        self.visible = event.type == EventType.Map
+        if self.visible and self.core.playing:
+            self.update_progress_bar()
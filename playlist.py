@@ -0,0 +1,261 @@
+import random
+from collections import Counter
+
+from library_view import LibraryModel
+
+REPEAT_OFF = "off"
+REPEAT_ONE = "one"
+REPEAT_ALL = "all"
+REPEAT_MODES = (REPEAT_OFF, REPEAT_ALL, REPEAT_ONE)
+
+
+class Playlist(LibraryModel):
+    # The playing position is a cursor into the list rather than a path, so next/previous are
+    # O(1) and duplicate paths are fine. Shuffle is a permutation of positions that can be
+    # regenerated without touching the paths themselves.
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.cursor = None
+        self.repeat = REPEAT_ALL
+        self.shuffle = False
+        self._order = []
+        self._rank = []
+        self._rank_stale = False
+        # How often each path is in the list, so membership doesn't mean a scan of it
+        self._counts = Counter(self._items)
+        # Where each path first appears, built when first asked for and dropped when positions shift
+        self._positions = None
+
+    def __contains__(self, item):
+        return item in self._counts
+
+    def _count(self, items, change):
+        counts = self._counts
+        for item in items:
+            counts[item] += change
+            if not counts[item]:
+                del counts[item]
+
+    def index_of(self, item):
+        # The first position of a path, or None once it has left the list
+        if self._positions is None:
+            positions = {}
+            for index, path in enumerate(self._items):
+                positions.setdefault(path, index)
+            self._positions = positions
+        return self._positions.get(item)
+
+    def _positions_added(self, start):
+        # Entries appended from start on; nobody else moved
+        if self._positions is not None:
+            for index in range(start, len(self._items)):
+                self._positions.setdefault(self._items[index], index)
+
+    @property
+    def current(self):
+        return self._items[self.cursor] if self.cursor is not None else None
+
+    @property
+    def order(self):
+        # The positions in the order shuffle plays them (empty with shuffle off), as a copy
+        return list(self._order)
+
+    def select(self, index):
+        self.cursor = index
+        return self._items[index]
+
+    def next_index(self, auto=False):
+        # auto is True when the current track ran out rather than the user pressing Next;
+        # only then do repeat-one and repeat-off apply
+        return self._step(1, auto)
+
+    def previous_index(self, auto=False):
+        return self._step(-1, auto)
+
+    def advance(self, auto=False):
+        index = self.next_index(auto)
+        if index is not None:
+            self.cursor = index
+        return index
+
+    def retreat(self):
+        index = self.previous_index()
+        if index is not None:
+            self.cursor = index
+        return index
+
+    def _step(self, step, auto):
+        count = len(self._items)
+        if count == 0:
+            return None
+        if self.cursor is None:
+            return self._order[0] if self.shuffle else 0
+        if auto and self.repeat == REPEAT_ONE:
+            return self.cursor
+
+        rank = self.rank_of(self.cursor) if self.shuffle else self.cursor
+        rank += step
+        if not 0 <= rank < count:
+            if auto and self.repeat == REPEAT_OFF:
+                return None
+            rank %= count
+        return self._order[rank] if self.shuffle else rank
+
+    def set_shuffle(self, enabled):
+        self.shuffle = enabled
+        if enabled:
+            self.reshuffle()
+        else:
+            self._order = []
+            self._rank = []
+
+    def reshuffle(self):
+        # A fresh permutation of positions that starts at the current track
+        order = list(range(len(self._items)))
+        random.shuffle(order)
+        if self.cursor is not None:
+            order.remove(self.cursor)
+            order.insert(0, self.cursor)
+        self._order = order
+        self._rank_stale = True
+
+    def rank_of(self, index):
+        if self._rank_stale:
+            rank = [0] * len(self._order)
+            for position, item in enumerate(self._order):
+                rank[item] = position
+            self._rank = rank
+            self._rank_stale = False
+        return self._rank[index]
+
+    def set_repeat(self, mode):
+        if mode not in REPEAT_MODES:
+            raise ValueError(f"Unknown repeat mode: {mode}")
+        self.repeat = mode
+
+    def cycle_repeat(self):
+        self.set_repeat(REPEAT_MODES[(REPEAT_MODES.index(self.repeat) + 1) % len(REPEAT_MODES)])
+        return self.repeat
+
+    def _remap_order(self, remap, added=()):
+        # Apply a position change to the shuffle order; new positions go at random upcoming spots,
+        # after the current track's rank so they are still to come
+        if not self.shuffle:
+            return
+        order = self._order
+        if remap is not None:
+            order = [remap(index) for index in order]
+            order = [index for index in order if index is not None]
+        upcoming = order.index(self.cursor) + 1 if added and self.cursor is not None else 0
+        for index in added:
+            order.insert(random.randint(upcoming, len(order)), index)
+        self._order = order
+        self._rank_stale = True
+
+    def extend(self, items):
+        items = list(items)
+        start = len(self._items)
+        self._count(items, 1)
+        super().extend(items)
+        self._positions_added(start)
+        if self.shuffle and len(self._items) > start:
+            # Appending doesn't shift anyone, so the existing order stays as it is
+            added = list(range(start, len(self._items)))
+            random.shuffle(added)
+            self._order.extend(added)
+            self._rank_stale = True
+
+    def insert(self, index, item):
+        index = max(0, min(index, len(self._items)))
+        self._count((item,), 1)
+        appended = index == len(self._items)
+        if not appended:
+            self._positions = None
+        super().insert(index, item)
+        if appended:
+            self._positions_added(index)
+        if self.cursor is not None and self.cursor >= index:
+            self.cursor += 1
+        if index == len(self._items) - 1:
+            # Appended, so no existing position moves
+            self._remap_order(None, added=(index,))
+        else:
+            self._remap_order(lambda position: position + 1 if position >= index else position, added=(index,))
+
+    def remove_at(self, index, count=1):
+        count = max(0, min(count, len(self._items) - index))
+
+        def remap(position):
+            if position < index:
+                return position
+            if position >= index + count:
+                return position - count
+            return None
+
+        removed_current = self.cursor is not None and index <= self.cursor < index + count
+        previous = None
+        if removed_current and self.shuffle:
+            # The shuffle carries on from the current track's rank: the cursor goes to the entry
+            # ranked just before it that stays, so Next plays whatever was ranked after it
+            for rank in range(self.rank_of(self.cursor) - 1, -1, -1):
+                if remap(self._order[rank]) is not None:
+                    previous = self._order[rank]
+                    break
+
+        self._count(self._items[index:index + count], -1)
+        self._positions = None
+        super().remove_at(index, count)
+        if self.cursor is not None:
+            if self.cursor >= index + count:
+                self.cursor -= count
+            elif removed_current and self.shuffle:
+                self.cursor = remap(previous) if previous is not None else None
+            elif removed_current:
+                # The current entry is gone, so Next continues with whatever took its place
+                self.cursor = index - 1 if index > 0 else None
+        self._remap_order(remap)
+
+    def move(self, source, target):
+        self._positions = None
+        super().move(source, target)
+        if self.cursor == source:
+            self.cursor = target
+        elif self.cursor is not None:
+            if source < self.cursor <= target:
+                self.cursor -= 1
+            elif target <= self.cursor < source:
+                self.cursor += 1
+
+        def remap(position):
+            if position == source:
+                return target
+            if source < position <= target:
+                return position - 1
+            if target <= position < source:
+                return position + 1
+            return position
+        self._remap_order(remap)
+
+    def restore(self, items, cursor, shuffle, order, repeat):
+        # Back to a saved state, keeping the saved shuffle order if it still fits the items
+        items = list(items)
+        self._counts = Counter(items)
+        self._positions = None
+        super().reset(items)
+        self.cursor = cursor
+        self.repeat = repeat
+        self.shuffle = shuffle
+        if shuffle and sorted(order) == list(range(len(self._items))):
+            self._order = list(order)
+            self._rank_stale = True
+        else:
+            self.set_shuffle(shuffle)
+
+    def reset(self, items):
+        items = list(items)
+        self._counts = Counter(items)
+        self._positions = None
+        super().reset(items)
+        self.cursor = None
+        if self.shuffle:
+            self.reshuffle()
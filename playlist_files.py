@@ -0,0 +1,375 @@
+import os
+import re
+from urllib.parse import urlparse, unquote
+from collections import namedtuple
+
+from background_loader import BackgroundLoader
+
+# Playlist files the player can read and write
+PLAYLIST_EXTENSIONS = (".m3u", ".m3u8", ".pls", ".cue")
+PLAYLIST_FILE_TYPES = [("Playlists", tuple("*" + extension for extension in PLAYLIST_EXTENSIONS))]
+
+# A track of a CUE sheet is a time slice of a bigger file. It goes into the playlist as the
+# file's path with a media fragment, "album.flac#t=312.5,547.25" (or "#t=312.5" for the last
+# track), so everything that deals in paths can carry it around unchanged.
+SLICE = re.compile(r"^(.*)#t=(\d+(?:\.\d+)?)(?:,(\d+(?:\.\d+)?))?$", re.S)
+
+# CUE sheet times are minutes:seconds:frames, at 75 frames per second
+CUE_FRAMES = 75
+
+Entry = namedtuple("Entry", "path title artist duration", defaults=(None, None, None))
+
+
+def slice_path(source, start, end=None):
+    if not start and end is None:
+        return source
+    if end is None:
+        return f"{source}#t={start:.3f}"
+    return f"{source}#t={start:.3f},{end:.3f}"
+
+
+def split_entry(path):
+    # (file, start, end) of a playlist entry; end is None when it runs to the end of the file
+    if "#t=" not in path:
+        return path, 0.0, None
+    match = SLICE.match(path)
+    if match is None:
+        return path, 0.0, None
+    source, start, end = match.groups()
+    return source, float(start), float(end) if end else None
+
+
+def source_path(path):
+    return split_entry(path)[0]
+
+
+def is_slice(path):
+    return "#t=" in path and SLICE.match(path) is not None
+
+
+def entry_label(path, info=None):
+    # What the library list shows for an entry: CUE tracks by their title, files by name
+    source, start, end = split_entry(path)
+    if source == path:
+        return os.path.basename(path)
+    if info is not None and info.title:
+        return f"{info.artist} - {info.title}" if info.artist else info.title
+    minutes, seconds = divmod(int(start), 60)
+    return f"{os.path.basename(source)} @ {minutes}:{seconds:02d}"
+
+
+def read_lines(path):
+    # Lines one at a time, so a playlist of any size is never held in memory. Playlists come in
+    # UTF-8 or whatever the system's code page was, so lines that aren't UTF-8 are read as Latin-1.
+    with open(path, "rb") as f:
+        first = True
+        for raw in f:
+            if first:
+                raw = raw.removeprefix(b"\xef\xbb\xbf")
+                first = False
+            try:
+                line = raw.decode("utf-8")
+            except UnicodeDecodeError:
+                line = raw.decode("latin-1")
+            yield line.strip()
+
+
+def resolve(location, base):
+    # An absolute path for a playlist location, or None for streams and other URLs
+    location = location.strip()
+    if location.lower().startswith("file:"):
+        location = unquote(urlparse(location).path)
+        if os.name == "nt" and re.match(r"^/[A-Za-z]:", location):
+            location = location[1:]
+    elif "://" in location:
+        return None
+    if not location:
+        return None
+    if os.sep == "/":
+        # Playlists written on Windows
+        location = location.replace("\\", "/")
+    if not os.path.isabs(location):
+        location = os.path.join(base, location)
+    return os.path.normpath(location)
+
+
+def read_m3u(path):
+    base = os.path.dirname(os.path.abspath(path))
+    title = duration = start = stop = None
+    for line in read_lines(path):
+        if line.startswith("#EXTINF:"):
+            length, _, title = line[8:].partition(",")
+            duration = parse_seconds(length.split()[0] if length.split() else "")
+            if duration is not None and duration < 0:
+                duration = None
+        elif line.startswith("#EXTVLCOPT:start-time="):
+            start = parse_seconds(line[22:])
+        elif line.startswith("#EXTVLCOPT:stop-time="):
+            stop = parse_seconds(line[21:])
+        elif line and not line.startswith("#"):
+            location = resolve(line, base)
+            if location is not None:
+                if start or stop is not None:
+                    location = slice_path(location, start or 0.0, stop)
+                yield Entry(location, (title.strip() or None) if title else None, None, duration)
+            title = duration = start = stop = None
+
+
+def read_pls(path):
+    # Entries are yielded as soon as the next one starts, falling back to number order at the end
+    base = os.path.dirname(os.path.abspath(path))
+    pending = {}
+    current = None
+    for line in read_lines(path):
+        key, separator, value = line.partition("=")
+        match = re.match(r"^(File|Title|Length)(\d+)$", key.strip(), re.I) if separator else None
+        if match is None:
+            continue
+        field, number = match.group(1).lower(), int(match.group(2))
+        if number != current and current in pending:
+            entry = pls_entry(pending.pop(current), base)
+            if entry is not None:
+                yield entry
+        current = number
+        pending.setdefault(number, {})[field] = value.strip()
+    for number in sorted(pending):
+        entry = pls_entry(pending[number], base)
+        if entry is not None:
+            yield entry
+
+
+def pls_entry(fields, base):
+    location = resolve(fields["file"], base) if "file" in fields else None
+    if location is None:
+        return None
+    duration = parse_seconds(fields.get("length", ""))
+    return Entry(location, fields.get("title") or None, None, duration if duration and duration > 0 else None)
+
+
+def read_cue(path):
+    # A track ends where the next one in the same FILE block starts, or at its REM END (which
+    # this player writes for a slice nothing follows); otherwise it runs to the end of the file
+    base = os.path.dirname(os.path.abspath(path))
+    source = None
+    block = 0
+    album_artist = None
+    track = None
+    pending = None
+    for line in read_lines(path):
+        command, _, rest = line.partition(" ")
+        command = command.upper()
+        if command == "FILE":
+            if rest.startswith('"') and rest.count('"') >= 2:
+                name = rest[1:rest.rindex('"')]
+            else:
+                name = rest.rsplit(" ", 1)[0]
+            source = resolve(name, base)
+            block += 1
+            track = None
+        elif command == "TRACK":
+            track = {"source": source, "block": block, "title": None, "artist": None, "start": None, "end": None}
+        elif command in ("TITLE", "PERFORMER"):
+            value = unquote_cue(rest)
+            if track is None:
+                if command == "PERFORMER":
+                    album_artist = value
+            else:
+                track["title" if command == "TITLE" else "artist"] = value
+        elif command == "REM" and track is not None:
+            remark, _, time = rest.strip().partition(" ")
+            if remark.upper() == "END":
+                try:
+                    track["end"] = parse_cue_time(time)
+                except ValueError:
+                    pass
+        elif command == "INDEX" and track is not None and track["source"] is not None:
+            number, _, time = rest.strip().partition(" ")
+            if number != "01":
+                continue
+            track["start"] = parse_cue_time(time)
+            if pending is not None:
+                end = track["start"] if pending["block"] == track["block"] else None
+                entry = cue_entry(pending, end, album_artist)
+                if entry is not None:
+                    yield entry
+            pending = track
+    if pending is not None:
+        entry = cue_entry(pending, None, album_artist)
+        if entry is not None:
+            yield entry
+
+
+def cue_entry(track, end, album_artist):
+    # None for a track that ends before it starts, which no player could make sense of
+    start = track["start"]
+    if track["end"] is not None:
+        end = track["end"]
+    if end is not None and end <= start:
+        return None
+    duration = end - start if end is not None else None
+    return Entry(slice_path(track["source"], start, end), track["title"], track["artist"] or album_artist, duration)
+
+
+def unquote_cue(value):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        value = value[1:-1]
+    return value or None
+
+
+def parse_cue_time(text):
+    minutes, seconds, frames = (int(part) for part in text.strip().split(":"))
+    return minutes * 60 + seconds + frames / CUE_FRAMES
+
+
+def format_cue_time(seconds):
+    frames = round(seconds * CUE_FRAMES)
+    minutes, frames = divmod(frames, 60 * CUE_FRAMES)
+    seconds, frames = divmod(frames, CUE_FRAMES)
+    return f"{minutes:02d}:{seconds:02d}:{frames:02d}"
+
+
+def parse_seconds(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+READERS = {".m3u": read_m3u, ".m3u8": read_m3u, ".pls": read_pls, ".cue": read_cue}
+
+
+def read_playlist(path):
+    # Entries of a playlist file, parsed as they are read
+    reader = READERS.get(os.path.splitext(path)[1].lower())
+    if reader is None:
+        raise ValueError(f"unsupported playlist type: {os.path.basename(path)}")
+    return reader(path)
+
+
+def relative_location(path, base):
+    # Relative to the playlist where possible, so a folder of music and playlists can be moved
+    try:
+        return os.path.relpath(path, base)
+    except ValueError:
+        # Another drive on Windows
+        return path
+
+
+def write_playlist(path, entries, info_for=None):
+    # Writes the entries (paths, as in the playlist) to path in the format its extension names.
+    # info_for(entry) gives the TrackInfo used for titles and lengths, if known.
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise ValueError(f"unsupported playlist type: {os.path.basename(path)}")
+    base = os.path.dirname(os.path.abspath(path))
+    info_for = info_for or (lambda entry: None)
+
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8", newline="\n") as f:
+        if extension == ".pls":
+            write_pls(f, entries, base, info_for)
+        elif extension == ".cue":
+            write_cue(f, entries, base, info_for)
+        else:
+            write_m3u(f, entries, base, info_for)
+    os.replace(temporary, path)
+
+
+def display_title(info):
+    if info is None or not info.title:
+        return None
+    return f"{info.artist} - {info.title}" if info.artist else info.title
+
+
+def write_m3u(f, entries, base, info_for):
+    f.write("#EXTM3U\n")
+    for entry in entries:
+        info = info_for(entry)
+        source, start, end = split_entry(entry)
+        title = display_title(info) or os.path.splitext(os.path.basename(source))[0]
+        duration = round(info.duration) if info is not None and info.duration else -1
+        f.write(f"#EXTINF:{duration},{title}\n")
+        if source != entry:
+            # VLC's way of playing part of a file, which this player reads back as well
+            f.write(f"#EXTVLCOPT:start-time={start:.3f}\n")
+            if end is not None:
+                f.write(f"#EXTVLCOPT:stop-time={end:.3f}\n")
+        f.write(relative_location(source, base) + "\n")
+
+
+def write_pls(f, entries, base, info_for):
+    # PLS can't say where in a file a track starts, so a CUE track is written as its whole file
+    f.write("[playlist]\n")
+    count = 0
+    for count, entry in enumerate(entries, 1):
+        info = info_for(entry)
+        f.write(f"File{count}={relative_location(source_path(entry), base)}\n")
+        title = display_title(info)
+        if title:
+            f.write(f"Title{count}={title}\n")
+        f.write(f"Length{count}={round(info.duration) if info is not None and info.duration else -1}\n")
+    f.write(f"NumberOfEntries={count}\nVersion=2\n")
+
+
+def write_cue(f, entries, base, info_for):
+    # An entry that starts where the one before it in the same file ends shares its FILE block;
+    # anything else starts a block of its own. A slice's end is the next track's INDEX when
+    # that follows on, and a REM END line when it doesn't.
+    entries = [(entry, *split_entry(entry)) for entry in entries]
+    previous_source = previous_end = None
+    for number, (entry, source, start, end) in enumerate(entries, 1):
+        info = info_for(entry)
+        if not follows_on(previous_source, previous_end, source, start):
+            kind = "MP3" if source.lower().endswith(".mp3") else "WAVE"
+            f.write(f'FILE "{relative_location(source, base)}" {kind}\n')
+        f.write(f"  TRACK {number:02d} AUDIO\n")
+        if info is not None and info.title:
+            f.write(f'    TITLE "{info.title.replace(chr(34), chr(39))}"\n')
+        if info is not None and info.artist:
+            f.write(f'    PERFORMER "{info.artist.replace(chr(34), chr(39))}"\n')
+        if end is not None and (number == len(entries) or not follows_on(source, end, *entries[number][1:3])):
+            f.write(f"    REM END {format_cue_time(end)}\n")
+        f.write(f"    INDEX 01 {format_cue_time(start)}\n")
+        previous_source, previous_end = source, end
+
+
+def follows_on(previous_source, previous_end, source, start):
+    # Compared as CUE times, the precision they are written at
+    return (previous_source == source and previous_end is not None
+            and format_cue_time(previous_end) == format_cue_time(start))
+
+
+class ExistenceChecker(BackgroundLoader):
+    # Stats playlist entries on a worker thread, so an imported playlist shows straight away
+    # and entries whose file is missing are marked as the checks come in
+    POLL_MS = 100
+    ERROR = "Error checking playlist files"
+
+    def __init__(self, master, on_missing):
+        super().__init__(master)
+        self.on_missing = on_missing
+        self.missing = set()
+
+    def check(self, paths):
+        self._submit(list(paths))
+
+    def _run(self, paths):
+        exists = {}
+        missing = []
+        for path in paths:
+            source = source_path(path)
+            found = exists.get(source)
+            if found is None:
+                found = exists[source] = os.path.exists(source)
+            if not found:
+                missing.append(path)
+                if len(missing) >= 500:
+                    self._results.put(missing)
+                    missing = []
+        if missing:
+            self._results.put(missing)
+
+    def _handle(self, missing):
+        self.missing.update(missing)
+        self.on_missing(missing)
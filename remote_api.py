@@ -0,0 +1,547 @@
+import os
+import hmac
+import json
+import time
+import queue
+import base64
+import struct
+import asyncio
+import hashlib
+import ipaddress
+import threading
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs
+
+from library_view import INSERT, REMOVE, MOVE
+
+# Remote control over HTTP and WebSocket for players without anyone at the window. The server
+# runs an asyncio loop on its own thread; whatever touches the player is handed to the thread
+# that owns it (the Tk thread, or the headless main loop) through a queue, which that thread
+# drains with process(). Track, state, position and queue changes are pushed to every WebSocket
+# subscriber, each through its own bounded queue so a slow client can't hold the others up.
+#
+#   GET  /state                       the player's state
+#   GET  /queue?offset=0&limit=100    entries of the playlist
+#   GET  /search?q=...&limit=50       library search
+#   POST /play /pause /toggle /stop /next /previous
+#   POST /seek {"position": seconds}
+#   POST /play_index {"index": n}
+#   POST /enqueue {"paths": [...], "play": false}
+#   POST /volume {"volume": 0.0-1.0}
+#   GET  /events                      WebSocket: pushed events, and the same commands as
+#                                     {"id": 1, "command": "seek", "args": {"position": 30}}
+#
+# With a token, every request has to carry it, as "Authorization: Bearer <token>" or as
+# ?token=<token> (for WebSocket clients that can't set headers). Listening anywhere but on
+# loopback needs one, since anyone who can reach the port could otherwise control the player.
+# Without one, a request from a browser page of another site (its Origin) or made through a name
+# that only resolves to loopback for now (its Host, as in DNS rebinding) is refused, so no web
+# page can drive the player through the user's browser.
+
+DEFAULT_HOST = "127.0.0.1"
+# Seconds between position updates while playing; changes made elsewhere (volume, shuffle from
+# the window) are noticed on the same beat
+POSITION_INTERVAL = 1.0
+# Messages waiting for one subscriber before it is dropped as too slow
+SEND_QUEUE = 256
+MAX_BODY = 1 << 20
+IDLE_TIMEOUT = 120.0
+COMMAND_TIMEOUT = 10.0
+# Most a pass of process() spends starting commands, so a crowd of clients can't freeze a window
+BUSY_SECONDS = 0.01
+QUEUE_LIMIT = 1000
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC11B65"
+OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+           503: "Service Unavailable"}
+
+
+class CommandError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        # Any other name may well resolve to something reachable from outside
+        return False
+
+
+def is_local_origin(origin):
+    # An Origin header: scheme://host[:port], or "null" from a sandboxed page or a file
+    url = urlsplit(origin)
+    return url.scheme in ("http", "https") and url.hostname is not None and is_loopback(url.hostname)
+
+
+def is_local_host(host):
+    # A Host header: host[:port], IPv6 addresses in brackets
+    hostname = urlsplit("//" + host).hostname
+    return hostname is not None and is_loopback(hostname)
+
+
+def websocket_frame(opcode, payload):
+    # Server frames are never masked
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def read_websocket_frame(reader, limit=MAX_BODY):
+    # (fin, opcode, payload) of the next frame, unmasked
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack("!Q", await reader.readexactly(8))
+    if length > limit:
+        raise ValueError("WebSocket message too large")
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask and length:
+        key = int.from_bytes((mask * (length // 4 + 1))[:length], "big")
+        payload = (int.from_bytes(payload, "big") ^ key).to_bytes(length, "big")
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+
+
+class Subscriber:
+    def __init__(self, writer):
+        self.writer = writer
+        self.messages = asyncio.Queue(SEND_QUEUE)
+        self.closed = False
+
+    def send(self, frame):
+        if self.closed:
+            return
+        try:
+            self.messages.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Hasn't read its events for a while; dropping it beats buffering without end
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class RemoteServer:
+    def __init__(self, core, port, host=DEFAULT_HOST, token=None):
+        if not token and not is_loopback(host):
+            raise ValueError(f"listening on {host or 'every address'} needs a token (MUSIC_PLAYER_REMOTE_TOKEN)")
+        self.core = core
+        self.host = host
+        self.port = port
+        self.token = token or None
+        self.connections = 0
+        self.subscribers = set()
+
+        self._commands = queue.Queue()
+        self._loop = None
+        self._server = None
+        self._ready = threading.Event()
+        self._error = None
+        # The state as last sent to subscribers, read by the server thread
+        self._state = None
+        self._sent = {}
+        self._checked = 0.0
+        self._thread = None
+
+        core.add_listener(self._on_core_event)
+        core.playlist.add_listener(self._on_queue_change)
+
+    def start(self):
+        # Binds the port on the server thread; raises OSError here if that fails
+        self._state = self._sent = self.state()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port, backlog=1024, limit=MAX_BODY))
+            # Port 0 picks a free one
+            self.port = self._server.sockets[0].getsockname()[1]
+        except OSError as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        self._loop.run_forever()
+
+    # Owner thread side
+
+    def process(self, timeout=0):
+        # Runs the commands that came in, waiting up to timeout seconds (or until the next
+        # position update is due) for the first; call it regularly from the thread that owns the
+        # player. Also sends the position while playing.
+        timeout = min(timeout, max(0.0, self._checked + POSITION_INTERVAL - time.monotonic()))
+        try:
+            batch = [self._commands.get(timeout=timeout) if timeout else self._commands.get_nowait()]
+        except queue.Empty:
+            batch = []
+        started = time.monotonic()
+        while batch and time.monotonic() - started < BUSY_SECONDS:
+            # Of several seeks waiting, only the last one matters; the others get its answer
+            seeks = [command for command in batch if command[0] == "seek"]
+            superseded = [future for _, _, future in seeks[:-1]]
+            for name, args, future in batch:
+                if name == "seek" and future is not seeks[-1][2]:
+                    continue
+                self._execute(name, args, [future] + (superseded if name == "seek" else []))
+            batch = self._take_waiting()
+        for name, args, future in batch:
+            # Out of time for this pass; back in line for the next
+            self._commands.put((name, args, future))
+
+        if time.monotonic() - self._checked >= POSITION_INTERVAL:
+            self._checked = time.monotonic()
+            state = self.state()
+            if self._changed(state):
+                self._publish({"event": "state", "state": state}, state)
+            elif state["playing"]:
+                self._publish_position(state)
+
+    def _take_waiting(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._commands.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _execute(self, name, args, futures):
+        futures = [future for future in futures if future.set_running_or_notify_cancel()]
+        if not futures:
+            return
+        try:
+            result = self._run_command(name, args)
+        except CommandError as e:
+            error = e
+        except (KeyError, TypeError, ValueError) as e:
+            error = CommandError(f"bad arguments: {e}")
+        except Exception as e:
+            print(f"Error in remote command: {e}")
+            error = CommandError(str(e), 500)
+        else:
+            for future in futures:
+                future.set_result(result)
+            return
+        for future in futures:
+            future.set_exception(error)
+
+    def _changed(self, state):
+        return any(value != self._sent.get(key) for key, value in state.items() if key != "position")
+
+    def state(self):
+        core = self.core
+        info = core.track_info
+        return {
+            "track": core.current_track,
+            "label": core.entry_label(core.current_track) if core.current_track else None,
+            "title": info.title if info else None,
+            "artist": info.artist if info else None,
+            "album": info.album if info else None,
+            "playing": core.playing,
+            "position": round(core.position(), 2),
+            "duration": core.duration,
+            "index": core.playlist.cursor,
+            "queue_length": len(core.playlist),
+            "shuffle": core.playlist.shuffle,
+            "repeat": core.playlist.repeat,
+            "volume": core.volume,
+        }
+
+    def _on_core_event(self, event):
+        state = self.state()
+        self._publish({"event": event, "state": state}, state)
+
+    def _on_queue_change(self, kind, index, value):
+        message = {"event": "queue", "kind": kind, "index": index, "total": len(self.core.playlist)}
+        if kind == INSERT:
+            message["count"] = value
+            if value <= QUEUE_LIMIT:
+                message["paths"] = self.core.playlist[index:index + value]
+        elif kind == REMOVE:
+            message["count"] = value
+        elif kind == MOVE:
+            message["target"] = value
+        self._publish(message)
+
+    def _publish_position(self, state):
+        self._publish({"event": "position", "position": state["position"], "duration": state["duration"],
+                       "playing": state["playing"]}, state)
+
+    def _publish(self, message, state=None):
+        if self._loop is None:
+            return
+        if state is not None:
+            self._sent = state
+        self._loop.call_soon_threadsafe(self._broadcast, json.dumps(message), state)
+
+    def _run_command(self, name, args):
+        # On the owner thread: a command by name, returning what goes back to the client
+        core = self.core
+        if name == "state":
+            return self.state()
+        if name == "queue":
+            offset = max(0, int(args.get("offset", 0)))
+            limit = max(0, min(QUEUE_LIMIT, int(args.get("limit", 100))))
+            items = core.playlist[offset:offset + limit]
+            return {"offset": offset, "total": len(core.playlist),
+                    "items": [{"index": offset + number, "path": path, "label": core.entry_label(path)}
+                              for number, path in enumerate(items)]}
+        if name == "search":
+            limit = max(0, min(QUEUE_LIMIT, int(args.get("limit", 50))))
+            paths = core.search(str(args.get("q", "")), limit)
+            return {"items": [{"path": path, "label": core.entry_label(path)} for path in paths]}
+
+        if name in ("play", "pause", "toggle"):
+            if not core.current_track:
+                if name != "pause" and core.playlist:
+                    core.play_next()
+            elif name == "toggle" or (name == "play") != core.playing:
+                core.toggle_play()
+        elif name == "stop":
+            core.stop()
+        elif name == "next":
+            core.play_next()
+        elif name == "previous":
+            core.play_previous()
+        elif name == "seek":
+            if not core.current_track:
+                raise CommandError("nothing to seek in")
+            position = float(args["position"])
+            core.seek(max(0.0, min(position, core.duration or position)))
+            self._publish_position(self.state())
+        elif name == "play_index":
+            index = int(args["index"])
+            if not 0 <= index < len(core.playlist):
+                raise CommandError(f"no entry {index}", 404)
+            core.play_index(index)
+        elif name == "enqueue":
+            paths = args.get("paths") or [args["path"]]
+            extensions = core.extensions
+            missing = [path for path in paths if not isinstance(path, str) or not os.path.isfile(path)
+                       or not path.lower().endswith(extensions)]
+            if missing:
+                raise CommandError(f"not a playable file: {missing[0]}", 404)
+            first = len(core.playlist)
+            core.add_tracks(paths)
+            if args.get("play"):
+                core.play_index(first)
+        elif name == "volume":
+            core.set_volume(float(args["volume"]))
+        else:
+            raise CommandError(f"unknown command: {name}", 404)
+        state = self.state()
+        if self._changed(state):
+            self._publish({"event": "state", "state": state}, state)
+        return state
+
+    # Server thread side
+
+    def _broadcast(self, text, state):
+        if state is not None:
+            self._state = state
+        frame = websocket_frame(OP_TEXT, text.encode())
+        for subscriber in list(self.subscribers):
+            subscriber.send(frame)
+
+    async def _call(self, name, args):
+        # Runs a command on the owner thread and waits for its result
+        if name == "state" and self._state is not None:
+            # Kept current by the events, so reading it doesn't have to wait for the owner
+            return self._state
+        future = concurrent.futures.Future()
+        self._commands.put((name, args, future))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise CommandError("the player didn't answer in time", 503)
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                url = urlsplit(target)
+                if not self._same_machine(headers):
+                    await self._respond(writer, 403, {"error": "requests from other sites aren't accepted"}, False)
+                    break
+                if not self._authorized(headers, url):
+                    await self._respond(writer, 401, {"error": "missing or wrong token"}, False)
+                    break
+                if url.path == "/events" and headers.get("upgrade", "").lower() == "websocket":
+                    await self._websocket(reader, writer, headers)
+                    return
+
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, {"error": "request too large"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                status, payload = await self._route(method, url, body)
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError, UnicodeDecodeError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def _same_machine(self, headers):
+        # With a token there is nothing a page that doesn't know it can do
+        if self.token is not None:
+            return True
+        origin, host = headers.get("origin"), headers.get("host")
+        return (origin is None or is_local_origin(origin)) and (host is None or is_local_host(host))
+
+    def _authorized(self, headers, url):
+        if self.token is None:
+            return True
+        scheme, _, given = headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer":
+            given = parse_qs(url.query).get("token", [""])[-1]
+        # In constant time, so the token can't be guessed a character at a time
+        return hmac.compare_digest(given.strip().encode(), self.token.encode())
+
+    async def _route(self, method, url, body):
+        name = url.path.strip("/")
+        if name in ("state", "queue", "search"):
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            args = {key: values[-1] for key, values in parse_qs(url.query).items() if key != "token"}
+        else:
+            if method != "POST":
+                return 405 if name else 404, {"error": "use POST" if name else "not found"}
+            try:
+                args = json.loads(body) if body.strip() else {}
+            except ValueError:
+                return 400, {"error": "the body isn't JSON"}
+            if not isinstance(args, dict):
+                return 400, {"error": "the body has to be a JSON object"}
+        try:
+            return 200, await self._call(name, args)
+        except CommandError as e:
+            return e.status, {"error": str(e)}
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        writer.write((f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+                      f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    async def _websocket(self, reader, writer, headers):
+        key = headers.get("sec-websocket-key")
+        if not key:
+            await self._respond(writer, 400, {"error": "missing Sec-WebSocket-Key"}, False)
+            return
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept_key(key)}\r\n\r\n").encode())
+        subscriber = Subscriber(writer)
+        subscriber.send(websocket_frame(OP_TEXT, json.dumps({"event": "hello", "state": self._state}).encode()))
+        self.subscribers.add(subscriber)
+        sender = asyncio.ensure_future(self._send_messages(subscriber))
+        try:
+            message = b""
+            while not subscriber.closed:
+                fin, opcode, payload = await read_websocket_frame(reader)
+                if opcode == OP_CLOSE:
+                    subscriber.send(websocket_frame(OP_CLOSE, payload[:2]))
+                    break
+                if opcode == OP_PING:
+                    subscriber.send(websocket_frame(OP_PONG, payload))
+                    continue
+                if opcode in (OP_TEXT, OP_BINARY, OP_CONTINUATION):
+                    message += payload
+                    if len(message) > MAX_BODY:
+                        break
+                    if fin:
+                        asyncio.ensure_future(self._answer(subscriber, message))
+                        message = b""
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            # Let the close frame go out before the connection does
+            await subscriber.messages.put(None)
+            await sender
+            subscriber.close()
+
+    async def _answer(self, subscriber, message):
+        reply = {}
+        try:
+            request = json.loads(message)
+            reply["id"] = request.get("id")
+            reply["result"] = await self._call(str(request["command"]), request.get("args") or {})
+        except CommandError as e:
+            reply["error"] = str(e)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            reply["error"] = f"bad request: {e}"
+        subscriber.send(websocket_frame(OP_TEXT, json.dumps(reply).encode()))
+
+    async def _send_messages(self, subscriber):
+        writer = subscriber.writer
+        try:
+            while True:
+                frame = await subscriber.messages.get()
+                if frame is None:
+                    break
+                writer.write(frame)
+                # Only wait on the socket once a backlog builds up
+                if writer.transport.get_write_buffer_size() > 64 * 1024:
+                    await writer.drain()
+        except (ConnectionError, RuntimeError):
+            subscriber.close()
+
+
+def start(core, port, host=None, token=None):
+    # The running server, or None when it couldn't start; MUSIC_PLAYER_REMOTE_HOST binds another
+    # address than localhost, which needs MUSIC_PLAYER_REMOTE_TOKEN to be set as well
+    try:
+        return RemoteServer(core, int(port), host or os.environ.get("MUSIC_PLAYER_REMOTE_HOST", DEFAULT_HOST),
+                            token or os.environ.get("MUSIC_PLAYER_REMOTE_TOKEN")).start()
+    except (OSError, ValueError) as e:
+        print(f"Error starting remote control: {e}")
+        return None
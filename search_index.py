@@ -0,0 +1,188 @@
+import os
+import re
+import unicodedata
+from array import array
+from collections import defaultdict
+
+WORD = re.compile(r"[^\W_]+")
+# Saved indexes of another version are rebuilt rather than read (2: underscores split words)
+INDEX_VERSION = 2
+
+# Rebuild the postings once this share of the indexed tracks has been removed
+COMPACT_RATIO = 0.25
+
+
+def normalize(text):
+    # Lower case without accents, so "Beyoncé" is found by "beyonce"
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    # Substring search over title, artist, album and file name. Terms of three or more characters
+    # are looked up through a trigram index, shorter ones through word prefixes; either way only
+    # the rarest posting list is walked and its candidates are checked against the full text.
+    # Postings are compact arrays of document ids, removals are tombstoned and compacted later.
+    def __init__(self):
+        self._ids = {}
+        self._paths = []
+        self._texts = []
+        self._refs = []
+        self._removed = 0
+        self._trigrams = defaultdict(lambda: array("I"))
+        self._prefixes = defaultdict(lambda: array("I"))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, path):
+        return path in self._ids
+
+    def add(self, path, info=None):
+        doc = self._ids.get(path)
+        if doc is not None:
+            # The same file added again, e.g. a duplicate playlist entry
+            self._refs[doc] += 1
+            return
+        self._index(path, document_text(path, info), 1)
+
+    def update(self, path, info):
+        # Re-index a track whose tags changed, keeping how often it was added
+        doc = self._ids.get(path)
+        refs = self._refs[doc] if doc is not None else 1
+        if doc is not None:
+            self._drop(doc)
+        self._index(path, document_text(path, info), refs)
+
+    def remove(self, path):
+        doc = self._ids.get(path)
+        if doc is None:
+            return
+        self._refs[doc] -= 1
+        if self._refs[doc] <= 0:
+            self._drop(doc)
+
+    def clear(self):
+        self.__init__()
+
+    def export(self):
+        # (paths, texts, refs, trigram postings, prefix postings) for saving; removed documents
+        # have None for their path and text
+        return self._paths, self._texts, self._refs, self._trigrams, self._prefixes
+
+    def copy(self):
+        # For saving on another thread while this one keeps changing
+        index = SearchIndex()
+        index._ids = dict(self._ids)
+        index._paths = list(self._paths)
+        index._texts = list(self._texts)
+        index._refs = list(self._refs)
+        index._removed = self._removed
+        for source, target in ((self._trigrams, index._trigrams), (self._prefixes, index._prefixes)):
+            for key, posting in source.items():
+                target[key] = posting[:]
+        return index
+
+    @classmethod
+    def restore(cls, paths, texts, refs, trigrams, prefixes):
+        # The inverse of export(); postings are (key, array("I")) pairs
+        index = cls()
+        index._paths = list(paths)
+        index._texts = list(texts)
+        index._refs = list(refs)
+        index._ids = {path: doc for doc, path in enumerate(index._paths) if path is not None}
+        index._removed = len(index._paths) - len(index._ids)
+        index._trigrams.update(trigrams)
+        index._prefixes.update(prefixes)
+        return index
+
+    def _index(self, path, text, refs):
+        doc = len(self._paths)
+        self._ids[path] = doc
+        self._paths.append(path)
+        self._texts.append(text)
+        self._refs.append(refs)
+
+        for gram in trigrams(text):
+            self._trigrams[gram].append(doc)
+        for word in set(WORD.findall(text)):
+            self._prefixes[word[:1]].append(doc)
+            if len(word) > 1:
+                self._prefixes[word[:2]].append(doc)
+
+    def _drop(self, doc):
+        del self._ids[self._paths[doc]]
+        self._paths[doc] = None
+        self._texts[doc] = None
+        self._removed += 1
+        if self._removed > COMPACT_RATIO * len(self._paths):
+            self._compact()
+
+    def _compact(self):
+        live = [(path, text, refs) for path, text, refs in zip(self._paths, self._texts, self._refs) if path is not None]
+        self.clear()
+        for path, text, refs in live:
+            self._index(path, text, refs)
+
+    def search(self, query, limit=None):
+        # Paths matching every word of the query, in the order they were added
+        terms = WORD.findall(normalize(query))
+        if not terms:
+            return []
+
+        postings = []
+        for term in terms:
+            if len(term) >= 3:
+                grams = [self._trigrams.get(gram) for gram in trigrams(term)]
+                if any(posting is None for posting in grams):
+                    return []
+                postings.extend(grams)
+            else:
+                posting = self._prefixes.get(term)
+                if posting is None:
+                    return []
+                postings.append(posting)
+
+        # Walk the shortest posting list and verify each candidate against the whole query
+        candidates = min(postings, key=len)
+        if len(terms) == 1 and len(terms[0]) <= 3:
+            # A query that is one trigram or one word prefix needs no verification; a longer word
+            # with a single distinct trigram ("aaaa") still has to be checked
+            paths = self._paths
+            results = [paths[doc] for doc in candidates if paths[doc] is not None]
+            return results[:limit] if limit is not None else results
+
+        short_terms = [term for term in terms if len(term) < 3]
+        long_terms = [term for term in terms if len(term) >= 3]
+        results = []
+        texts = self._texts
+        for doc in candidates:
+            text = texts[doc]
+            if text is None:
+                continue
+            if all(term in text for term in long_terms) and all(has_word_prefix(text, term) for term in short_terms):
+                results.append(self._paths[doc])
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
+
+
+def has_word_prefix(text, prefix):
+    position = text.find(prefix)
+    while position != -1:
+        if position == 0 or not text[position - 1].isalnum():
+            return True
+        position = text.find(prefix, position + 1)
+    return False
+
+
+def document_text(path, info=None):
+    fields = [os.path.splitext(os.path.basename(path))[0]]
+    if info is not None:
+        fields.extend(field for field in (info.title, info.artist, info.album) if field)
+    # Tags occasionally hold NULs between multiple values; the saved index separates keys by NUL
+    return normalize(" ".join(fields).replace("\0", " "))
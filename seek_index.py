@@ -0,0 +1,136 @@
+import io
+import os
+from array import array
+from collections import namedtuple
+
+from duration_probe import (SCAN_BLOCK_SIZE, parse_frame_header, id3v2_size, audio_end, find_first_frame,
+                            read_vbr_header)
+
+# Where an MP3's frames start, so a seek can begin decoding at the frame that holds the wanted
+# moment instead of guessing a byte position from the bitrate (wrong for VBR) or decoding from
+# the start of the file (slow for long ones). The byte offset of every `step`th frame is kept,
+# about one a second; the frames in between are found by reading at most step - 1 headers
+# forward, so a seek reads a few kilobytes however long the track is. Frame 0 is the first
+# frame of sound, after any Xing/Info/VBRI frame.
+SeekIndex = namedtuple("SeekIndex", "sample_rate frame_samples step frames offsets")
+
+STEP_SECONDS = 1.0
+# The longest an MPEG audio frame can be (Layer II at 384 kbit/s and 32 kHz, padded)
+MAX_FRAME_LENGTH = 1729
+
+
+def indexable(path):
+    return os.path.splitext(path)[1].lower() == ".mp3"
+
+
+def build_seek_index(path, step_seconds=STEP_SECONDS):
+    # Walks every frame header once; None if the file doesn't look like MPEG audio
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = id3v2_size(f.read(10))
+        end = audio_end(f, file_size)
+        offset, header = find_first_frame(f, start, end)
+        if header is None:
+            return None
+        if read_vbr_header(f, offset, header) is not None:
+            # That frame only describes the stream, it holds no sound
+            offset += header.length
+
+        step = max(1, round(step_seconds * header.sample_rate / header.samples))
+        offsets = array("Q")
+        frames = 0
+        # Frame length by the two header bytes that decide it; a file only uses a handful
+        lengths = {}
+        block_start = offset
+        f.seek(block_start)
+        block = f.read(min(SCAN_BLOCK_SIZE, end - block_start))
+        while offset < end:
+            position = offset - block_start
+            if position + 4 > len(block):
+                if block_start + len(block) >= end:
+                    break
+                block_start = offset
+                f.seek(block_start)
+                block = f.read(min(SCAN_BLOCK_SIZE, end - block_start))
+                position = 0
+                if len(block) < 4:
+                    break
+            key = block[position + 1:position + 3]
+            length = lengths.get(key)
+            if length is None or block[position] != 0xFF:
+                frame = parse_frame_header(block, position)
+                if frame is None or frame.length <= 0:
+                    # Lost sync, usually trailing junk or an APE tag
+                    break
+                length = lengths[key] = frame.length
+            if frames % step == 0:
+                offsets.append(offset)
+            frames += 1
+            offset += length
+    if not frames:
+        return None
+    return SeekIndex(header.sample_rate, header.samples, step, frames, offsets)
+
+
+def seek_position(index, path, seconds):
+    # (byte offset, start in seconds) of the frame that is playing `seconds` into the track
+    frame = max(0, min(int(seconds * index.sample_rate / index.frame_samples), index.frames - 1))
+    point = frame // index.step
+    offset = index.offsets[point]
+    ahead = frame - point * index.step
+    if ahead:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(ahead * MAX_FRAME_LENGTH + 4)
+        position = 0
+        for walked in range(ahead):
+            header = parse_frame_header(data, position)
+            if header is None:
+                # The file changed since it was indexed; start at the last frame found
+                frame = point * index.step + walked
+                break
+            position += header.length
+        offset += position
+    return offset, frame * index.frame_samples / index.sample_rate
+
+
+def encode(index):
+    return index.offsets.tobytes()
+
+
+def decode(sample_rate, frame_samples, step, frames, data):
+    offsets = array("Q")
+    offsets.frombytes(data)
+    return SeekIndex(sample_rate, frame_samples, step, frames, offsets)
+
+
+class FileSlice(io.RawIOBase):
+    # A file from `start` on, as if that were all there was: for decoders that can only be
+    # handed a file, to start them at a frame boundary
+    def __init__(self, path, start):
+        super().__init__()
+        self._file = open(path, "rb")
+        self._start = start
+        self._file.seek(start)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position += self._start
+        return max(0, self._file.seek(position, whence) - self._start)
+
+    def tell(self):
+        return self._file.tell() - self._start
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
@@ -0,0 +1,439 @@
+import os
+import json
+import mmap
+import zlib
+import struct
+import threading
+from array import array
+from collections import namedtuple
+
+from app_paths import data_path
+from metadata_cache import TrackInfo, FIELDS
+from playlist import REPEAT_MODES
+from search_index import SearchIndex, INDEX_VERSION
+
+# The session is a snapshot plus a journal of what changed since. The snapshot is written in
+# one go (to a temporary file, then renamed into place) and read through a memory map:
+# strings are interned into one table and everything else is stored as flat arrays, so loading
+# a big library is mostly slicing. Changes are appended to the journal as small checksummed
+# records until it grows large enough to be folded into a fresh snapshot. That snapshot can be
+# written on a thread of its own: changes made meanwhile go to both the old journal and the one
+# that will follow the new snapshot, which only replaces the old one once the snapshot is done.
+
+MAGIC = b"MPSS"
+JOURNAL_MAGIC = b"MPSJ"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<4sIQI")  # magic, format version, snapshot id, section count
+SECTION = struct.Struct("<4sQQ")  # name, offset, size
+SESSION = struct.Struct("<iBBidd")  # cursor, shuffle, repeat mode, current track row, position, volume
+RECORD = struct.Struct("<II")  # payload size, crc32 of the payload
+
+# Fold the journal into a new snapshot once it is this big
+COMPACT_BYTES = 1 << 20
+
+# How TrackInfo fields are stored: "s" is an id into the string table (0 for None), anything
+# else an array typecode; missing numbers are NaN, or 0 for the integer columns
+COLUMNS = {"path": "s", "size": "Q", "mtime": "d", "duration": "d", "bitrate": "I", "title": "s", "artist": "s",
+           "album": "s", "genre": "s", "year": "i", "art_hash": "s", "track_gain": "d", "album_gain": "d",
+           "track_peak": "d"}
+
+# folders are the library folders being watched for changes, settings the sound settings
+SessionState = namedtuple("SessionState", "playlist cursor shuffle order repeat current position volume folders settings",
+                          defaults=((), None))
+
+NAN = float("nan")
+
+
+class StringTable:
+    def __init__(self):
+        self.strings = [""]
+        self.ids = {}
+
+    def intern(self, text):
+        if text is None:
+            return 0
+        string_id = self.ids.get(text)
+        if string_id is None:
+            string_id = self.ids[text] = len(self.strings)
+            # The table is NUL separated; tags occasionally contain NULs between multiple values
+            self.strings.append(text.replace("\0", "/"))
+        return string_id
+
+    def encode(self):
+        return "\0".join(self.strings).encode("utf-8", "surrogateescape")
+
+
+def column_value(value, kind):
+    if value is None:
+        return NAN if kind == "d" else 0
+    return value
+
+
+def write_snapshot(path, snapshot_id, state, info_for, search_index=None):
+    strings = StringTable()
+    sections = []
+
+    tracks = list(dict.fromkeys(state.playlist))
+    rows = {track: row for row, track in enumerate(tracks)}
+    infos = [info_for(track) or TrackInfo(track, 0, 0.0, 0.0, 0, None, None, None, None, None, None) for track in tracks]
+    for number, field in enumerate(FIELDS):
+        kind = COLUMNS[field]
+        if kind == "s":
+            column = array("I", [strings.intern(info[number]) for info in infos])
+        else:
+            column = array(kind, [column_value(info[number], kind) for info in infos])
+        sections.append((f"C{number:03d}".encode(), column))
+
+    sections.append((b"PLST", array("I", [rows[track] for track in state.playlist])))
+    sections.append((b"ORDR", array("I", state.order if state.shuffle else [])))
+    current = rows.get(state.current, -1)
+    cursor = -1 if state.cursor is None else state.cursor
+    sections.append((b"SESS", SESSION.pack(cursor, state.shuffle, REPEAT_MODES.index(state.repeat), current,
+                                           state.position, state.volume)))
+    sections.append((b"ROOT", "\0".join(state.folders).encode("utf-8", "surrogateescape")))
+    sections.append((b"PREF", json.dumps(state.settings or {}).encode()))
+
+    if search_index is not None:
+        paths, texts, refs, trigrams, prefixes = search_index.export()
+        sections.append((b"SVER", array("I", [INDEX_VERSION])))
+        sections.append((b"SDOC", array("I", [strings.intern(doc_path) for doc_path in paths])))
+        sections.append((b"SREF", array("I", refs)))
+        sections.append((b"STXT", "\0".join((text or "").replace("\0", " ") for text in texts).encode("utf-8", "surrogateescape")))
+        for prefix, postings in ((b"T", trigrams), (b"P", prefixes)):
+            keys = [key for key, posting in postings.items() if posting]
+            offsets = array("Q", [0])
+            for key in keys:
+                offsets.append(offsets[-1] + len(postings[key]))
+            joined = array("I")
+            for key in keys:
+                joined.extend(postings[key])
+            sections.append((prefix + b"KEY", "\0".join(keys).encode("utf-8", "surrogateescape")))
+            sections.append((prefix + b"OFF", offsets))
+            sections.append((prefix + b"PST", joined))
+
+    sections.insert(0, (b"STRS", strings.encode()))
+
+    # Each section starts on an 8 byte boundary so it can be viewed as an array in place
+    position = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, data in sections:
+        position = (position + 7) & ~7
+        size = len(data) * data.itemsize if isinstance(data, array) else len(data)
+        table.append((name, position, size))
+        position += size
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, snapshot_id, len(sections)))
+        for entry in table:
+            f.write(SECTION.pack(*entry))
+        for (name, data), (_, offset, size) in zip(sections, table):
+            f.write(bytes(offset - f.tell()))
+            f.write(data.tobytes() if isinstance(data, array) else data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+class Snapshot:
+    # A snapshot file opened through a memory map. Metadata is turned into TrackInfo tuples only
+    # when asked for, so opening costs little more than decoding the string table.
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self._arrays = []
+        try:
+            magic, version, self.snapshot_id, count = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError("unknown session format")
+            self._sections = {}
+            for number in range(count):
+                name, offset, size = SECTION.unpack_from(self._map, HEADER.size + number * SECTION.size)
+                if offset + size > len(self._map):
+                    raise ValueError("truncated session snapshot")
+                self._sections[name] = (offset, size)
+
+            self.strings = self._text(b"STRS")
+            # Fields added to TrackInfo after the snapshot was written read as None
+            self._columns = [self._array(name, "I" if COLUMNS[field] == "s" else COLUMNS[field])
+                             if name in self._sections else None
+                             for name, field in ((f"C{number:03d}".encode(), field) for number, field in enumerate(FIELDS))]
+            self.tracks = [self.strings[string_id] for string_id in self._columns[0]]
+            self._rows = {track: row for row, track in enumerate(self.tracks)}
+        except Exception:
+            self.close()
+            raise
+
+    def _raw(self, name):
+        offset, size = self._sections[name]
+        return self._view[offset:offset + size]
+
+    def _array(self, name, typecode):
+        view = self._raw(name).cast(typecode)
+        self._arrays.append(view)
+        return view
+
+    def _text(self, name):
+        return bytes(self._raw(name)).decode("utf-8", "surrogateescape").split("\0")
+
+    def info(self, path):
+        row = self._rows.get(path)
+        if row is None:
+            return None
+        values = []
+        for field, column in zip(FIELDS, self._columns):
+            if column is None:
+                values.append(None)
+                continue
+            value = column[row]
+            kind = COLUMNS[field]
+            if kind == "s":
+                value = self.strings[value] if value else None
+            elif kind == "d" and value != value:
+                value = None
+            elif field == "year" and not value:
+                value = None
+            values.append(value)
+        return TrackInfo(*values)
+
+    def playlist(self):
+        tracks = self.tracks
+        return [tracks[row] for row in self._array(b"PLST", "I")]
+
+    def order(self):
+        return list(self._array(b"ORDR", "I"))
+
+    def state(self):
+        cursor, shuffle, repeat, current, position, volume = SESSION.unpack(self._raw(b"SESS"))
+        playlist = self.playlist()
+        folders = [folder for folder in self._text(b"ROOT") if folder] if b"ROOT" in self._sections else []
+        settings = json.loads(bytes(self._raw(b"PREF"))) if b"PREF" in self._sections else {}
+        return SessionState(playlist, cursor if 0 <= cursor < len(playlist) else None, bool(shuffle), self.order(),
+                            REPEAT_MODES[repeat], self.tracks[current] if current >= 0 else None, position, volume,
+                            folders, settings)
+
+    def search_index(self):
+        # The saved search index, or None if this snapshot doesn't have one (of this version)
+        if b"SDOC" not in self._sections or b"SVER" not in self._sections:
+            return None
+        if self._array(b"SVER", "I")[0] != INDEX_VERSION:
+            return None
+        # String id 0 marks a document that had been removed
+        paths = [self.strings[string_id] if string_id else None for string_id in self._array(b"SDOC", "I")]
+        texts = self._text(b"STXT") if paths else []
+        texts = [text if path is not None else None for path, text in zip(paths, texts)]
+        refs = self._array(b"SREF", "I")
+        postings = []
+        for prefix in (b"T", b"P"):
+            keys = self._text(prefix + b"KEY")
+            offsets = self._array(prefix + b"OFF", "Q")
+            joined = self._array(prefix + b"PST", "B")
+            size = array("I").itemsize
+            postings.append([(key, posting_array(joined[offsets[number] * size:offsets[number + 1] * size]))
+                             for number, key in enumerate(keys) if key])
+        return SearchIndex.restore(paths, texts, refs, postings[0], postings[1])
+
+    def close(self):
+        for view in self._arrays:
+            view.release()
+        self._arrays = []
+        self._view.release()
+        self._map.close()
+
+
+def posting_array(view):
+    # A mutable copy, since the index keeps appending to its postings
+    posting = array("I")
+    posting.frombytes(view)
+    return posting
+
+
+def read_journal(path, snapshot_id):
+    # (records, end of the last intact record), or (None, None) if the journal doesn't belong to
+    # the snapshot; a record cut short by a crash ends the journal
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None, None
+    if data[:4] != JOURNAL_MAGIC or len(data) < 12 or struct.unpack_from("<Q", data, 4)[0] != snapshot_id:
+        return None, None
+
+    records = []
+    position = 12
+    while position + RECORD.size <= len(data):
+        size, checksum = RECORD.unpack_from(data, position)
+        payload = data[position + RECORD.size:position + RECORD.size + size]
+        if len(payload) < size or zlib.crc32(payload) != checksum:
+            break
+        try:
+            records.append(json.loads(payload))
+        except ValueError:
+            break
+        position += RECORD.size + size
+    return records, position
+
+
+class SessionStore:
+    def __init__(self, directory=None):
+        directory = directory or os.path.dirname(data_path("session", "journal"))
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.journal_path = os.path.join(directory, "journal")
+        self.next_journal_path = self.journal_path + ".next"
+        self.snapshot = None
+        self.snapshot_id = 0
+        self.journal_size = 0
+        self._journal = None
+        # The journal of a snapshot still being written, and the thread writing it
+        self._next_journal = None
+        self._saving = None
+        # Guards the journals against record() while a finished save swaps them
+        self._lock = threading.Lock()
+
+    def snapshot_path(self, snapshot_id):
+        # Every snapshot gets a new file, since the one in use is still mapped (and Windows won't
+        # replace a mapped file); older ones are deleted once a new one is written
+        return os.path.join(self.directory, f"snapshot.{snapshot_id}")
+
+    def snapshot_ids(self):
+        ids = []
+        for name in os.listdir(self.directory):
+            prefix, _, number = name.partition(".")
+            if prefix == "snapshot" and number.isdigit():
+                ids.append(int(number))
+        return sorted(ids, reverse=True)
+
+    def load(self):
+        # Opens the newest readable snapshot and returns the journal records written after it
+        for snapshot_id in self.snapshot_ids():
+            try:
+                self.snapshot = Snapshot(self.snapshot_path(snapshot_id))
+                self.snapshot_id = self.snapshot.snapshot_id
+                break
+            except (OSError, ValueError, KeyError, struct.error) as e:
+                print(f"Error reading session: {e}")
+
+        records, end = read_journal(self.journal_path, self.snapshot_id)
+        if records is None:
+            # A background save that wrote its snapshot but didn't get to swap the journals
+            records, end = read_journal(self.next_journal_path, self.snapshot_id)
+            if records is not None:
+                os.replace(self.next_journal_path, self.journal_path)
+        if records is None:
+            self._start_journal()
+            return []
+        self._journal = open(self.journal_path, "r+b")
+        # Drop a half-written record at the end, so new ones follow the last good one
+        self._journal.truncate(end)
+        self._journal.seek(end)
+        self.journal_size = end
+        return records
+
+    def _new_journal(self, path, snapshot_id):
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(JOURNAL_MAGIC + struct.pack("<Q", snapshot_id))
+        os.replace(temporary, path)
+        journal = open(path, "r+b")
+        journal.seek(0, os.SEEK_END)
+        return journal
+
+    def _start_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = self._new_journal(self.journal_path, self.snapshot_id)
+        self.journal_size = self._journal.tell()
+
+    def record(self, *change):
+        payload = json.dumps(change, separators=(",", ":")).encode()
+        data = RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._journal is None:
+                return
+            try:
+                self._journal.write(data)
+                self._journal.flush()
+                self.journal_size += len(data)
+                if self._next_journal is not None:
+                    self._next_journal.write(data)
+                    self._next_journal.flush()
+            except OSError as e:
+                print(f"Error writing session: {e}")
+
+    @property
+    def saving(self):
+        return self._saving is not None and self._saving.is_alive()
+
+    @property
+    def needs_compaction(self):
+        return self.journal_size > COMPACT_BYTES and not self.saving
+
+    def save(self, state, info_for, search_index=None, background=False):
+        # A fresh snapshot of everything, then an empty journal that belongs to it. A crash in
+        # between leaves a journal with the old id, which is then ignored. In the background
+        # the state and search index must be copies the caller won't change.
+        self.wait()
+        snapshot_id = max([self.snapshot_id] + self.snapshot_ids()) + 1
+        if background:
+            try:
+                next_journal = self._new_journal(self.next_journal_path, snapshot_id)
+            except OSError as e:
+                print(f"Error saving session: {e}")
+                return
+            with self._lock:
+                self._next_journal = next_journal
+            self._saving = threading.Thread(target=self._save, args=(snapshot_id, state, info_for, search_index),
+                                            daemon=True)
+            self._saving.start()
+        else:
+            self._save(snapshot_id, state, info_for, search_index)
+
+    def _save(self, snapshot_id, state, info_for, search_index):
+        try:
+            write_snapshot(self.snapshot_path(snapshot_id), snapshot_id, state, info_for, search_index)
+        except OSError as e:
+            print(f"Error saving session: {e}")
+            with self._lock:
+                if self._next_journal is not None:
+                    self._next_journal.close()
+                    self._next_journal = None
+            return
+        with self._lock:
+            self.snapshot_id = snapshot_id
+            if self._next_journal is None:
+                self._start_journal()
+            else:
+                # Closed first, since Windows won't rename an open file
+                self._next_journal.close()
+                self._next_journal = None
+                self._journal.close()
+                try:
+                    os.replace(self.next_journal_path, self.journal_path)
+                    self._journal = open(self.journal_path, "r+b")
+                    self.journal_size = self._journal.seek(0, os.SEEK_END)
+                except OSError as e:
+                    print(f"Error saving session: {e}")
+                    self._start_journal()
+        for old_id in self.snapshot_ids():
+            if old_id != snapshot_id:
+                try:
+                    os.remove(self.snapshot_path(old_id))
+                except OSError:
+                    # Still mapped on Windows; it goes with the next save
+                    pass
+
+    def wait(self):
+        # Until a background save has finished
+        if self._saving is not None:
+            self._saving.join()
+            self._saving = None
+
+    def close(self):
+        self.wait()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
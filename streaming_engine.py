@@ -0,0 +1,482 @@
+import os
+import time
+import threading
+import importlib.util
+
+from audio_decode import open_pcm, decoder_for, supported_extensions, numpy_available, ffmpeg_path
+from dsp import Equalizer, Crossfade, EQ_PRESETS, flat
+from playback import PlaybackEngine, ADVANCED, ENDED
+
+pygame = None
+
+# The ring holds RING_SLOTS blocks of BLOCK_SECONDS each: that much audio is decoded ahead,
+# and it is all the memory a track takes however long it is
+BLOCK_SECONDS = 0.25
+RING_SLOTS = 8
+MIXER_RATE = 44100
+MIXER_CHANNELS = 2
+
+
+def available():
+    # Streaming needs NumPy for the sample conversion and ffmpeg for anything but WAV;
+    # MUSIC_PLAYER_ENGINE=music|stream overrides the choice
+    choice = os.environ.get("MUSIC_PLAYER_ENGINE")
+    if choice:
+        return choice == "stream"
+    return numpy_available() and importlib.util.find_spec("pygame") is not None and ffmpeg_path() is not None
+
+
+class RingBuffer:
+    # A fixed number of equally sized slots in one preallocated bytearray. The decoder fills
+    # slots, the feeder hands them to the mixer. Each slot can carry a tag (a track boundary).
+    def __init__(self, slots, slot_bytes):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.finished = False
+        self.closed = False
+
+        self._data = bytearray(slots * slot_bytes)
+        self._view = memoryview(self._data)
+        self._sizes = [0] * slots
+        self._tags = [None] * slots
+        self._head = 0
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def slot(self, index):
+        return self._view[index * self.slot_bytes:(index + 1) * self.slot_bytes]
+
+    def reserve(self):
+        # Index of the next free slot, waiting for one; None once the ring has been closed
+        with self._condition:
+            while self._count == self.slots and not self.closed:
+                self._condition.wait()
+            if self.closed:
+                return None
+            return (self._head + self._count) % self.slots
+
+    def commit(self, index, size, tag=None):
+        with self._condition:
+            self._sizes[index] = size
+            self._tags[index] = tag
+            self._count += 1
+
+    def take(self):
+        # (index, size, tag) of the oldest filled slot without waiting, or None
+        with self._condition:
+            if not self._count:
+                return None
+            return self._head, self._sizes[self._head], self._tags[self._head]
+
+    def release(self):
+        with self._condition:
+            self._head = (self._head + 1) % self.slots
+            self._count -= 1
+            self._condition.notify()
+
+    def buffered(self):
+        return self._count
+
+    def finish(self):
+        with self._condition:
+            self.finished = True
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class BlockReader:
+    # Reads a PcmStream in blocks of exactly the size asked for (shorter only at its end),
+    # whatever sizes its decoder hands out, through one preallocated buffer. read() returns a
+    # view that is valid until the next call.
+    def __init__(self, stream, block_frames):
+        import numpy as np
+
+        self.stream = stream
+        self.frames = stream.frames
+        self.read_frames = 0
+        self._blocks = stream.blocks(block_frames)
+        self._buffer = np.zeros((block_frames, stream.channels), np.float32)
+        self._block = None
+        self._position = 0
+
+    @property
+    def remaining(self):
+        # Frames left, or None when the stream's length isn't known
+        return max(0, self.frames - self.read_frames) if self.frames is not None else None
+
+    def read(self, count):
+        filled = 0
+        while filled < count:
+            if self._block is None or self._position >= len(self._block):
+                self._block = next(self._blocks, None)
+                self._position = 0
+                if self._block is None:
+                    break
+            taken = min(count - filled, len(self._block) - self._position)
+            self._buffer[filled:filled + taken] = self._block[self._position:self._position + taken]
+            self._position += taken
+            filled += taken
+        self.read_frames += filled
+        return self._buffer[:filled]
+
+    def close(self):
+        self.stream.close()
+
+
+class RingWriter:
+    # Converts float frames to 16 bit samples straight into the ring's slots
+    def __init__(self, ring, channels):
+        import numpy as np
+
+        self.ring = ring
+        self.channels = channels
+        self.slot_samples = ring.slot_bytes // 2
+        self.slot_frames = self.slot_samples // channels
+        self._scratch = np.empty(self.slot_samples, np.float32)
+        self._index = None
+        self._out = None
+        self._filled = 0
+        self._tag = None
+
+    def mark(self, file_path, ahead=0):
+        # file_path starts `ahead` frames after what has been written so far
+        self._tag = (file_path, self._filled // self.channels + ahead)
+
+    def write(self, frames):
+        # False once the ring has been closed
+        import numpy as np
+
+        samples = frames.reshape(-1)
+        position = 0
+        while position < len(samples):
+            if self._index is None:
+                self._index = self.ring.reserve()
+                if self._index is None:
+                    return False
+                self._out = np.frombuffer(self.ring.slot(self._index), np.int16)
+            count = min(len(samples) - position, self.slot_samples - self._filled)
+            chunk = self._scratch[:count]
+            np.multiply(samples[position:position + count], 32767, out=chunk)
+            np.clip(chunk, -32768, 32767, out=chunk)
+            self._out[self._filled:self._filled + count] = chunk
+            self._filled += count
+            position += count
+            if self._filled == self.slot_samples:
+                self.ring.commit(self._index, self._filled * 2, self._tag)
+                self._index, self._filled, self._tag = None, 0, None
+        return True
+
+    def finish(self):
+        if self._index is not None and self._filled:
+            self.ring.commit(self._index, self._filled * 2, self._tag)
+        self.ring.finish()
+
+
+class StreamingEngine(PlaybackEngine):
+    # Plays through a mixer channel fed with short blocks decoded by audio_decode, instead of
+    # pygame.mixer.music. Any format with a registered decoder plays, memory stays at one ring
+    # buffer, and the next track is decoded into the same ring so it follows without a gap.
+    def __init__(self, metadata=None, art_loader=None):
+        super().__init__(metadata, art_loader)
+        self.channel = None
+        self.sample_rate = MIXER_RATE
+        self.channels = MIXER_CHANNELS
+        self._lock = threading.Lock()
+        self._ring = None
+        self._decoder = None
+        self._pending_tag = None
+        self._advanced = None
+        self._ended = False
+        # The queued track the decoder has already moved on to
+        self._taken = None
+        # One Sound per ring slot, its samples written over each time the slot comes round
+        self._sounds = []
+        self._sound_views = []
+
+    @property
+    def extensions(self):
+        return supported_extensions()
+
+    @property
+    def processes_audio(self):
+        return True
+
+    def _init_mixer(self):
+        global pygame
+        if self._ready:
+            return
+        if pygame is None:
+            import pygame
+        import pygame.sndarray
+        pygame.mixer.init(frequency=MIXER_RATE, size=-16, channels=MIXER_CHANNELS, buffer=1024)
+        self.sample_rate, _, self.channels = pygame.mixer.get_init()
+        self._sounds = [pygame.mixer.Sound(buffer=bytes(self._slot_bytes())) for _ in range(RING_SLOTS)]
+        self._sound_views = [memoryview(pygame.sndarray.samples(sound)).cast("B") for sound in self._sounds]
+        pygame.mixer.set_reserved(1)
+        self.channel = pygame.mixer.Channel(0)
+        self.channel.set_volume(self.volume)
+        self._ready = True
+        threading.Thread(target=self._feed, daemon=True).start()
+
+    def play(self, file_path, start=0.0):
+        self._init_mixer()
+        # A track picked while another one plays fades in over it, from where that one is now
+        fade_from = None
+        if self.crossfade and self.playing and self.current is not None and self._ring is not None:
+            fade_from = (self.current, self.get_pos())
+        with self._lock:
+            self.current = file_path
+            self.queued = None
+            self.playing = True
+            self._start_decoding(file_path, start, fade_from)
+        self.clock.start(start)
+        self._index_later(file_path)
+
+    def _start_decoding(self, file_path, start, fade_from=None):
+        # Called with the lock held: drop whatever was buffered and decode from file_path onwards
+        if self._ring is not None:
+            self._ring.close()
+        self.channel.stop()
+        self._pending_tag = None
+        self._advanced = None
+        self._ended = False
+        if self._taken is not None and self.queued is None:
+            # Seeking within a track: what the old decoder had taken as next is still next
+            self.queued = self._taken
+        self._taken = None
+
+        self._ring = RingBuffer(RING_SLOTS, self._slot_bytes())
+        self._decoder = threading.Thread(target=self._decode, args=(self._ring, file_path, start, fade_from), daemon=True)
+        self._decoder.start()
+
+    def _slot_bytes(self):
+        return int(BLOCK_SECONDS * self.sample_rate) * self.channels * 2
+
+    def queue(self, file_path):
+        if self.current is not None and file_path != self._taken and decoder_for(file_path) is not None:
+            self.queued = file_path
+
+    def pause(self):
+        if self.current is not None:
+            self.channel.pause()
+            self.clock.pause()
+            self.playing = False
+
+    def unpause(self):
+        if self.current is not None:
+            self.channel.unpause()
+            self.clock.resume()
+            self.playing = True
+
+    def stop(self):
+        if self.current is not None:
+            with self._lock:
+                if self._ring is not None:
+                    self._ring.close()
+                    self._ring = None
+                self.channel.stop()
+            self.clock.stop()
+            self.current = None
+            self.queued = None
+            self.playing = False
+
+    def set_volume(self, volume):
+        self.volume = volume
+        if self._ready:
+            self.channel.set_volume(volume)
+
+    def set_pos(self, seconds):
+        if self.current is None:
+            return
+        with self._lock:
+            self._start_decoding(self.current, seconds)
+        self.clock.seek(seconds)
+
+    def poll(self):
+        with self._lock:
+            if self._advanced is not None:
+                file_path, started = self._advanced
+                self._advanced = None
+                self.current = file_path
+                self._taken = None
+                self.clock.start(max(0.0, time.monotonic() - started))
+                return ADVANCED
+            if self._ended:
+                self._ended = False
+                self.playing = False
+                self.clock.stop()
+                return ENDED
+        return None
+
+    def _decode(self, ring, file_path, start, fade_from=None):
+        # Decoder thread: reads the track and the ones queued after it block by block, through the
+        # crossfade and the equalizer into the ring. Settings changed meanwhile apply from the
+        # next block on, which reaches the speakers once the blocks already in the ring have played.
+        writer = RingWriter(ring, self.channels)
+        block_frames = writer.slot_frames
+        reader = self._open(file_path, start, block_frames)
+        outgoing = None
+        crossfade = None
+        equalizer = None
+        # Whether the fade into the next track was looked into for the current one
+        fade_checked = False
+        if fade_from is not None and reader is not None:
+            outgoing = self._open(*fade_from, block_frames)
+            if outgoing is not None:
+                crossfade = Crossfade(self.crossfade, self.sample_rate, self.channels, block_frames)
+                crossfade.start()
+
+        try:
+            while reader is not None:
+                equalizer = self._equalizer(equalizer, block_frames)
+                count = block_frames
+                fade_frames = int(self.crossfade * self.sample_rate)
+                if fade_frames and outgoing is None and not fade_checked and reader.remaining is not None:
+                    lead = reader.remaining - fade_frames
+                    if reader.frames < 2 * fade_frames:
+                        # Too short to fade over, it follows without a gap instead
+                        fade_checked = True
+                    elif lead > 0:
+                        # Stop short of where the fade into the next track begins
+                        count = min(count, lead)
+                    else:
+                        fade_checked = True
+                        following = self._next_track(ring)
+                        if ring.closed:
+                            return
+                        incoming = self._open(following, 0.0, block_frames) if following is not None else None
+                        if incoming is not None:
+                            if crossfade is None or crossfade.frames != fade_frames:
+                                crossfade = Crossfade(self.crossfade, self.sample_rate, self.channels, block_frames)
+                            crossfade.start()
+                            outgoing, reader = reader, incoming
+                            fade_checked = False
+                            writer.mark(following, equalizer.pending if equalizer is not None else 0)
+
+                block = reader.read(count)
+                if outgoing is not None:
+                    block = crossfade.mix(outgoing.read(len(block)), block)
+                    if not crossfade.active or not len(block):
+                        outgoing.close()
+                        outgoing = None
+
+                if not len(block):
+                    # Carry straight on with the queued track, remembering where in the slot it begins
+                    reader.close()
+                    reader = None
+                    following = self._next_track(ring)
+                    if ring.closed:
+                        return
+                    if following is None:
+                        break
+                    # An undecodable next track ends playback here, as if nothing had been queued
+                    reader = self._open(following, 0.0, block_frames)
+                    if reader is not None:
+                        writer.mark(following, equalizer.pending if equalizer is not None else 0)
+                        fade_checked = False
+                    continue
+
+                if equalizer is not None:
+                    block = equalizer.process(block)
+                if not writer.write(block):
+                    return
+
+            if equalizer is not None and not writer.write(equalizer.flush()):
+                return
+            writer.finish()
+        finally:
+            for stream in (reader, outgoing):
+                if stream is not None:
+                    stream.close()
+
+    def _open(self, file_path, start, block_frames):
+        seek_index = self.metadata.seek_index(file_path, build=False) if start > 0 and self.metadata is not None else None
+        stream = open_pcm(file_path, start, self.sample_rate, self.channels, seek_index)
+        return BlockReader(stream, block_frames) if stream is not None else None
+
+    def _next_track(self, ring):
+        # The player only queues the track after next once it notices this one has started,
+        # so with nothing queued yet, wait until the ring has nearly run dry before giving up
+        while self.queued is None and ring.buffered() > 1 and not ring.closed:
+            time.sleep(BLOCK_SECONDS / 4)
+        with self._lock:
+            if ring.closed:
+                return None
+            file_path, self.queued = self.queued, None
+            self._taken = file_path
+        return file_path
+
+    def _equalizer(self, equalizer, block_frames):
+        # Made when the equalizer is first turned on, then kept (flat if turned off) so its
+        # delay doesn't come and go in the middle of the sound
+        gains = self.equalizer
+        if equalizer is None:
+            if gains is None or flat(gains):
+                return None
+            return Equalizer(self.sample_rate, self.channels, block_frames, gains)
+        # Called for every block; the gains are clamped when they are set, so only a change
+        # needs the filter redone
+        if gains is None:
+            gains = EQ_PRESETS["flat"]
+        if gains != equalizer.gains:
+            equalizer.set_gains(gains)
+        return equalizer
+
+    def _feed(self):
+        # Feeder thread: keeps one block queued behind the one the channel is playing
+        while True:
+            time.sleep(BLOCK_SECONDS / 4)
+            with self._lock:
+                ring = self._ring
+                if ring is None or not self.playing:
+                    continue
+                try:
+                    self._feed_ring(ring)
+                except pygame.error as e:
+                    print(f"Error feeding audio: {e}")
+
+    def _feed_ring(self, ring):
+        channel = self.channel
+        if channel.get_queue() is not None:
+            return
+        if self._pending_tag is not None:
+            # The block queued last has just started, and the next track begins inside it
+            self._mark_advanced(self._pending_tag, time.monotonic())
+            self._pending_tag = None
+
+        entry = ring.take()
+        if entry is None:
+            if ring.finished and not channel.get_busy():
+                self._ended = True
+                self._ring = None
+            return
+        index, size, tag = entry
+        sound = None
+        if size == ring.slot_bytes:
+            # Into the slot's own Sound rather than a new one every block. The channel holds at
+            # most two blocks and is stopped before a new ring starts, so this Sound is done
+            # playing since its slot last came round.
+            self._sound_views[index][:] = ring.slot(index)
+            sound = self._sounds[index]
+        elif size:
+            # The last block of the stream, shorter than a slot
+            sound = pygame.mixer.Sound(buffer=ring.slot(index)[:size])
+        ring.release()
+
+        if sound is None:
+            if tag is not None:
+                self._mark_advanced(tag, time.monotonic())
+        elif channel.get_busy():
+            channel.queue(sound)
+            self._pending_tag = tag
+        else:
+            channel.play(sound)
+            if tag is not None:
+                self._mark_advanced(tag, time.monotonic())
+
+    def _mark_advanced(self, tag, block_started):
+        file_path, offset = tag
+        self._advanced = (file_path, block_started + offset / self.sample_rate)
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# The modules live at the top of the repo, the synthetic MP3 writer in benchmarks/
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in (REPO, os.path.join(REPO, "benchmarks")):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+# Set before anything imports app_paths, so no test touches the real ~/.music_player
+os.environ.setdefault("MUSIC_PLAYER_HOME", tempfile.mkdtemp(prefix="music_player_tests_"))
@@ -0,0 +1,97 @@
+import pytest
+
+from library_columns import LibraryColumns, compile_query, looks_like_query
+from metadata_cache import TrackInfo
+from playlist import Playlist
+
+
+def info(path, title, artist, album, genre, year, duration):
+    return TrackInfo(path, 0, 0.0, duration, 128, title, artist, album, genre, year, None)
+
+
+INFOS = {info.path: info for info in (
+    info("/a.mp3", "So What", "Miles Davis", "Kind of Blue", "Jazz", 1959, 565.0),
+    info("/b.mp3", "Blue in Green", "Miles Davis", "Kind of Blue", "jazz", 1959, 337.0),
+    info("/c.mp3", "Bohemian Rhapsody", "Queen", "A Night at the Opera", "Rock", 1975, 355.0),
+    info("/d.mp3", "Halo", "Beyoncé", "I Am... Sasha Fierce", "Pop", 2008, 261.0),
+    info("/e.mp3", None, None, None, None, None, None),
+)}
+
+
+@pytest.fixture
+def columns():
+    playlist = Playlist(INFOS)
+    return LibraryColumns(playlist, INFOS.get)
+
+
+def select(columns, text):
+    return columns.select(compile_query(text))
+
+
+def test_looks_like_query():
+    assert looks_like_query("genre = jazz")
+    assert looks_like_query("miles sorted by year")
+    assert not looks_like_query("miles davis")
+
+
+def test_filters(columns):
+    assert select(columns, "genre = JAZZ") == ["/a.mp3", "/b.mp3"]
+    assert select(columns, "artist ~ beyonce") == ["/d.mp3"]
+    assert select(columns, "year < 1970 or genre = rock") == ["/a.mp3", "/b.mp3", "/c.mp3"]
+    assert select(columns, "not genre = jazz and year >= 1960") == ["/c.mp3", "/d.mp3"]
+    assert select(columns, "album = kind of blue and (title ~ green or duration > 9:00)") == ["/a.mp3", "/b.mp3"]
+    # Unknown numbers match nothing but !=
+    assert select(columns, "year != 1959") == ["/c.mp3", "/d.mp3", "/e.mp3"]
+    assert select(columns, "title < c") == ["/b.mp3", "/c.mp3", "/e.mp3"]
+
+
+def test_sorting_and_limit(columns):
+    assert select(columns, "sorted by duration desc limit 2") == ["/a.mp3", "/c.mp3"]
+    # Ties keep their playlist order
+    assert select(columns, "genre = jazz sorted by year, title") == ["/b.mp3", "/a.mp3"]
+    assert select(columns, "year > 1900 sorted by artist desc, year") == ["/c.mp3", "/a.mp3", "/b.mp3", "/d.mp3"]
+
+
+def test_follows_playlist_changes(columns):
+    assert select(columns, "genre = pop") == ["/d.mp3"]
+    playlist = columns.playlist
+    playlist.remove_at(3)
+    assert select(columns, "genre = pop") == []
+    playlist.insert(0, "/d.mp3")
+    playlist.extend(["/d.mp3"])
+    assert select(columns, "genre = pop") == ["/d.mp3", "/d.mp3"]
+    playlist.move(0, 2)
+    assert list(playlist) == ["/a.mp3", "/b.mp3", "/d.mp3", "/c.mp3", "/e.mp3", "/d.mp3"]
+    assert select(columns, "genre != jazz") == ["/d.mp3", "/c.mp3", "/e.mp3", "/d.mp3"]
+    playlist.reset(["/c.mp3"])
+    assert select(columns, "year > 0") == ["/c.mp3"]
+
+
+def test_retag_and_plays(columns):
+    select(columns, "year > 0")
+    columns.update(INFOS["/e.mp3"]._replace(genre="Jazz", year=2020))
+    assert select(columns, "genre = jazz sorted by year desc") == ["/e.mp3", "/a.mp3", "/b.mp3"]
+    columns.count_play("/c.mp3")
+    columns.count_play("/c.mp3")
+    columns.set_plays({"/a.mp3": 1, "/c.mp3": 2})
+    columns.count_play("/a.mp3")
+    columns.count_play("/a.mp3")
+    assert select(columns, "plays >= 1 sorted by plays desc") == ["/a.mp3", "/c.mp3"]
+
+
+@pytest.mark.parametrize("text, message", [
+    ("colour = red", "unknown field"),
+    ("year ~ 19", "only works on text"),
+    ("year < soon", "isn't a number"),
+    ("genre =", "ends too early"),
+    ("(genre = jazz", 'missing ")"'),
+    ("genre jazz", "expected =, !="),
+    ("sorted year", 'expected "by"'),
+    ("sorted by", "ends too early"),
+    ("limit ten", "whole number"),
+    ("genre = jazz )", "unexpected"),
+    ("genre = 'jazz", "can't read the query"),
+])
+def test_parse_errors(text, message):
+    with pytest.raises(ValueError, match=message.replace("(", r"\(").replace(")", r"\)")):
+        compile_query(text)
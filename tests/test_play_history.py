@@ -0,0 +1,133 @@
+import os
+import time
+
+from play_history import PlayHistory, read_log, month_of, month_range, PLAYED, SKIPPED, COMPLETED, LOG_HEADER
+
+NOW = time.mktime((2024, 5, 15, 12, 0, 0, 0, 0, -1))
+LAST_MONTH = time.mktime((2024, 4, 30, 23, 0, 0, 0, 0, -1))
+
+
+def record_some(history):
+    history.record(PLAYED, "/a.mp3", timestamp=NOW)
+    history.record(COMPLETED, "/a.mp3", 200.04, timestamp=NOW + 200)
+    history.record(PLAYED, "/b.mp3", timestamp=NOW + 300)
+    history.record(SKIPPED, "/b.mp3", 12.0, timestamp=NOW + 310)
+    history.record(PLAYED, "/a.mp3", timestamp=NOW + 400)
+    history.record(PLAYED, "/c.mp3", timestamp=LAST_MONTH)
+
+
+def check(history):
+    assert history.most_played("2024-05") == [("/a.mp3", 2), ("/b.mp3", 1)]
+    assert history.most_played("2024-04") == [("/c.mp3", 1)]
+    assert history.most_played("2024-05", limit=1) == [("/a.mp3", 2)]
+    assert history.recently_played() == [("/a.mp3", NOW + 400), ("/b.mp3", NOW + 300), ("/c.mp3", LAST_MONTH)]
+    assert history.recently_played(limit=1) == [("/a.mp3", NOW + 400)]
+    assert history.plays() == {"/a.mp3": 2, "/b.mp3": 1, "/c.mp3": 1}
+
+
+def test_months():
+    assert month_of(NOW) == "2024-05"
+    start, end = month_range("2024-12")
+    assert month_of(start) == "2024-12" and month_of(end) == "2025-01"
+    assert month_of(end - 1) == "2024-12"
+
+
+def test_queries_before_anything_is_written(tmp_path):
+    history = PlayHistory(str(tmp_path))
+    record_some(history)
+    check(history)
+    history.close()
+
+
+def test_log_round_trip(tmp_path):
+    history = PlayHistory(str(tmp_path))
+    record_some(history)
+    history.close()
+
+    generation, events, end = read_log(history.log_path)
+    assert generation == 0
+    assert end == os.path.getsize(history.log_path)
+    assert [event[1:] for event in events][:2] == [(PLAYED, "/a.mp3", 0.0), (COMPLETED, "/a.mp3", 200.0)]
+
+    history = PlayHistory(str(tmp_path))
+    check(history)
+    history.close()
+
+
+def test_compaction_round_trip(tmp_path):
+    history = PlayHistory(str(tmp_path))
+    record_some(history)
+    history.flush()
+    history.compact()
+    assert history.generation == 1
+    assert os.path.exists(history.log_path + ".0")
+    check(history)
+    # Recorded after the compaction, on top of the counters
+    history.record(PLAYED, "/b.mp3", timestamp=NOW + 500)
+    history.close()
+
+    history = PlayHistory(str(tmp_path))
+    assert history.generation == 1
+    assert history.most_played("2024-05") == [("/a.mp3", 2), ("/b.mp3", 2)]
+    assert history.recently_played(limit=1) == [("/b.mp3", NOW + 500)]
+    history.flush()
+    history.compact()
+    assert history.plays() == {"/a.mp3": 2, "/b.mp3": 2, "/c.mp3": 1}
+    history.close()
+
+
+def test_truncated_log(tmp_path):
+    history = PlayHistory(str(tmp_path))
+    record_some(history)
+    history.close()
+    with open(history.log_path, "r+b") as f:
+        f.truncate(os.path.getsize(history.log_path) - 5)
+
+    _, events, end = read_log(history.log_path)
+    assert len(events) == 5
+
+    # The torn record is dropped, and what comes next follows the last good one
+    history = PlayHistory(str(tmp_path))
+    assert "/c.mp3" not in history.plays()
+    history.record(PLAYED, "/d.mp3", timestamp=NOW)
+    history.close()
+    _, events, end = read_log(history.log_path)
+    assert [event[2] for event in events][-1] == "/d.mp3"
+    assert end == os.path.getsize(history.log_path)
+
+
+def test_corrupt_record_ends_the_log(tmp_path):
+    history = PlayHistory(str(tmp_path))
+    record_some(history)
+    history.close()
+    with open(history.log_path, "r+b") as f:
+        f.seek(LOG_HEADER.size + 12)
+        f.write(b"#")
+    assert read_log(history.log_path)[1] == []
+
+
+def test_missing_and_foreign_logs(tmp_path):
+    assert read_log(str(tmp_path / "log")) == (None, [], None)
+    (tmp_path / "log").write_bytes(b"something else entirely")
+    assert read_log(str(tmp_path / "log")) == (None, [], None)
+
+    # A log that isn't ours is started afresh rather than read
+    history = PlayHistory(str(tmp_path))
+    assert history.plays() == {}
+    history.close()
+    assert read_log(str(tmp_path / "log"))[0] == 0
+
+
+def test_log_of_an_older_generation_is_archived(tmp_path):
+    # A compaction that committed the counters but stopped before starting a new log
+    history = PlayHistory(str(tmp_path))
+    record_some(history)
+    history.flush()
+    history._db.execute("PRAGMA user_version = 1")
+    history.close()
+
+    history = PlayHistory(str(tmp_path))
+    assert history.generation == 1
+    assert os.path.exists(history.log_path + ".0")
+    assert read_log(history.log_path)[:2] == (1, [])
+    history.close()
@@ -0,0 +1,145 @@
+import random
+
+from playlist import Playlist, REPEAT_OFF, REPEAT_ONE, REPEAT_ALL
+
+TRACKS = [f"/music/{number:02d}.mp3" for number in range(10)]
+
+
+def shuffled(items=TRACKS, seed=1):
+    random.seed(seed)
+    playlist = Playlist(items)
+    playlist.set_shuffle(True)
+    return playlist
+
+
+def play_through(playlist, auto=True):
+    # The entries played from the cursor on until the playlist stops or comes round again
+    played = []
+    for _ in range(2 * len(playlist) + 1):
+        if playlist.advance(auto) is None:
+            break
+        played.append(playlist.current)
+    return played
+
+
+def test_advance_in_order():
+    playlist = Playlist(TRACKS)
+    playlist.set_repeat(REPEAT_OFF)
+    assert play_through(playlist) == TRACKS
+    # Next pressed by hand still comes round
+    assert playlist.advance() == 0
+    assert playlist.retreat() == 9
+
+
+def test_repeat_modes():
+    playlist = Playlist(TRACKS)
+    playlist.select(9)
+    playlist.set_repeat(REPEAT_ALL)
+    assert playlist.advance(auto=True) == 0
+    playlist.set_repeat(REPEAT_ONE)
+    assert playlist.advance(auto=True) == 0
+    assert playlist.advance() == 1
+    assert playlist.cycle_repeat() == REPEAT_OFF
+    playlist.select(9)
+    assert playlist.advance(auto=True) is None and playlist.cursor == 9
+
+
+def test_shuffle_plays_everything_once():
+    playlist = shuffled()
+    playlist.set_repeat(REPEAT_OFF)
+    played = play_through(playlist)
+    assert sorted(played) == TRACKS and played != TRACKS
+    assert [playlist[index] for index in playlist.order] == played
+    # Back through the same order
+    assert playlist.retreat() == playlist.order[-2]
+
+    playlist.set_repeat(REPEAT_ALL)
+    assert play_through(playlist)[:len(TRACKS)] == played[-1:] + played[:-1]
+
+
+def test_shuffle_starts_at_the_current_track():
+    playlist = Playlist(TRACKS)
+    playlist.select(4)
+    playlist.set_shuffle(True)
+    assert playlist.order[0] == 4 and playlist.rank_of(4) == 0
+    playlist.set_shuffle(False)
+    assert playlist.order == [] and playlist.advance() == 5
+
+
+def test_removing_the_current_track_while_shuffled():
+    playlist = shuffled()
+    order = playlist.order
+    for _ in range(4):
+        playlist.advance()
+    current, previous = playlist.current, playlist[order[2]]
+    coming = [playlist[index] for index in order[4:]]
+    playlist.remove_at(playlist.cursor)
+
+    assert current not in playlist and len(playlist) == 9
+    # The cursor goes back to the entry ranked before it
+    assert playlist.current == previous
+    assert sorted(playlist.order) == list(range(9))
+    # Next carries on with what was ranked after the removed track
+    assert play_through(playlist, auto=False)[:6] == coming
+
+
+def test_removing_the_first_ranked_track_while_shuffled():
+    playlist = shuffled()
+    second = playlist[playlist.order[1]]
+    playlist.advance()
+    playlist.remove_at(playlist.cursor)
+    assert playlist.cursor is None
+    playlist.advance()
+    assert playlist.current == second
+
+
+def test_removing_other_tracks_while_shuffled():
+    playlist = shuffled()
+    for _ in range(3):
+        playlist.advance()
+    current = playlist.current
+    coming = [playlist[index] for index in playlist.order[3:]]
+    for index in sorted(playlist.order[-3:], reverse=True):
+        playlist.remove_at(index)
+    assert playlist.current == current
+    assert sorted(playlist.order) == list(range(7))
+    assert play_through(playlist, auto=False)[:4] == coming[:4]
+    assert playlist.order[playlist.rank_of(playlist.cursor)] == playlist.cursor
+
+
+def test_inserting_while_shuffled():
+    playlist = shuffled()
+    for _ in range(3):
+        playlist.advance()
+    current = playlist.current
+    played = [playlist[index] for index in playlist.order[:playlist.rank_of(playlist.cursor)]]
+
+    playlist.insert(0, "/music/new.mp3")
+    playlist.insert(5, "/music/newer.mp3")
+    playlist.append("/music/last.mp3")
+    playlist.extend(["/music/more.mp3", "/music/most.mp3"])
+    assert playlist.current == current and len(playlist) == 15
+    assert sorted(playlist.order) == list(range(15))
+
+    # What was already played stays played, and every new entry is still to come
+    playlist.set_repeat(REPEAT_OFF)
+    rest = play_through(playlist)
+    assert sorted(rest) == sorted(set(playlist) - set(played) - {current})
+
+
+def test_index_of():
+    playlist = Playlist(TRACKS + [TRACKS[0]])
+    assert playlist.index_of(TRACKS[3]) == 3 and playlist.index_of(TRACKS[0]) == 0
+    playlist.append("/music/new.mp3")
+    assert playlist.index_of("/music/new.mp3") == 11
+    playlist.insert(0, "/music/first.mp3")
+    assert playlist.index_of(TRACKS[3]) == 4 and playlist.index_of("/music/new.mp3") == 12
+    playlist.remove_at(1)
+    assert playlist.index_of(TRACKS[0]) == 10
+    playlist.move(0, 5)
+    assert playlist.index_of("/music/first.mp3") == 5 and playlist.index_of(TRACKS[1]) == 0
+    playlist.remove_at(5)
+    # Gone from the list, say removed by the folder watcher
+    assert playlist.index_of("/music/first.mp3") is None
+    playlist.reset(TRACKS[:2])
+    assert playlist.index_of(TRACKS[1]) == 1 and playlist.index_of(TRACKS[3]) is None
@@ -0,0 +1,183 @@
+import os
+
+import pytest
+
+from metadata_cache import TrackInfo
+from playlist_files import (read_playlist, write_playlist, slice_path, split_entry, format_cue_time, parse_cue_time,
+                            entry_label)
+
+
+def info(path, title=None, artist=None, duration=None):
+    return TrackInfo(path, 0, 0.0, duration, 0, title, artist, None, None, None, None)
+
+
+def paths(entries):
+    return [entry.path for entry in entries]
+
+
+@pytest.fixture
+def music(tmp_path):
+    folder = tmp_path / "music"
+    folder.mkdir()
+    return str(folder)
+
+
+def test_slices_round_trip():
+    assert slice_path("/a.flac", 0.0) == "/a.flac"
+    assert split_entry(slice_path("/a.flac", 312.5, 547.25)) == ("/a.flac", 312.5, 547.25)
+    assert split_entry(slice_path("/a.flac", 312.5)) == ("/a.flac", 312.5, None)
+    # Not a media fragment, just an odd file name
+    assert split_entry("/a#t=x.mp3") == ("/a#t=x.mp3", 0.0, None)
+    assert entry_label("/music/a.flac#t=75.000") == "a.flac @ 1:15"
+
+
+def test_cue_times():
+    assert format_cue_time(312.5) == "05:12:38"
+    assert parse_cue_time("05:12:37") == pytest.approx(312 + 37 / 75)
+    assert parse_cue_time(format_cue_time(3599.99)) == pytest.approx(3599.99, abs=1 / 75)
+    with pytest.raises(ValueError):
+        parse_cue_time("5:12")
+
+
+@pytest.mark.parametrize("extension", [".m3u", ".m3u8"])
+def test_m3u_round_trip(music, extension):
+    entries = [os.path.join(music, "ä b.mp3"), os.path.join(music, "sub", "c.flac#t=10.000,20.000"),
+               os.path.join(music, "d.flac#t=30.000")]
+    infos = {entries[0]: info(entries[0], "Title", "Artist", 61.4)}
+    path = os.path.join(music, "list" + extension)
+    write_playlist(path, entries, infos.get)
+
+    read = list(read_playlist(path))
+    assert paths(read) == entries
+    assert read[0].title == "Artist - Title"
+    assert read[0].duration == 61
+    assert read[1].duration is None
+    # Written relative to the playlist
+    assert os.path.join(music, "ä b.mp3") not in open(path, encoding="utf-8").read()
+
+
+def test_pls_round_trip(music):
+    entries = [os.path.join(music, "a.mp3"), os.path.join(music, "b.mp3")]
+    infos = {entries[1]: info(entries[1], "B", None, 200.0)}
+    path = os.path.join(music, "list.pls")
+    write_playlist(path, entries, infos.get)
+
+    read = list(read_playlist(path))
+    assert paths(read) == entries
+    assert read[0].title is None and read[0].duration is None
+    assert read[1].title == "B" and read[1].duration == 200
+
+
+def test_pls_writes_slices_as_whole_files(music):
+    path = os.path.join(music, "list.pls")
+    write_playlist(path, [os.path.join(music, "a.flac#t=10.000,20.000")])
+    assert paths(read_playlist(path)) == [os.path.join(music, "a.flac")]
+
+
+@pytest.mark.parametrize("entries", [
+    # Consecutive tracks of one file share a FILE block
+    ["a.flac", "a.flac#t=0.000,180.000", "a.flac#t=180.000,360.000", "a.flac#t=360.000"],
+    # Out of order: the later slice must not run on into the earlier one, nor lose its end
+    ["a.flac#t=360.000", "a.flac#t=0.000,180.000"],
+    ["a.flac#t=0.000,180.000", "b.flac#t=0.000,60.000", "a.flac#t=180.000"],
+    # A gap between two slices of the same file
+    ["a.flac#t=0.000,100.000", "a.flac#t=200.000,300.000"],
+    ["a.flac#t=12.000,13.000"],
+])
+def test_cue_round_trip(music, entries):
+    entries = [os.path.join(music, entry) for entry in entries]
+    path = os.path.join(music, "album.cue")
+    write_playlist(path, entries)
+    assert paths(read_playlist(path)) == entries
+
+
+def test_cue_keeps_titles_and_lengths(music):
+    entries = [os.path.join(music, "a.flac#t=0.000,90.000"), os.path.join(music, "a.flac#t=90.000")]
+    infos = {entries[0]: info(entries[0], 'Say "Hi"', "Ann")}
+    path = os.path.join(music, "album.cue")
+    write_playlist(path, entries, infos.get)
+
+    first, second = read_playlist(path)
+    assert (first.title, first.artist, first.duration) == ("Say 'Hi'", "Ann", 90.0)
+    assert second.duration is None
+
+
+def test_cue_reader(music):
+    path = os.path.join(music, "album.cue")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('\ufeffPERFORMER "Band"\n'
+                'FILE "one.wav" WAVE\n'
+                '  TRACK 01 AUDIO\n'
+                '    TITLE "First"\n'
+                '    INDEX 00 00:00:00\n'
+                '    INDEX 01 00:01:00\n'
+                '  TRACK 02 AUDIO\n'
+                '    TITLE "Second"\n'
+                '    PERFORMER "Guest"\n'
+                '    INDEX 01 01:00:00\n'
+                'FILE "two.wav" WAVE\n'
+                '  TRACK 03 AUDIO\n'
+                '    INDEX 01 00:00:00\n')
+    first, second, third = read_playlist(path)
+    assert first == (os.path.join(music, "one.wav#t=1.000,60.000"), "First", "Band", 59.0)
+    # The last track of a block runs to the end of its file, not into the next one
+    assert second == (os.path.join(music, "one.wav#t=60.000"), "Second", "Guest", None)
+    assert third == (os.path.join(music, "two.wav"), None, "Band", None)
+
+
+def test_cue_skips_a_track_that_ends_before_it_starts(music):
+    path = os.path.join(music, "album.cue")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('FILE "one.wav" WAVE\n'
+                '  TRACK 01 AUDIO\n'
+                '    INDEX 01 02:00:00\n'
+                '  TRACK 02 AUDIO\n'
+                '    INDEX 01 01:00:00\n')
+    assert paths(read_playlist(path)) == [os.path.join(music, "one.wav#t=60.000")]
+
+
+def test_cue_with_a_bad_time_fails(music):
+    path = os.path.join(music, "album.cue")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('FILE "one.wav" WAVE\n  TRACK 01 AUDIO\n    INDEX 01 1:xx:00\n')
+    with pytest.raises(ValueError):
+        list(read_playlist(path))
+
+
+def test_m3u_reader(music):
+    path = os.path.join(music, "list.m3u")
+    with open(path, "wb") as f:
+        f.write(b"#EXTM3U\n"
+                b"#EXTINF:-1,Stream\n"
+                b"http://radio.example/stream\n"
+                b"#EXTINF:abc,Odd length\n"
+                b"C:\\Music\\caf\xe9.mp3\n"
+                b"\n"
+                b"file:///music/x%20y.mp3\n"
+                b"#EXTVLCOPT:start-time=5\n"
+                b"part.mp3\n")
+    odd, url, part = read_playlist(path)
+    # Streams are skipped, a Latin-1 line still reads
+    assert odd.title == "Odd length" and odd.duration is None
+    assert odd.path.endswith("café.mp3")
+    assert url.path == os.path.normpath("/music/x y.mp3")
+    assert part.path == os.path.join(music, "part.mp3#t=5.000")
+
+
+def test_truncated_pls(music):
+    # Cut off in the middle of the file: whatever entries are complete still come through
+    path = os.path.join(music, "list.pls")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[playlist]\nFile1=a.mp3\nTitle1=A\nLength1=12\nFile2=b.mp3\nTitle2=B\nLeng")
+    read = list(read_playlist(path))
+    assert paths(read) == [os.path.join(music, "a.mp3"), os.path.join(music, "b.mp3")]
+    assert read[0].duration == 12
+    assert read[1].duration is None
+
+
+def test_unsupported_playlist_type(music):
+    with pytest.raises(ValueError):
+        read_playlist(os.path.join(music, "list.xspf"))
+    with pytest.raises(ValueError):
+        write_playlist(os.path.join(music, "list.xspf"), [])
+    assert not os.listdir(music)
@@ -0,0 +1,107 @@
+import os
+import json
+import socket
+import threading
+
+import pytest
+
+from remote_api import RemoteServer, accept_key
+
+KEY = "dGhlIHNhbXBsZSBub25jZQ=="
+
+
+@pytest.fixture
+def serve():
+    # A headless player's remote control on a free port, its commands run by a thread of the test
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    from metadata_cache import MetadataCache
+    from player_core import PlayerCore
+
+    servers = []
+    done = threading.Event()
+
+    def run(host="127.0.0.1", token=None):
+        remote = RemoteServer(PlayerCore(metadata=MetadataCache()), 0, host, token).start()
+        servers.append(remote)
+        threading.Thread(target=owner, args=(remote,), daemon=True).start()
+        return remote
+
+    def owner(remote):
+        while not done.is_set():
+            remote.process(0.05)
+
+    yield run
+    done.set()
+    for remote in servers:
+        remote.stop()
+
+
+def request(remote, method, path, headers=None, body=b""):
+    # The status line and the JSON body of one request, sending exactly the headers given
+    lines = [f"{method} {path} HTTP/1.1", f"Content-Length: {len(body)}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    with socket.create_connection(("127.0.0.1", remote.port), timeout=5) as sock:
+        sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        response = b""
+        while True:
+            data = sock.recv(65536)
+            response += data
+            # An accepted WebSocket stays open
+            if not data or response.startswith(b"HTTP/1.1 101 ") and b"\r\n\r\n" in response:
+                break
+    head, _, payload = response.partition(b"\r\n\r\n")
+    status = int(head.split()[1])
+    return status, (head.decode() if status == 101 else json.loads(payload))
+
+
+def websocket_headers(**headers):
+    return dict({"Upgrade": "websocket", "Connection": "Upgrade", "Sec-WebSocket-Key": KEY,
+                 "Sec-WebSocket-Version": "13"}, **headers)
+
+
+def test_local_requests(serve):
+    remote = serve()
+    for host in ("127.0.0.1", f"127.0.0.1:{remote.port}", f"localhost:{remote.port}", "[::1]"):
+        status, state = request(remote, "GET", "/state", {"Host": host})
+        assert status == 200 and state["queue_length"] == 0
+    status, _ = request(remote, "GET", "/state", {"Host": "localhost", "Origin": "http://localhost:3000"})
+    assert status == 200
+    # Clients that aren't browsers may send no Host at all
+    assert request(remote, "GET", "/state")[0] == 200
+
+
+def test_other_sites_are_refused(serve):
+    remote = serve()
+    headers = {"Host": f"127.0.0.1:{remote.port}", "Content-Type": "text/plain"}
+    for origin in ("http://evil.example", "https://127.0.0.1.evil.example", "null"):
+        status, _ = request(remote, "POST", "/next", dict(headers, Origin=origin), b"{}")
+        assert status == 403
+    status, _ = request(remote, "POST", "/volume", dict(headers, Origin="http://evil.example"), b'{"volume": 0}')
+    assert status == 403 and remote.core.volume == 1.0
+
+
+def test_rebound_names_are_refused(serve):
+    remote = serve()
+    for host in ("evil.example", f"evil.example:{remote.port}", "127.0.0.1.evil.example"):
+        assert request(remote, "GET", "/state", {"Host": host})[0] == 403
+
+
+def test_websocket_from_another_site(serve):
+    remote = serve()
+    status, head = request(remote, "GET", "/events", websocket_headers(Host="localhost"))
+    assert status == 101 and accept_key(KEY) in head
+    status, _ = request(remote, "GET", "/events", websocket_headers(Host="localhost", Origin="http://evil.example"))
+    assert status == 403
+    status, _ = request(remote, "GET", "/events", websocket_headers(Host="evil.example"))
+    assert status == 403
+
+
+def test_token(serve):
+    with pytest.raises(ValueError):
+        RemoteServer(None, 0, "0.0.0.0")
+    remote = serve("0.0.0.0", "secret")
+    assert request(remote, "GET", "/state", {"Host": "player.lan"})[0] == 401
+    assert request(remote, "GET", "/state", {"Authorization": "Bearer wrong"})[0] == 401
+    status, _ = request(remote, "GET", "/state", {"Host": "player.lan", "Authorization": "Bearer secret"})
+    assert status == 200
+    assert request(remote, "GET", "/state?token=secret", {"Origin": "http://player.lan"})[0] == 200
@@ -0,0 +1,36 @@
+from metadata_cache import TrackInfo
+from search_index import SearchIndex
+
+
+def info(path, title, artist):
+    return TrackInfo(path, 0, 0.0, 0.0, 0, title, artist, None, None, None, None)
+
+
+def test_underscores_separate_words():
+    index = SearchIndex()
+    index.add("/music/01_so_what.mp3")
+    index.add("/music/02 blue in green.mp3", info("/music/02 blue in green.mp3", "Blue in Green", "Miles_Davis"))
+    assert index.search("so") == ["/music/01_so_what.mp3"]
+    assert index.search("wh so") == ["/music/01_so_what.mp3"]
+    assert index.search("da") == ["/music/02 blue in green.mp3"]
+    assert index.search("in bl") == ["/music/02 blue in green.mp3"]
+    assert index.search("_") == []
+
+
+def test_repeated_trigram_is_verified():
+    index = SearchIndex()
+    index.add("/music/xaaax.mp3")
+    index.add("/music/aaaa.mp3")
+    assert index.search("aaaa") == ["/music/aaaa.mp3"]
+    assert index.search("aaa") == ["/music/xaaax.mp3", "/music/aaaa.mp3"]
+
+
+def test_restored_index_matches():
+    index = SearchIndex()
+    for number in range(20):
+        path = f"/music/{number:02d}_track.mp3"
+        index.add(path, info(path, f"Song {number}", "Beyoncé" if number % 2 else "Queen"))
+    index.remove("/music/03_track.mp3")
+    restored = SearchIndex.restore(*index.export())
+    for query in ("beyonce", "so 1", "queen 0", "tr", "03"):
+        assert restored.search(query) == index.search(query)
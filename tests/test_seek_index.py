@@ -0,0 +1,125 @@
+import os
+
+import pytest
+
+import corpus
+from seek_index import build_seek_index, seek_position, encode, decode, indexable, FileSlice
+
+
+def frame_offsets(path, duration, bitrate=None, xing=True, seed=0):
+    # Where the corpus writer put every frame of sound
+    size = os.path.getsize(path)
+    lengths = [length for _, length in corpus.mp3_frames(duration, bitrate, corpus.random.Random(seed))]
+    offsets = []
+    position = size - sum(lengths)
+    for length in lengths:
+        offsets.append(position)
+        position += length
+    return offsets
+
+
+@pytest.mark.parametrize("bitrate, xing", [(128, True), (None, True), (320, False)])
+def test_index_finds_every_frame(tmp_path, bitrate, xing):
+    path = str(tmp_path / "track.mp3")
+    corpus.write_mp3(path, 30, bitrate=bitrate, title="Title", xing=xing)
+    expected = frame_offsets(path, 30, bitrate)
+
+    index = build_seek_index(path)
+    assert index.sample_rate == corpus.SAMPLE_RATE
+    assert index.frame_samples == corpus.SAMPLES_PER_FRAME
+    assert index.frames == len(expected)
+    assert list(index.offsets) == expected[::index.step]
+
+    for seconds in (0, 0.5, 1.0, 12.34, 29.9, 60):
+        offset, start = seek_position(index, path, seconds)
+        frame = min(int(seconds * corpus.SAMPLE_RATE / corpus.SAMPLES_PER_FRAME), len(expected) - 1)
+        assert offset == expected[frame]
+        assert start == pytest.approx(frame * corpus.SAMPLES_PER_FRAME / corpus.SAMPLE_RATE)
+        assert start <= seconds
+
+
+def test_encode_round_trip(tmp_path):
+    path = str(tmp_path / "track.mp3")
+    corpus.write_mp3(path, 10, bitrate=None)
+    index = build_seek_index(path)
+    assert decode(index.sample_rate, index.frame_samples, index.step, index.frames, encode(index)) == index
+
+
+def test_truncated_file(tmp_path):
+    path = str(tmp_path / "track.mp3")
+    corpus.write_mp3(path, 10, bitrate=128)
+    expected = frame_offsets(path, 10, 128)
+    # Cut off in the middle of the last frame
+    with open(path, "r+b") as f:
+        f.truncate(expected[-1] + 100)
+
+    # A frame cut short is still indexed, the decoder stops where the data does
+    index = build_seek_index(path)
+    assert index.frames == len(expected)
+    assert seek_position(index, path, 10)[0] == expected[-1]
+
+
+def test_file_changed_since_it_was_indexed(tmp_path):
+    path = str(tmp_path / "track.mp3")
+    corpus.write_mp3(path, 10, bitrate=128)
+    index = build_seek_index(path)
+    expected = frame_offsets(path, 10, 128)
+    with open(path, "r+b") as f:
+        f.truncate(expected[index.step // 2])
+
+    # Starts at the last frame it could still find
+    offset, start = seek_position(index, path, (index.step - 1) * corpus.SAMPLES_PER_FRAME / corpus.SAMPLE_RATE)
+    assert offset == expected[index.step // 2]
+    assert start == pytest.approx(index.step // 2 * corpus.SAMPLES_PER_FRAME / corpus.SAMPLE_RATE)
+
+
+def test_not_mpeg_audio(tmp_path):
+    path = tmp_path / "track.mp3"
+    path.write_bytes(b"RIFF" + bytes(5000))
+    assert build_seek_index(str(path)) is None
+    path.write_bytes(b"")
+    assert build_seek_index(str(path)) is None
+    assert indexable("a.MP3") and not indexable("a.flac")
+
+
+def test_file_slice(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(bytes(range(100)))
+    with FileSlice(str(path), 40) as part:
+        assert part.read(3) == bytes((40, 41, 42))
+        assert part.tell() == 3
+        assert part.seek(10) == 10
+        assert part.read(1) == bytes((50,))
+        assert part.seek(-5, os.SEEK_END) == 55
+        assert part.read() == bytes(range(95, 100))
+    assert part.closed
+    part.close()
+
+
+def test_metadata_cache_keeps_the_most_recently_used(tmp_path, monkeypatch):
+    import metadata_cache
+
+    monkeypatch.setattr(metadata_cache, "SEEK_INDEX_MEMORY", 2)
+    cache = metadata_cache.MetadataCache(str(tmp_path / "metadata.db"))
+    paths = []
+    for name in "abc":
+        path = str(tmp_path / f"{name}.mp3")
+        corpus.write_mp3(path, 3, bitrate=128)
+        paths.append(path)
+    a, b, c = paths
+
+    index = cache.seek_index(a)
+    assert cache.seek_index(a + "#t=1.000", build=False) is index
+    cache.seek_index(b)
+    cache.seek_index(a)
+    cache.seek_index(c)
+    # b was used least recently, so it went; the database still has it
+    assert list(cache._seek_indexes) == [a, c]
+    assert cache.seek_index(b, build=False) == build_seek_index(b)
+
+    # A changed file is indexed again
+    corpus.write_mp3(a, 4, bitrate=128)
+    os.utime(a, (1, 1))
+    assert cache.seek_index(a, build=False) is None
+    assert cache.seek_index(a).frames == build_seek_index(a).frames
+    cache.close()
@@ -0,0 +1,250 @@
+import os
+import zlib
+import struct
+
+import pytest
+
+from metadata_cache import TrackInfo
+from search_index import SearchIndex
+from session_store import SessionStore, SessionState, Snapshot, read_journal, write_snapshot, RECORD, JOURNAL_MAGIC
+
+
+def info(path, title=None, artist=None, year=None, duration=180.0):
+    return TrackInfo(path, 1000, 1.5, duration, 128, title, artist, "Album", None, year, None)
+
+
+INFOS = {
+    "/music/a.mp3": info("/music/a.mp3", "Alpha", "Ann", 1969),
+    "/music/b.mp3": info("/music/b.mp3", "Béta", None, None),
+    "/music/c.flac#t=0.000,60.000": info("/music/c.flac#t=0.000,60.000", "Gamma\0Two", "Cat"),
+}
+
+
+def state(**changes):
+    fields = dict(playlist=["/music/a.mp3", "/music/b.mp3", "/music/a.mp3", "/music/c.flac#t=0.000,60.000"],
+                  cursor=2, shuffle=True, order=[2, 0, 3, 1], repeat="one", current="/music/a.mp3", position=12.5,
+                  volume=0.75, folders=["/music"], settings={"equalizer": [1.0, 0.0]})
+    fields.update(changes)
+    return SessionState(**fields)
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot.1")
+    write_snapshot(path, 1, state(), INFOS.get)
+    snapshot = Snapshot(path)
+    try:
+        assert snapshot.snapshot_id == 1
+        assert snapshot.state() == state()
+        assert snapshot.info("/music/a.mp3") == INFOS["/music/a.mp3"]
+        assert snapshot.info("/music/b.mp3").artist is None
+        assert snapshot.info("/music/b.mp3").year is None
+        # NULs inside tags can't survive the NUL separated string table
+        assert snapshot.info("/music/c.flac#t=0.000,60.000").title == "Gamma/Two"
+        assert snapshot.info("/music/missing.mp3") is None
+        assert snapshot.search_index() is None
+    finally:
+        snapshot.close()
+
+
+def test_snapshot_without_shuffle_keeps_no_order(tmp_path):
+    path = str(tmp_path / "snapshot.1")
+    write_snapshot(path, 1, state(shuffle=False, cursor=None, current=None), INFOS.get)
+    snapshot = Snapshot(path)
+    try:
+        restored = snapshot.state()
+        assert restored.order == []
+        assert restored.cursor is None
+        assert restored.current is None
+    finally:
+        snapshot.close()
+
+
+def test_unknown_track_gets_empty_metadata(tmp_path):
+    path = str(tmp_path / "snapshot.1")
+    write_snapshot(path, 1, state(playlist=["/music/new.mp3"], cursor=0, order=[0]), lambda path: None)
+    snapshot = Snapshot(path)
+    try:
+        restored = snapshot.info("/music/new.mp3")
+        assert restored.title is None
+        assert restored.duration == 0.0
+    finally:
+        snapshot.close()
+
+
+def test_snapshot_search_index_round_trip(tmp_path):
+    index = SearchIndex()
+    for path, track in INFOS.items():
+        index.add(path, track)
+    path = str(tmp_path / "snapshot.1")
+    write_snapshot(path, 1, state(), INFOS.get, index)
+    snapshot = Snapshot(path)
+    try:
+        restored = snapshot.search_index()
+        for query in ("alpha", "beta", "cat", "gam"):
+            assert sorted(restored.search(query)) == sorted(index.search(query))
+    finally:
+        snapshot.close()
+
+
+@pytest.mark.parametrize("size", [0, 10, 100])
+def test_truncated_snapshot_is_rejected(tmp_path, size):
+    path = str(tmp_path / "snapshot.1")
+    write_snapshot(path, 1, state(), INFOS.get)
+    with open(path, "r+b") as f:
+        f.truncate(size)
+    with pytest.raises((ValueError, struct.error)):
+        Snapshot(path).close()
+
+
+def test_foreign_snapshot_is_rejected(tmp_path):
+    path = tmp_path / "snapshot.1"
+    path.write_bytes(b"NOPE" + bytes(64))
+    with pytest.raises(ValueError):
+        Snapshot(str(path))
+
+
+def test_journal_round_trip(tmp_path):
+    store = SessionStore(str(tmp_path))
+    assert store.load() == []
+    store.record("volume", 0.5)
+    store.record("insert", 0, ["/music/ä.mp3"])
+    store.close()
+
+    store = SessionStore(str(tmp_path))
+    assert store.load() == [["volume", 0.5], ["insert", 0, ["/music/ä.mp3"]]]
+    store.close()
+
+
+def test_journal_drops_a_torn_record(tmp_path):
+    store = SessionStore(str(tmp_path))
+    store.load()
+    store.record("volume", 0.5)
+    store.record("volume", 0.25)
+    store.close()
+    size = os.path.getsize(store.journal_path)
+    with open(store.journal_path, "r+b") as f:
+        f.truncate(size - 3)
+
+    records, end = read_journal(store.journal_path, 0)
+    assert records == [["volume", 0.5]]
+
+    # The next record follows the last intact one
+    store = SessionStore(str(tmp_path))
+    assert store.load() == [["volume", 0.5]]
+    store.record("volume", 1.0)
+    store.close()
+    assert read_journal(store.journal_path, 0)[0] == [["volume", 0.5], ["volume", 1.0]]
+
+
+def test_journal_stops_at_a_bad_checksum(tmp_path):
+    store = SessionStore(str(tmp_path))
+    store.load()
+    store.record("volume", 0.5)
+    store.record("volume", 0.25)
+    store.close()
+    with open(store.journal_path, "r+b") as f:
+        data = bytearray(f.read())
+        # Flip a byte in the second record's payload
+        data[-2] ^= 0xFF
+        f.seek(0)
+        f.write(data)
+    assert read_journal(store.journal_path, 0)[0] == [["volume", 0.5]]
+
+
+def test_journal_of_another_snapshot_is_ignored(tmp_path):
+    store = SessionStore(str(tmp_path))
+    store.load()
+    store.record("volume", 0.5)
+    store.close()
+    assert read_journal(store.journal_path, 7) == (None, None)
+    assert read_journal(str(tmp_path / "missing"), 0) == (None, None)
+    (tmp_path / "garbage").write_bytes(b"MPSJ" + bytes(2))
+    assert read_journal(str(tmp_path / "garbage"), 0) == (None, None)
+
+
+def test_unparseable_record_ends_the_journal(tmp_path):
+    store = SessionStore(str(tmp_path))
+    store.load()
+    store.record("volume", 0.5)
+    store.close()
+    payload = b"{not json"
+    with open(store.journal_path, "ab") as f:
+        f.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+    assert read_journal(store.journal_path, 0)[0] == [["volume", 0.5]]
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_save_starts_an_empty_journal(tmp_path, background):
+    store = SessionStore(str(tmp_path))
+    store.load()
+    store.record("volume", 0.5)
+    store.save(state(), INFOS.get, background=background)
+    if background:
+        # Recorded while the snapshot is written, so it belongs after it
+        store.record("volume", 0.25)
+    store.close()
+    assert sorted(os.listdir(tmp_path)) == ["journal", "snapshot.1"]
+
+    store = SessionStore(str(tmp_path))
+    records = store.load()
+    try:
+        assert store.snapshot.state() == state()
+        assert records == ([["volume", 0.25]] if background else [])
+    finally:
+        store.close()
+        store.snapshot.close()
+
+
+def test_load_falls_back_to_an_older_snapshot(tmp_path):
+    store = SessionStore(str(tmp_path))
+    store.load()
+    store.save(state(), INFOS.get)
+    store.close()
+    # A newer snapshot that was cut short
+    (tmp_path / "snapshot.2").write_bytes(b"MPSS")
+
+    store = SessionStore(str(tmp_path))
+    store.load()
+    try:
+        assert store.snapshot_id == 1
+        assert store.snapshot.state() == state()
+    finally:
+        store.close()
+        store.snapshot.close()
+
+
+def test_load_picks_up_a_journal_that_was_not_swapped_in(tmp_path):
+    # A background save that wrote its snapshot, then stopped before replacing the journal
+    store = SessionStore(str(tmp_path))
+    store.load()
+    store.record("volume", 0.5)
+    store.close()
+    write_snapshot(store.snapshot_path(1), 1, state(), INFOS.get)
+    payload = b'["volume",0.25]'
+    with open(store.next_journal_path, "wb") as f:
+        f.write(JOURNAL_MAGIC + struct.pack("<Q", 1) + RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+
+    store = SessionStore(str(tmp_path))
+    try:
+        assert store.load() == [["volume", 0.25]]
+        assert not os.path.exists(store.next_journal_path)
+    finally:
+        store.close()
+        store.snapshot.close()
+
+
+def test_search_index_of_another_version_is_not_read(tmp_path, monkeypatch):
+    import session_store
+
+    index = SearchIndex()
+    index.add("/music/a.mp3", INFOS["/music/a.mp3"])
+    path = str(tmp_path / "snapshot.1")
+    monkeypatch.setattr(session_store, "INDEX_VERSION", 1)
+    write_snapshot(path, 1, state(), INFOS.get, index)
+    monkeypatch.undo()
+    snapshot = Snapshot(path)
+    try:
+        assert snapshot.search_index() is None
+        assert snapshot.state() == state()
+    finally:
+        snapshot.close()
@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+
+from waveform import WaveformCache
+
+
+def test_cache_keeps_the_recently_used(tmp_path):
+    tracks = []
+    for number in range(6):
+        track = tmp_path / f"{number}.wav"
+        track.write_bytes(b"x" * number)
+        tracks.append(str(track))
+    cache = WaveformCache(str(tmp_path / "waveforms"), max_files=4, pruned_files=3)
+    os.mkdir(cache.directory)
+    peaks = np.ones((2, 8), np.float32)
+
+    for number, track in enumerate(tracks[:4]):
+        cache.put(track, peaks * number)
+        os.utime(cache._file(track), (number, number))
+    # Reading one makes it the most recently used
+    assert cache.get(tracks[0])[0, 0] == 0
+    cache.put(tracks[4], peaks)
+
+    assert len(os.listdir(cache.directory)) == 3
+    assert [cache.get(track) is not None for track in tracks[:5]] == [True, False, False, True, True]
+    cache.put(tracks[5], peaks)
+    assert len(os.listdir(cache.directory)) == 4
@@ -0,0 +1,202 @@
+import os
+import math
+import hashlib
+
+from app_paths import data_path
+from audio_decode import open_pcm
+from background_loader import BackgroundLoader
+from duration_probe import probe_duration
+from instrumentation import timed
+from playlist_files import split_entry
+
+# Peaks are computed once at this resolution and scaled to whatever width they are drawn at
+COLUMNS = 1024
+# Waveforms kept on disk (about 4 KB each); past that the least recently shown ones are deleted,
+# down to PRUNED_FILES so pruning isn't needed again straight away
+MAX_FILES = 5000
+PRUNED_FILES = 4500
+
+
+@timed("waveform_compute")
+def compute_peaks(path, columns=COLUMNS):
+    # Per-column minimum and maximum of the track, as a float32 array shaped (2, columns).
+    # The audio is decoded block by block and each block is folded into the columns it covers.
+    import numpy as np
+
+    stream = open_pcm(path)
+    if stream is None:
+        return None
+    with stream:
+        total = stream.frames
+        if not total:
+            return None
+        lows = np.zeros(columns, np.float32)
+        highs = np.zeros(columns, np.float32)
+        position = 0
+        for block in stream.blocks():
+            count = len(block)
+            # Mixing down by taking the extremes over the channels keeps clipping visible
+            block_lows = block.min(axis=1)
+            block_highs = block.max(axis=1)
+
+            column = np.arange(position, position + count, dtype=np.int64) * columns // total
+            np.minimum(column, columns - 1, out=column)
+            # Columns only ever increase within a block, so each run of equal columns is one segment
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(column)) + 1))
+            targets = column[starts]
+            lows[targets] = np.minimum(lows[targets], np.minimum.reduceat(block_lows, starts))
+            highs[targets] = np.maximum(highs[targets], np.maximum.reduceat(block_highs, starts))
+            position += count
+    return np.stack((lows, highs))
+
+
+def crop_peaks(peaks, start, end, duration):
+    # The columns of a file's peaks that cover start..end seconds of it (a CUE track)
+    if not duration:
+        return peaks
+    columns = peaks.shape[1]
+    first = min(columns - 1, int(start / duration * columns))
+    last = columns if end is None else min(columns, math.ceil(end / duration * columns))
+    return peaks[:, first:max(last, first + 1)]
+
+
+def resample_peaks(peaks, width):
+    # Scale the stored columns to the drawing width, keeping the extremes when shrinking
+    import numpy as np
+
+    columns = peaks.shape[1]
+    if width >= columns:
+        index = np.arange(width) * columns // width
+        return peaks[:, index]
+    starts = np.arange(width) * columns // width
+    return np.stack((np.minimum.reduceat(peaks[0], starts), np.maximum.reduceat(peaks[1], starts)))
+
+
+def waveform_points(peaks, width, height):
+    # Outline of the waveform as flat polygon coordinates: along the maxima, back along the minima
+    import numpy as np
+
+    peaks = resample_peaks(peaks, width)
+    middle = height / 2
+    x = np.arange(width, dtype=np.float32)
+    top = np.stack((x, middle - peaks[1] * middle), axis=1)
+    bottom = np.stack((x[::-1], middle - peaks[0][::-1] * middle), axis=1)
+    return np.concatenate((top, bottom)).ravel().tolist()
+
+
+class WaveformCache:
+    # Peaks on disk, one small .npy per file, named after the file's path, size and mtime
+    # so an edited file gets a fresh waveform. A cache file's own mtime is when it was last
+    # read or written, which is what pruning goes by.
+    def __init__(self, directory=None, max_files=MAX_FILES, pruned_files=PRUNED_FILES):
+        self.directory = directory or os.path.dirname(data_path("waveforms", "x"))
+        self.max_files = max_files
+        self.pruned_files = pruned_files
+        # Files in the directory, counted at the first put()
+        self._files = None
+
+    def _file(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = hashlib.sha1(f"{os.path.abspath(path)}\0{st.st_size}\0{st.st_mtime}".encode()).hexdigest()
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, path):
+        import numpy as np
+
+        cache_file = self._file(path)
+        if cache_file is None or not os.path.exists(cache_file):
+            return None
+        try:
+            peaks = np.load(cache_file)
+            os.utime(cache_file)
+            return peaks
+        except (OSError, ValueError) as e:
+            print(f"Error reading waveform cache: {e}")
+            return None
+
+    def put(self, path, peaks):
+        import numpy as np
+
+        cache_file = self._file(path)
+        if cache_file is None:
+            return
+        temporary = cache_file + ".tmp"
+        try:
+            with open(temporary, "wb") as f:
+                np.save(f, peaks.astype(np.float16))
+            os.replace(temporary, cache_file)
+        except OSError as e:
+            print(f"Error writing waveform cache: {e}")
+            return
+        if self._files is None:
+            self._files = len(self._cache_files())
+        else:
+            self._files += 1
+        if self._files > self.max_files:
+            self.prune()
+
+    def _cache_files(self):
+        try:
+            with os.scandir(self.directory) as entries:
+                return [entry for entry in entries if entry.name.endswith(".npy")]
+        except OSError:
+            return []
+
+    def prune(self):
+        # Deletes the least recently used waveforms down to pruned_files
+        entries = []
+        for entry in self._cache_files():
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.pruned_files)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._files = len(self._cache_files())
+
+
+class WaveformLoader(BackgroundLoader):
+    # Loads peaks from the cache or computes them on a worker thread, and hands them to the
+    # Tk thread. Like the album art, only the most recently requested track is delivered.
+    ERROR = "Error computing waveform"
+
+    def __init__(self, master, cache=None):
+        super().__init__(master)
+        self.cache = cache if cache is not None else WaveformCache()
+        self._latest = 0
+
+    def request(self, file_path, callback):
+        # callback(peaks) is run on the Tk thread
+        self._latest += 1
+        self._submit((self._latest, file_path, callback))
+
+    def _run(self, job):
+        token, file_path, callback = job
+        if token == self._latest:
+            peaks = self._load(file_path)
+            if peaks is not None:
+                self._results.put((token, peaks, callback))
+
+    def _load(self, file_path):
+        # Peaks are kept per file; a CUE track gets its part of them
+        source, start, end = split_entry(file_path)
+        peaks = self.cache.get(source)
+        if peaks is None:
+            peaks = compute_peaks(source)
+            if peaks is not None:
+                self.cache.put(source, peaks)
+        if peaks is not None and source != file_path:
+            peaks = crop_peaks(peaks, start, end, probe_duration(source))
+        return peaks
+
+    def _handle(self, result):
+        token, peaks, callback = result
+        if token == self._latest:
+            callback(peaks)